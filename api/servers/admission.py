@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+''' Admission control with per-key and per-model token buckets
+
+Requests are admitted against token buckets before they reach the upstream,
+so client bursts are smoothed out here instead of turning into upstream 429s.
+Each configured scope has a request bucket (rpm) and/or a token bucket (tpm),
+kept separately for every API key:
+
+    LLMPROXY_RATE_LIMITS='{"groq": {"rpm": 30, "tpm": 6000},
+                           "groq/llama-3.1-70b-versatile": {"tpm": 6000}}'
+
+A "platform" entry limits all requests of a key to that platform, a
+"platform/model" entry those for one model. A request's token cost is its
+estimated prompt size plus `max_tokens`. Buckets hold one minute's worth and
+refill continuously. A request that does not fit reserves its share and waits
+for it (FIFO, since later requests queue behind earlier reservations), unless
+the wait would exceed the deadline or too many requests are already waiting,
+in which case it gets a 429 with `Retry-After`.
+
+- LLMPROXY_RATE_LIMITS: JSON as above; unset disables admission control
+- LLMPROXY_RATE_LIMIT_MAX_WAIT: longest queueing delay in seconds (default 10)
+- LLMPROXY_RATE_LIMIT_QUEUE: requests waiting per API key and platform (default 100)
+- LLMPROXY_RATE_LIMIT_COMPLETION_TOKENS: assumed completion size when a
+  request has no `max_tokens` (default 512)
+'''
+import asyncio
+import json
+import math
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+from fastapi import HTTPException
+from .config import env_float, env_int
+from .metrics import RATE_LIMIT_QUEUED, RATE_LIMIT_REJECTED, RATE_LIMIT_WAIT
+from .response_cache import caller_id
+
+DEFAULT_COMPLETION_TOKENS = env_int("LLMPROXY_RATE_LIMIT_COMPLETION_TOKENS", 512)
+# Idle buckets are dropped once this many exist.
+MAX_BUCKETS = 10000
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        """Seconds until `cost` is available; costs above capacity are capped so they can ever pass."""
+        self._refill(now)
+        return max(0.0, (min(cost, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, cost: float):
+        # May go negative: that is a reservation later requests queue behind.
+        self.tokens -= min(cost, self.capacity)
+
+    def refund(self, cost: float):
+        self.tokens = min(self.capacity, self.tokens + min(cost, self.capacity))
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+def estimate_request_tokens(prompt_tokens: int, max_tokens: Optional[int]) -> int:
+    """Token cost of a request: its prompt plus `max_tokens` (or a default completion size)."""
+    return prompt_tokens + (max_tokens if isinstance(max_tokens, int) and max_tokens > 0
+                            else DEFAULT_COMPLETION_TOKENS)
+
+
+class AdmissionController:
+    def __init__(self, limits: Dict[str, Dict[str, float]], max_wait: float = 10, max_queue: int = 100):
+        self.limits = limits
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self._buckets: Dict[Tuple[str, str, str], TokenBucket] = {}
+        # (platform, caller) -> requests currently waiting
+        self._queued: Dict[Tuple[str, str], int] = {}
+        self.admitted = 0
+        self.delayed = 0
+        self.rejected = 0
+
+    def _bucket(self, scope: str, kind: str, caller: str) -> TokenBucket:
+        key = (scope, kind, caller)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(self.limits[scope][kind])
+        return bucket
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [key for key, bucket in self._buckets.items() if bucket.idle(now)]:
+            del self._buckets[key]
+
+    def _charges(self, platform: str, model: str, caller: str, tokens: int) -> List[Tuple[TokenBucket, float]]:
+        charges = []
+        for scope in (platform, f"{platform}/{model}"):
+            limit = self.limits.get(scope)
+            if not limit:
+                continue
+            if limit.get("rpm"):
+                charges.append((self._bucket(scope, "rpm", caller), 1))
+            if limit.get("tpm"):
+                charges.append((self._bucket(scope, "tpm", caller), tokens))
+        return charges
+
+    async def admit(self, platform: str, api_key: str, model: str, tokens: int):
+        """Return once the request may go upstream; raise a 429 HTTPException if it cannot within the deadline."""
+        caller = caller_id(api_key)
+        charges = self._charges(platform, model, caller, tokens)
+        if not charges:
+            return
+        now = time.monotonic()
+        wait = max(bucket.wait_time(cost, now) for bucket, cost in charges)
+        queue_key = (platform, caller)
+        if wait > 0 and (wait > self.max_wait or self._queued.get(queue_key, 0) >= self.max_queue):
+            self.rejected += 1
+            RATE_LIMIT_REJECTED.inc((platform,))
+            raise HTTPException(status_code=429, detail="Rate limit exceeded, retry later",
+                                headers={"Retry-After": str(math.ceil(wait))})
+        for bucket, cost in charges:
+            bucket.take(cost)
+        self.admitted += 1
+        RATE_LIMIT_WAIT.observe((platform,), wait)
+        if wait <= 0:
+            return
+
+        self.delayed += 1
+        self._queued[queue_key] = self._queued.get(queue_key, 0) + 1
+        RATE_LIMIT_QUEUED.inc((platform,))
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # The client went away while queued; give its reservation back.
+            for bucket, cost in charges:
+                bucket.refund(cost)
+            raise
+        finally:
+            RATE_LIMIT_QUEUED.dec((platform,))
+            self._queued[queue_key] -= 1
+            if not self._queued[queue_key]:
+                del self._queued[queue_key]
+
+    def stats(self) -> Dict:
+        return {
+            "limits": self.limits,
+            "admitted": self.admitted,
+            "delayed": self.delayed,
+            "rejected": self.rejected,
+            "queued": sum(self._queued.values()),
+            "buckets": len(self._buckets),
+        }
+
+
+def _create_controller() -> Optional[AdmissionController]:
+    raw = os.environ.get("LLMPROXY_RATE_LIMITS")
+    if not raw:
+        return None
+    return AdmissionController(json.loads(raw),
+                               max_wait=env_float("LLMPROXY_RATE_LIMIT_MAX_WAIT", 10),
+                               max_queue=env_int("LLMPROXY_RATE_LIMIT_QUEUE", 100))
+
+
+admission: Optional[AdmissionController] = _create_controller()
+
+
+async def admit(platform: str, api_key: str, model: str, tokens: int):
+    if admission is not None:
+        await admission.admit(platform, api_key, model, tokens)
+
+
+def admission_stats() -> Dict:
+    return admission.stats() if admission else {"enabled": False}
@@ -1,7 +1,13 @@
 from pydantic import BaseModel, Field
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+import anyio
 import httpx
 import asyncio
-from typing import List, Dict, Optional, Union
+import re
+from typing import Any, AsyncIterator, List, Dict, Optional, Tuple, Union
+from .config import env_bool, env_int
+from . import codec
 
 
 class ImageUrl(BaseModel):
@@ -15,9 +21,24 @@ class ContentPart(BaseModel):
     image_url: Optional[ImageUrl] = None
 
 
+class FunctionCall(BaseModel):
+    name: str
+    arguments: str = ""  # JSON-encoded
+
+
+class ToolCall(BaseModel):
+    id: str
+    type: str = "function"
+    function: FunctionCall
+
+
 class Message(BaseModel):
     role: str
-    content: Union[str, List[ContentPart]]
+    # None for an assistant message that only carries tool_calls.
+    content: Union[str, List[ContentPart], None] = None
+    name: Optional[str] = None
+    tool_calls: Optional[List[ToolCall]] = None
+    tool_call_id: Optional[str] = None
 
 
 class OpenAIProxyArgs(BaseModel):
@@ -32,11 +53,229 @@ class OpenAIProxyArgs(BaseModel):
     frequency_penalty: float = Field(default=0, ge=-2, le=2)
 
 
-async def stream_openai_response(endpoint: str, payload: Dict, headers: Dict):
-    async with httpx.AsyncClient() as client:
-        async with client.stream("POST", endpoint, json=payload, headers=headers) as response:
+def wants_usage(body: Optional[Dict]) -> bool:
+    """Whether a streaming request asked for a final usage chunk (`stream_options.include_usage`)."""
+    stream_options = (body or {}).get("stream_options")
+    return isinstance(stream_options, dict) and stream_options.get("include_usage") is True
+
+
+_JSON_STRUCTURAL = re.compile(rb'[{}\[\]"]')
+_JSON_SCALAR = re.compile(rb'\s*:\s*("[^"\\]*(?:\\.[^"\\]*)*"|true|false|null|-?[0-9][0-9.eE+-]*)')
+_JSON_COLON = re.compile(rb'\s*:')
+
+
+def _json_string_end(body: bytes, start: int) -> int:
+    """Index just past the JSON string whose opening quote is at `start`."""
+    pos = start + 1
+    while True:
+        end = body.find(b'"', pos)
+        if end < 0:
+            return len(body)
+        backslashes = 0
+        while body[end - 1 - backslashes] == 0x5C:
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end + 1
+        pos = end + 1
+
+
+def scan_top_level_fields(body: bytes, fields: Tuple[str, ...]) -> Dict[str, Any]:
+    """Read scalar values of top-level keys from a JSON object without parsing all of it.
+
+    Strings are skipped with `bytes.find`, so large values such as base64
+    images cost a memchr rather than a decode. Keys nested in messages or
+    tool schemas are ignored, as are non-scalar values; a repeated key counts
+    as its last value, as with json.loads. Raises ValueError if `body` is not
+    a JSON object or is cut short; other syntax errors are left to the upstream.
+    """
+    stripped = body.strip()
+    if not stripped.startswith(b"{") or not stripped.endswith(b"}"):
+        raise ValueError("Body is not a JSON object")
+    wanted = {field.encode(): field for field in fields}
+    found: Dict[str, Any] = {}
+    depth = 0
+    pos = 0
+    while True:
+        token = _JSON_STRUCTURAL.search(body, pos)
+        if token is None:
+            break
+        start = token.start()
+        char = body[start]
+        if char == 0x22:  # '"'
+            pos = _json_string_end(body, start)
+            if depth != 1:
+                continue
+            name = body[start + 1:pos - 1]
+            if b"\\" in name:
+                name = codec.loads(body[start:pos]).encode()
+            if name in wanted:
+                scalar = _JSON_SCALAR.match(body, pos)
+                if scalar:
+                    found[wanted[name]] = codec.loads(scalar.group(1))
+                    pos = scalar.end()
+                elif _JSON_COLON.match(body, pos):
+                    found.pop(wanted[name], None)
+        else:
+            depth += 1 if char in (0x7B, 0x5B) else -1
+            pos = start + 1
+            if depth == 0:
+                break
+    if depth != 0 or body[pos:].strip():
+        raise ValueError("Body is not a single complete JSON object")
+    return found
+
+
+def payload_kwargs(payload: Union[Dict, bytes]) -> Dict:
+    """httpx request kwargs for a dict payload or an already encoded JSON body.
+
+    Dicts are encoded with the fast codec; callers set the Content-Type header.
+    """
+    return {"content": payload if isinstance(payload, bytes) else codec.dumps(payload)}
+
+
+async def iter_sse_data(response: httpx.Response) -> AsyncIterator[str]:
+    """Yield the `data:` payload of each server-sent event, stopping at `[DONE]`.
+
+    Multi-line `data:` fields are joined with newlines as per the SSE spec.
+    """
+    data_lines: List[str] = []
+    async for line in response.aiter_lines():
+        if line.startswith("data:"):
+            data_lines.append(line[6:] if line.startswith("data: ") else line[5:])
+        elif not line and data_lines:
+            data = "\n".join(data_lines)
+            data_lines = []
+            if data == "[DONE]":
+                return
+            yield data
+    if data_lines and data_lines != ["[DONE]"]:
+        yield "\n".join(data_lines)
+
+
+# `[DONE]` only ends the stream as a whole data line; completion text may contain it.
+_DONE_LINES = (b"\ndata: [DONE]", b"\ndata:[DONE]")
+_SCAN_TAIL = max(len(line) for line in _DONE_LINES) - 1
+
+
+class SSEScanner:
+    """Cheap event-boundary scanner over raw SSE bytes.
+
+    Counts events and spots the `data: [DONE]` line with C-level bytes
+    operations only; nothing is decoded or copied beyond a few bytes around
+    each chunk boundary to catch markers split across chunks.
+    """
+    __slots__ = ("events", "done", "_tail")
+
+    def __init__(self):
+        self.events = 0
+        self.done = False
+        # The start of the stream counts as the start of a line.
+        self._tail = b"\n"
+
+    def feed(self, chunk: bytes):
+        head = chunk[:_SCAN_TAIL]
+        window = self._tail + head
+        for marker in (b"\n\n", b"\r\n\r\n"):
+            self.events += chunk.count(marker)
+            # markers straddling the previous chunk and this one
+            self.events += window.count(marker) - self._tail.count(marker) - head.count(marker)
+        if any(line in chunk or line in window for line in _DONE_LINES):
+            self.done = True
+        self._tail = window[-_SCAN_TAIL:] if len(chunk) < _SCAN_TAIL else chunk[-_SCAN_TAIL:]
+
+
+# Forward upstream SSE bytes unchanged instead of re-framing them line by line.
+SSE_PASSTHROUGH = env_bool("LLMPROXY_SSE_PASSTHROUGH", True)
+
+
+async def stream_openai_response(response: httpx.Response, passthrough: Optional[bool] = None):
+    """Relay an OpenAI-compatible SSE stream from an upstream response.
+
+    `response` has been sent with `stream=True` and is closed when the relay
+    ends. In passthrough mode the raw upstream chunks are yielded as they
+    arrive, with only `SSEScanner` looking at them to stop at `[DONE]`. The
+    legacy line mode decodes every line and re-frames `data:` events.
+    """
+    if passthrough is None:
+        passthrough = SSE_PASSTHROUGH
+    try:
+        if passthrough:
+            # aiter_raw skips the decoder entirely unless the body is compressed,
+            # since the compressed bytes would not match our response headers.
+            if response.headers.get("content-encoding", "identity") == "identity":
+                chunks = response.aiter_raw()
+            else:
+                chunks = response.aiter_bytes()
+            scanner = SSEScanner()
+            async for chunk in chunks:
+                scanner.feed(chunk)
+                yield chunk
+                if scanner.done:
+                    break
+        else:
             async for line in response.aiter_lines():
                 if line.startswith("data: "):
                     yield line + "\n\n"
                 elif line.strip() == "data: [DONE]":
                     break
+    finally:
+        await response.aclose()
+
+
+# Chunks read ahead from the upstream while the client is being written to.
+STREAM_BUFFER = env_int("LLMPROXY_STREAM_BUFFER", 16)
+_END = object()
+
+
+async def relay_stream(chunks: AsyncIterator[bytes], buffer: int = STREAM_BUFFER) -> AsyncIterator[bytes]:
+    """Yield `chunks`, read by a separate task into a queue of at most `buffer` chunks.
+
+    The upstream keeps flowing while a write to the client is pending, but a
+    slow client holds back the reader (and thus the upstream socket) once the
+    queue is full instead of growing a buffer. Closing this generator, e.g.
+    on client disconnect, cancels the reader, which closes `chunks` and with
+    it the upstream response.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=buffer)
+
+    async def read():
+        try:
+            async for chunk in chunks:
+                await queue.put(chunk)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(_END)
+        finally:
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+
+    reader = asyncio.ensure_future(read())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        reader.cancel()
+
+
+class StreamRelayResponse(StreamingResponse):
+    """StreamingResponse that closes its body iterator when the client disconnects.
+
+    Starlette cancels the send loop on disconnect but leaves the async
+    generator suspended until it is garbage collected, so upstream streams
+    (and coalesced flights) would stay open. Closing it here runs their
+    cleanup right away.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if hasattr(self.body_iterator, "aclose"):
+                with anyio.CancelScope(shield=True):
+                    await self.body_iterator.aclose()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+''' Batch chat completions
+
+One HTTP call carries many chat completion requests, as a JSON array or as
+JSONL (one request per line). Items run against the upstream with bounded
+concurrency and a per-item timeout, and results are streamed back as NDJSON
+in completion order, each line tagged with the item's original index:
+
+    {"index": 3, "response": {...chat.completion...}}
+    {"index": 0, "error": {"status": 504, "message": "..."}}
+
+A failing item only produces an error line; the rest of the batch goes on.
+
+- LLMPROXY_BATCH_CONCURRENCY: items in flight per batch (default 8)
+- LLMPROXY_BATCH_TIMEOUT: per-item timeout in seconds (default 60)
+- LLMPROXY_BATCH_MAX_ITEMS: largest accepted batch (default 10000)
+'''
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Union
+from fastapi import HTTPException
+from . import codec
+from .config import env_float, env_int
+
+BATCH_CONCURRENCY = env_int("LLMPROXY_BATCH_CONCURRENCY", 8)
+BATCH_TIMEOUT = env_float("LLMPROXY_BATCH_TIMEOUT", 60)
+BATCH_MAX_ITEMS = env_int("LLMPROXY_BATCH_MAX_ITEMS", 10000)
+
+NDJSON = "application/x-ndjson"
+
+
+class BatchItemError(Exception):
+    """A failed batch item, reported on its own result line."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+def parse_batch_body(body: bytes) -> List[Union[Any, BatchItemError]]:
+    """Split a JSON array or JSONL body into items.
+
+    A JSONL line that is not valid JSON becomes a BatchItemError in its place,
+    so it is reported under its own index instead of failing the batch.
+    """
+    stripped = body.strip()
+    if stripped.startswith(b"["):
+        try:
+            items = codec.loads(stripped)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON array: {e}")
+    else:
+        items = []
+        for line in stripped.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(codec.loads(line))
+            except ValueError as e:
+                items.append(BatchItemError(400, f"Invalid JSON: {e}"))
+    if not items:
+        raise HTTPException(status_code=400, detail="Empty batch")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {BATCH_MAX_ITEMS} items")
+    return items
+
+
+def result_line(index: int, completion: bytes) -> bytes:
+    # The completion is already JSON; splice it in rather than re-encoding it,
+    # unless it is pretty-printed and would break the one-line-per-result framing.
+    if b"\n" in completion:
+        completion = codec.dumps(codec.loads(completion))
+    return b'{"index":%d,"response":%s}\n' % (index, completion)
+
+
+def error_line(index: int, status_code: int, message: str) -> bytes:
+    return codec.dumps({"index": index, "error": {"status": status_code, "message": message}}) + b"\n"
+
+
+async def run_batch(items: List[Any],
+                    run_one: Callable[[Any], Awaitable[bytes]],
+                    concurrency: int = BATCH_CONCURRENCY,
+                    timeout: float = BATCH_TIMEOUT) -> AsyncIterator[bytes]:
+    """Run `run_one` (which returns a JSON completion) for every item and yield NDJSON lines as they finish.
+
+    Remaining items are cancelled if the consumer stops early, e.g. because
+    the client disconnected.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(index: int, item: Any) -> bytes:
+        if isinstance(item, BatchItemError):
+            return error_line(index, item.status_code, item.message)
+        async with semaphore:
+            try:
+                return result_line(index, await asyncio.wait_for(run_one(item), timeout))
+            except BatchItemError as e:
+                return error_line(index, e.status_code, e.message)
+            except HTTPException as e:
+                return error_line(index, e.status_code, str(e.detail))
+            except asyncio.TimeoutError:
+                return error_line(index, 504, f"Timed out after {timeout:g}s")
+            except Exception as e:
+                return error_line(index, 500, repr(e))
+
+    tasks = [asyncio.ensure_future(run(i, item)) for i, item in enumerate(items)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
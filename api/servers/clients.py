@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+''' Shared upstream HTTP clients
+
+One pooled httpx.AsyncClient per provider, created on app startup and closed
+on shutdown, so TCP+TLS connections to the upstream APIs are reused across
+requests instead of being set up again for every call.
+
+Tunable through environment variables:
+- LLMPROXY_MAX_CONNECTIONS: max open connections per provider (default 100)
+- LLMPROXY_MAX_KEEPALIVE: max idle keep-alive connections per provider (default 20)
+- LLMPROXY_KEEPALIVE_EXPIRY: seconds an idle connection is kept (default 30)
+- LLMPROXY_TIMEOUT: upstream read/write/pool timeout in seconds (default 60;
+  non-streaming completions send nothing until they are done)
+- LLMPROXY_CONNECT_TIMEOUT: upstream connect timeout in seconds (default 5)
+- LLMPROXY_HTTP2: set to 1 to negotiate HTTP/2 (requires the `h2` package)
+'''
+from loguru import logger
+import httpx
+from typing import Dict, Iterable, Optional
+from .config import env_bool, env_float, env_int
+
+
+def _h2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _http2_enabled() -> bool:
+    if not env_bool("LLMPROXY_HTTP2"):
+        return False
+    if not _h2_available():
+        logger.warning("LLMPROXY_HTTP2 is set but `h2` is not installed, using HTTP/1.1")
+        return False
+    return True
+
+
+class ClientRegistry:
+    """App-lifetime registry of pooled upstream clients, keyed by provider."""
+
+    def __init__(self,
+                 limits: Optional[httpx.Limits] = None,
+                 timeout: Optional[httpx.Timeout] = None,
+                 http2: Optional[bool] = None):
+        self.limits = limits or httpx.Limits(
+            max_connections=env_int("LLMPROXY_MAX_CONNECTIONS", 100),
+            max_keepalive_connections=env_int("LLMPROXY_MAX_KEEPALIVE", 20),
+            keepalive_expiry=env_float("LLMPROXY_KEEPALIVE_EXPIRY", 30),
+        )
+        self.timeout = timeout or httpx.Timeout(env_float("LLMPROXY_TIMEOUT", 60),
+                                                connect=env_float("LLMPROXY_CONNECT_TIMEOUT", 5))
+        self.http2 = _http2_enabled() if http2 is None else http2
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._requests: Dict[str, int] = {}
+
+    def _create(self, provider: str) -> httpx.AsyncClient:
+        self._requests.setdefault(provider, 0)
+
+        async def count_request(request: httpx.Request):
+            self._requests[provider] += 1
+
+        return httpx.AsyncClient(
+            limits=self.limits,
+            timeout=self.timeout,
+            http2=self.http2,
+            event_hooks={"request": [count_request]},
+        )
+
+    def get(self, provider: str) -> httpx.AsyncClient:
+        """Return the pooled client for `provider`, creating it on first use.
+
+        Lazy creation keeps things working on runtimes that never fire the
+        ASGI startup event (e.g. some serverless deployments).
+        """
+        client = self._clients.get(provider)
+        if client is None or client.is_closed:
+            client = self._clients[provider] = self._create(provider)
+        return client
+
+    async def startup(self, providers: Iterable[str]):
+        for provider in providers:
+            self.get(provider)
+        logger.info(f"Upstream clients ready: {sorted(self._clients)} "
+                    f"(http2={self.http2}, limits={self.limits})")
+
+    async def aclose(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def stats(self) -> Dict[str, Dict]:
+        """Connection pool stats per provider."""
+        stats = {}
+        for provider, client in self._clients.items():
+            # httpx does not expose its pool publicly; read it defensively.
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", []))
+            stats[provider] = {
+                "requests": self._requests.get(provider, 0),
+                "connections": len(connections),
+                "idle": sum(1 for c in connections if c.is_idle()),
+                "active": sum(1 for c in connections if not c.is_idle() and not c.is_closed()),
+                "http2": self.http2,
+                "max_connections": self.limits.max_connections,
+                "max_keepalive_connections": self.limits.max_keepalive_connections,
+                "keepalive_expiry": self.limits.keepalive_expiry,
+            }
+        return stats
+
+
+registry = ClientRegistry()
+
+
+def get_client(provider: str) -> httpx.AsyncClient:
+    return registry.get(provider)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+''' JSON codec shared by all routers
+
+Uses orjson or msgspec when installed and falls back to the stdlib. All
+encoders produce compact UTF-8 bytes with non-ASCII text left unescaped,
+matching `json.dumps(..., ensure_ascii=False)`, and `loads` raises ValueError
+on invalid JSON whichever backend is in use.
+
+`ChunkTemplate` pre-renders the invariant parts of an OpenAI
+chat.completion.chunk once per stream, so each token only costs escaping its
+delta text.
+'''
+import json
+from typing import Any, Callable, Dict, Optional
+
+try:
+    import orjson
+
+    BACKEND = "orjson"
+    dumps: Callable[[Any], bytes] = orjson.dumps
+    loads: Callable[[Any], Any] = orjson.loads
+except ImportError:
+    try:
+        import msgspec
+
+        BACKEND = "msgspec"
+        dumps = msgspec.json.encode
+
+        def loads(data: Any) -> Any:
+            # msgspec.DecodeError is not a ValueError, unlike the other backends' errors.
+            try:
+                return msgspec.json.decode(data)
+            except msgspec.DecodeError as e:
+                raise ValueError(str(e)) from e
+    except ImportError:
+        BACKEND = "json"
+
+        def dumps(obj: Any) -> bytes:
+            return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+        loads = json.loads
+
+
+class ChunkTemplate:
+    """Byte templates for the SSE chunks of one chat completion stream."""
+
+    def __init__(self, completion_id: str, model: str, created: int):
+        self._head = (b'data: {"id":' + dumps(completion_id)
+                      + b',"object":"chat.completion.chunk","created":' + str(created).encode()
+                      + b',"model":' + dumps(model)
+                      + b',"choices":[{"index":')
+        self._envelope = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+        }
+
+    def content(self, text: str, index: int = 0) -> bytes:
+        """An SSE event carrying `text` as the delta content of choice `index`."""
+        return (self._head + str(index).encode() + b',"delta":{"content":' + dumps(text)
+                + b'},"finish_reason":null}]}\n\n')
+
+    def event(self, choices: list, **extra: Any) -> bytes:
+        """An SSE event with arbitrary choices, for the rarer non-text chunks."""
+        chunk: Dict[str, Any] = dict(self._envelope, choices=choices)
+        chunk.update(extra)
+        return b"data: " + dumps(chunk) + b"\n\n"
+
+    def finish(self, finish_reason: Optional[str], index: int = 0, **extra: Any) -> bytes:
+        return self.event([{"index": index, "delta": {}, "finish_reason": finish_reason}], **extra)
+
+
+DONE = b"data: [DONE]\n\n"
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+''' Adaptive per-upstream concurrency limits
+
+Opt-in (LLMPROXY_ADAPTIVE_CONCURRENCY=1). Every (platform, model) gets a
+limit on requests in flight upstream, from sending the request until its
+response (or stream) is closed. The limit is tuned from what the upstream
+shows, in the style of Netflix's gradient limiter with AIMD backoff:
+
+- every successful response's time to first byte (TTFB) updates a fast and a
+  slow moving average; while the fast one stays within `TOLERANCE` times the
+  slow one (no queueing upstream) the limit grows by about its square root,
+  and when latency inflates beyond that the limit shrinks proportionally;
+- a 429/503 or another 5xx/connection error cuts the limit by
+  `BACKOFF_RATIO`, at most once per observed TTFB so one burst of errors
+  counts once;
+- the limit only grows while it is actually being used, so idle periods do
+  not inflate it.
+
+Requests beyond the limit wait in a priority queue (`X-LLMProxy-Priority:
+high|normal|low`; batch items and batch jobs run as low), and get a 429 with
+`Retry-After` when the queue is full or the wait exceeds its deadline.
+Current limits are at /stats/concurrency and in /metrics.
+
+- LLMPROXY_ADAPTIVE_CONCURRENCY: set to 1 to enable
+- LLMPROXY_CONCURRENCY_LIMITS: JSON bounds per "platform" or
+  "platform/model", e.g. '{"gemini": {"initial": 2, "max": 10}}'
+- LLMPROXY_CONCURRENCY_INITIAL / _MIN / _MAX: default bounds (16 / 1 / 256)
+- LLMPROXY_CONCURRENCY_QUEUE: waiting requests per limit (default 1000)
+- LLMPROXY_CONCURRENCY_MAX_WAIT: longest wait for a slot in seconds (default 30)
+'''
+import asyncio
+import heapq
+import itertools
+import json
+import math
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
+from fastapi import HTTPException
+import httpx
+from .config import env_bool, env_float, env_int
+from .metrics import CONCURRENCY_IN_FLIGHT, CONCURRENCY_LIMIT, CONCURRENCY_QUEUED
+
+PRIORITY_HEADER = "X-LLMProxy-Priority"
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+PRIORITY_NORMAL = PRIORITIES["normal"]
+PRIORITY_LOW = PRIORITIES["low"]
+
+# Latency inflation tolerated before the limit shrinks.
+TOLERANCE = 1.5
+# Multiplicative decrease on throttling and errors.
+BACKOFF_RATIO = 0.8
+# Weight of each new limit estimate, and of each TTFB sample in the fast/slow averages.
+SMOOTHING = 0.2
+FAST_RTT_WEIGHT = 0.2
+SLOW_RTT_WEIGHT = 0.02
+THROTTLE_STATUSES = (429, 503)
+
+
+class AdaptiveLimiter:
+    def __init__(self, initial: float = 16, min_limit: float = 1, max_limit: float = 256,
+                 max_queue: int = 1000, max_wait: float = 30):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = min(max(initial, min_limit), max_limit)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.fast_rtt: Optional[float] = None
+        self.slow_rtt: Optional[float] = None
+        self._last_backoff = 0.0
+        # (priority, arrival, future) of waiting requests
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+        self.completed = 0
+        self.throttled = 0
+        self.errors = 0
+        self.rejected = 0
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def _has_room(self) -> bool:
+        return self.in_flight < max(1, int(self.limit))
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL) -> int:
+        """Wait for a slot; returns the number of requests in flight when it was granted.
+
+        Raises a 429 HTTPException when the queue is full or the wait times out.
+        """
+        if self._has_room() and not self.queued:
+            self.in_flight += 1
+            return self.in_flight
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(status_code=429, detail="Upstream concurrency limit reached, retry later",
+                                headers={"Retry-After": "1"})
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._arrivals), future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            if future.done():
+                # Granted just as the deadline passed; hand the slot on.
+                self.release()
+            else:
+                future.cancel()
+            self.rejected += 1
+            raise HTTPException(status_code=429, detail="Timed out waiting for an upstream slot",
+                                headers={"Retry-After": str(math.ceil(self.fast_rtt or 1))})
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+        return self.in_flight
+
+    def release(self):
+        """Free a slot and grant it to the next waiter."""
+        self.in_flight -= 1
+        self._grant()
+
+    def _grant(self):
+        """Hand free slots to waiters by priority, then arrival."""
+        while self._waiters and self._has_room():
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def observe(self, ttfb: float, status: Optional[int], in_flight: int):
+        """Update the limit from one upstream answer (`status` None for a connection error)."""
+        if status is None or status in THROTTLE_STATUSES or status >= 500:
+            if status in THROTTLE_STATUSES:
+                self.throttled += 1
+            else:
+                self.errors += 1
+            now = time.monotonic()
+            if now - self._last_backoff >= (self.fast_rtt or 0):
+                self._last_backoff = now
+                self._set_limit(self.limit * BACKOFF_RATIO)
+            return
+        self.completed += 1
+        if status >= 400:
+            # Client errors say nothing about upstream load.
+            return
+        if self.fast_rtt is None:
+            self.fast_rtt = self.slow_rtt = ttfb
+        else:
+            self.fast_rtt += FAST_RTT_WEIGHT * (ttfb - self.fast_rtt)
+            self.slow_rtt += SLOW_RTT_WEIGHT * (ttfb - self.slow_rtt)
+            # Let the baseline follow a lasting drop in latency quickly.
+            self.slow_rtt = min(self.slow_rtt, self.fast_rtt * 2)
+        if in_flight < self.limit / 2 and self.fast_rtt <= TOLERANCE * self.slow_rtt:
+            return
+        gradient = max(0.5, min(1.0, TOLERANCE * self.slow_rtt / self.fast_rtt)) if self.fast_rtt else 1.0
+        estimate = self.limit * gradient + math.sqrt(self.limit)
+        self._set_limit(self.limit * (1 - SMOOTHING) + estimate * SMOOTHING)
+
+    def _set_limit(self, limit: float):
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+        # A grown limit may admit waiters right away.
+        self._grant()
+
+    def stats(self) -> Dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "ttfb_fast": self.fast_rtt,
+            "ttfb_baseline": self.slow_rtt,
+            "completed": self.completed,
+            "throttled": self.throttled,
+            "errors": self.errors,
+            "rejected": self.rejected,
+        }
+
+
+class ReleasingStream(httpx.AsyncByteStream):
+    """Response body stream that frees the request's slot once the response is closed."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self._stream = stream
+        self._release: Optional[Callable[[], None]] = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release is not None:
+                self._release, release = None, self._release
+                release()
+
+
+class ConcurrencyLimits:
+    def __init__(self, bounds: Dict[str, Dict[str, float]], initial: float = 16, min_limit: float = 1,
+                 max_limit: float = 256, max_queue: int = 1000, max_wait: float = 30):
+        self.bounds = bounds
+        self.defaults = {"initial": initial, "min": min_limit, "max": max_limit}
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.limiters: Dict[Tuple[str, str], AdaptiveLimiter] = {}
+
+    def get(self, platform: str, model: str) -> AdaptiveLimiter:
+        limiter = self.limiters.get((platform, model))
+        if limiter is None:
+            bounds = dict(self.defaults, **self.bounds.get(platform, {}), **self.bounds.get(f"{platform}/{model}", {}))
+            limiter = self.limiters[(platform, model)] = AdaptiveLimiter(
+                bounds["initial"], bounds["min"], bounds["max"], self.max_queue, self.max_wait)
+            CONCURRENCY_LIMIT.set((platform, model), limiter.limit)
+        return limiter
+
+    async def send(self, platform: str, model: str, priority: int,
+                   send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        """Run `send` within the (platform, model) limit; the slot is held until the response is closed."""
+        limiter = self.get(platform, model)
+        labels = (platform, model)
+        CONCURRENCY_QUEUED.inc(labels)
+        try:
+            in_flight = await limiter.acquire(priority)
+        finally:
+            CONCURRENCY_QUEUED.dec(labels)
+        CONCURRENCY_IN_FLIGHT.inc(labels)
+
+        def release():
+            CONCURRENCY_IN_FLIGHT.dec(labels)
+            limiter.release()
+
+        started = time.perf_counter()
+        try:
+            response = await send()
+        except (asyncio.CancelledError, HTTPException):
+            # Cancelled, or refused by the proxy itself (every pooled key cooling down): not upstream load.
+            release()
+            raise
+        except Exception:
+            limiter.observe(time.perf_counter() - started, None, in_flight)
+            CONCURRENCY_LIMIT.set(labels, limiter.limit)
+            release()
+            raise
+        limiter.observe(time.perf_counter() - started, response.status_code, in_flight)
+        CONCURRENCY_LIMIT.set(labels, limiter.limit)
+        if response.is_closed:
+            release()
+        else:
+            response.stream = ReleasingStream(response.stream, release)
+        return response
+
+    def stats(self) -> Dict:
+        return {"enabled": True,
+                "limits": {f"{platform}/{model}": limiter.stats()
+                           for (platform, model), limiter in self.limiters.items()}}
+
+
+def _create_limits() -> Optional[ConcurrencyLimits]:
+    if not env_bool("LLMPROXY_ADAPTIVE_CONCURRENCY"):
+        return None
+    return ConcurrencyLimits(json.loads(os.environ.get("LLMPROXY_CONCURRENCY_LIMITS") or "{}"),
+                             initial=env_float("LLMPROXY_CONCURRENCY_INITIAL", 16),
+                             min_limit=env_float("LLMPROXY_CONCURRENCY_MIN", 1),
+                             max_limit=env_float("LLMPROXY_CONCURRENCY_MAX", 256),
+                             max_queue=env_int("LLMPROXY_CONCURRENCY_QUEUE", 1000),
+                             max_wait=env_float("LLMPROXY_CONCURRENCY_MAX_WAIT", 30))
+
+
+concurrency_limits: Optional[ConcurrencyLimits] = _create_limits()
+
+
+def request_priority(headers: Mapping[str, str]) -> int:
+    return PRIORITIES.get(headers.get(PRIORITY_HEADER, "").lower(), PRIORITY_NORMAL)
+
+
+async def limited_send(platform: str, model: str, priority: int,
+                       send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+    if concurrency_limits is None:
+        return await send()
+    return await concurrency_limits.send(platform, model, priority, send)
+
+
+def concurrency_stats() -> Dict:
+    return concurrency_limits.stats() if concurrency_limits else {"enabled": False}
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+''' Environment-variable helpers for proxy settings. '''
+import os
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    return float(value) if value else default
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+''' Gemini context caching for long, stable prompt prefixes
+
+Opt-in (LLMPROXY_GEMINI_CONTEXT_CACHE=1). When the part of a request before
+its last turn (system instruction, tools and earlier turns) is large, it is
+uploaded once to Gemini's cachedContents API, and later requests sharing
+that prefix send only the turns after it plus a `cachedContent` reference.
+Gemini bills cached tokens at a reduced rate and skips their prefill.
+
+Prefixes are identified by a hash of the model, API key, system
+instruction, tool config and turns, and the cache names Gemini returns are
+kept in a local registry until shortly before their TTL runs out. Uploads run
+in the background, so the request that triggers one is sent uncached and
+does not wait; a new upload only happens once the turns not covered by an
+existing cache are large enough on their own. A request whose cache Gemini
+no longer knows is resent without it.
+
+Caches belong to the Google project of the API key that created them, so
+this only applies to requests with a single key, not to key pools.
+
+- LLMPROXY_GEMINI_CONTEXT_CACHE: set to 1 to enable
+- LLMPROXY_GEMINI_CONTEXT_CACHE_TTL: lifetime of uploaded caches in seconds (default 3600)
+- LLMPROXY_GEMINI_CONTEXT_CACHE_MIN_TOKENS: smallest prefix worth caching,
+  estimated locally (default 4096, Gemini's minimum for most models)
+- LLMPROXY_GEMINI_CONTEXT_CACHE_ENTRIES: registry size, LRU eviction (default 1000)
+'''
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from loguru import logger
+from . import codec
+from .config import env_bool, env_float, env_int
+from .tokens import TOKENS_PER_IMAGE, TOKENS_PER_MESSAGE, estimate_tokens
+
+# Payload fields that become part of the cached content.
+CACHED_FIELDS = ("systemInstruction", "tools", "toolConfig")
+# Stop using an entry this long before Gemini expires it.
+EXPIRY_MARGIN = 60
+# After a failed upload, do not retry the same prefix for this long.
+FAILURE_BACKOFF = 600
+
+# (cachedContents body) -> cache name, or None if the upload failed
+Uploader = Callable[[Dict], Awaitable[Optional[str]]]
+
+
+@dataclass
+class CacheEntry:
+    name: Optional[str]  # None marks a failed upload
+    expires: float
+    tokens: int
+
+
+def content_tokens(content: Dict) -> int:
+    """Approximate tokens of one Gemini content (or systemInstruction)."""
+    total = TOKENS_PER_MESSAGE
+    for part in content.get("parts", []):
+        if "text" in part:
+            total += estimate_tokens(part["text"])
+        elif "inline_data" in part:
+            total += TOKENS_PER_IMAGE
+        else:
+            total += estimate_tokens(codec.dumps(part).decode())
+    return total
+
+
+class ContextCache:
+    def __init__(self, ttl: float = 3600, min_tokens: int = 4096, max_entries: int = 1000):
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._uploading: Set[str] = set()
+        self._tasks: Set[asyncio.Future] = set()
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
+        self.upload_failures = 0
+        self.invalidations = 0
+        self.cached_tokens = 0
+
+    def _prefix_keys(self, model: str, api_key: str, payload: Dict) -> List[str]:
+        """Key of `contents[:k]` (with the cached fields) for every k from 1 to len(contents) - 1."""
+        digest = hashlib.sha256(codec.dumps([model, api_key] + [payload.get(f) for f in CACHED_FIELDS]))
+        keys = []
+        for content in payload["contents"][:-1]:
+            digest.update(codec.dumps(content))
+            keys.append(digest.copy().hexdigest())
+        return keys
+
+    def _lookup(self, key: str, now: float) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is not None and now >= entry.expires:
+            del self._entries[key]
+            return None
+        return entry
+
+    def prepare(self, model: str, api_key: str, payload: Dict,
+                upload: Uploader) -> Tuple[Dict, Optional[str]]:
+        """Return (payload to send, key of the cache entry it uses).
+
+        The payload references the longest cached prefix, if any. If enough
+        uncached turns precede the last one, an upload of everything before
+        the last turn is started in the background for later requests.
+        """
+        contents = payload["contents"]
+        keys = self._prefix_keys(model, api_key, payload)
+        now = time.monotonic()
+        used = None
+        for k in range(len(keys), 0, -1):
+            entry = self._lookup(keys[k - 1], now)
+            if entry is not None and entry.name is not None:
+                used = k
+                break
+
+        prefix = content_tokens(payload["systemInstruction"]) if payload.get("systemInstruction") else 0
+        if payload.get("tools"):
+            prefix += estimate_tokens(codec.dumps(payload["tools"]).decode())
+        uncovered = sum(content_tokens(c) for c in contents[used or 0:len(keys)])
+        if used is None:
+            uncovered += prefix
+        if keys and uncovered >= self.min_tokens and self._lookup(keys[-1], now) is None:
+            tokens = prefix + sum(content_tokens(c) for c in contents[:len(keys)])
+            self._start_upload(keys[-1], model, payload, len(keys), tokens, upload)
+
+        if used is None:
+            self.misses += 1
+            return payload, None
+        self.hits += 1
+        key = keys[used - 1]
+        entry = self._entries[key]
+        self._entries.move_to_end(key)
+        self.cached_tokens += entry.tokens
+        sent = {k: v for k, v in payload.items() if k not in CACHED_FIELDS}
+        sent.update(cachedContent=entry.name, contents=contents[used:])
+        return sent, key
+
+    def _start_upload(self, key: str, model: str, payload: Dict, turns: int, tokens: int, upload: Uploader):
+        if key in self._uploading:
+            return
+        body = {"model": f"models/{model}", "contents": payload["contents"][:turns], "ttl": f"{int(self.ttl)}s"}
+        body.update((f, payload[f]) for f in CACHED_FIELDS if payload.get(f))
+        self._uploading.add(key)
+        task = asyncio.ensure_future(self._upload(key, body, tokens, upload))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _upload(self, key: str, body: Dict, tokens: int, upload: Uploader):
+        try:
+            name = await upload(body)
+        except Exception as e:
+            logger.warning(f"Gemini context cache upload failed: {e!r}")
+            name = None
+        finally:
+            self._uploading.discard(key)
+        now = time.monotonic()
+        if name is None:
+            self.upload_failures += 1
+            self._store(key, CacheEntry(None, now + FAILURE_BACKOFF, tokens))
+        else:
+            self.uploads += 1
+            self._store(key, CacheEntry(name, now + max(self.ttl - EXPIRY_MARGIN, 0), tokens))
+
+    def _store(self, key: str, entry: CacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            # Evicted caches are left to expire on Gemini's side.
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: str):
+        """Forget an entry Gemini rejected, e.g. because the cache was deleted or expired early."""
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": True,
+            "entries": sum(1 for entry in self._entries.values() if entry.name is not None),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "min_tokens": self.min_tokens,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "uploads": self.uploads,
+            "uploads_in_progress": len(self._uploading),
+            "upload_failures": self.upload_failures,
+            "invalidations": self.invalidations,
+            "estimated_cached_tokens": self.cached_tokens,
+        }
+
+
+def _create_cache() -> Optional[ContextCache]:
+    if not env_bool("LLMPROXY_GEMINI_CONTEXT_CACHE"):
+        return None
+    return ContextCache(ttl=env_float("LLMPROXY_GEMINI_CONTEXT_CACHE_TTL", 3600),
+                        min_tokens=env_int("LLMPROXY_GEMINI_CONTEXT_CACHE_MIN_TOKENS", 4096),
+                        max_entries=env_int("LLMPROXY_GEMINI_CONTEXT_CACHE_ENTRIES", 1000))
+
+
+context_cache: Optional[ContextCache] = _create_cache()
+
+
+def context_cache_stats() -> Dict:
+    return context_cache.stats() if context_cache else {"enabled": False}
@@ -5,22 +5,63 @@ Gemini API docs:
 - https://ai.google.dev/gemini-api/docs/text-generation?lang=rest
 '''
 from loguru import logger
-from pydantic import BaseModel
-from fastapi import APIRouter, HTTPException, Header, Query
-from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from fastapi import APIRouter, HTTPException, Header, Query, Request
+from fastapi.responses import Response
+from starlette.background import BackgroundTask
 import httpx
 import typing
 from typing import List, Dict, Optional
-from .base import Message, ContentPart, ImageUrl
+from .base import (Message, ContentPart, ImageUrl, iter_sse_data, payload_kwargs, wants_usage, relay_stream,
+                   StreamRelayResponse)
+from . import codec
+from .codec import ChunkTemplate
+from .clients import get_client
+from .upstream import RETRY_STATUSES, get_pool
+from .keypool import KeyPool, KeyState, get_key_pool
+from .response_cache import CACHE_HEADER, cached_response, response_cache
+from .semantic_cache import semantic_cache, semantic_response
+from .singleflight import coalesce_key, singleflight
+from .metrics import RequestTracker, failure_status
+from .admission import admit, estimate_request_tokens
+from .batch import NDJSON, BatchItemError, parse_batch_body, run_batch
+from .config import env_float, env_int
+from .context_cache import context_cache
+from .concurrency import PRIORITY_LOW, PRIORITY_NORMAL, limited_send, request_priority
+from .gemini_tools import (convert_tool_choice, convert_tools, function_call_part, function_response_part,
+                           openai_tool_call, tool_call_deltas)
+from .image_cache import image_cache
+from .shaping import shape_stream
+from .tokens import estimate_message_tokens, estimate_tokens
+import asyncio
+import base64
+import math
 import time
-import json
-import re
 
 router = APIRouter()
 
 
-GEMINI_ENDPOINT = "https://generativelanguage.googleapis.com/v1beta/models/{}:generateContent"
-GEMINI_STREAM_ENDPOINT = "https://generativelanguage.googleapis.com/v1beta/models/{}:streamGenerateContent"
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+# Formatted with (api base, model)
+GEMINI_ENDPOINT = "{}/models/{}:generateContent"
+GEMINI_STREAM_ENDPOINT = "{}/models/{}:streamGenerateContent?alt=sse"
+GEMINI_CACHE_ENDPOINT = "{}/cachedContents"
+# How Gemini's errors name a missing or expired cache, lowercased.
+CACHE_ERROR_MARKERS = (b"cachedcontent", b"cached content", b"cache content")
+
+# Roles sent as Gemini's systemInstruction rather than as turns.
+SYSTEM_ROLES = ("system", "developer")
+
+# Gemini finishReason -> OpenAI finish_reason
+FINISH_REASONS: Dict[str, str] = {
+    "STOP": "stop",
+    "MAX_TOKENS": "length",
+    "SAFETY": "content_filter",
+    "RECITATION": "content_filter",
+    "BLOCKLIST": "content_filter",
+    "PROHIBITED_CONTENT": "content_filter",
+    "SPII": "content_filter",
+}
 
 
 class OpenAIProxyArgs(BaseModel):
@@ -33,172 +74,482 @@ class OpenAIProxyArgs(BaseModel):
     max_tokens: Optional[int] = None
     presence_penalty: float = 0
     frequency_penalty: float = 0
+    stream_options: Optional[Dict] = None
+    tools: Optional[List[Dict]] = None
+    tool_choice: Optional[typing.Union[str, Dict]] = None
+
+
+# Limits for fetching remote `image_url` parts during conversion.
+IMAGE_FETCH_CONCURRENCY = env_int("LLMPROXY_IMAGE_CONCURRENCY", 8)
+IMAGE_FETCH_TIMEOUT = env_float("LLMPROXY_IMAGE_TIMEOUT", 10)
+# Gemini rejects requests with more than 20MB of inline data.
+IMAGE_MAX_TOTAL_BYTES = env_int("LLMPROXY_IMAGE_MAX_BYTES", 20 * 1024 * 1024)
+
+
+class ImageBudgetExceeded(Exception):
+    pass
+
+
+class GeminiHTTPError(Exception):
+    """A non-200 answer from Gemini, relayed to the client as-is."""
+
+    def __init__(self, response: httpx.Response):
+        super().__init__(f"Gemini returned {response.status_code}")
+        self.status_code = response.status_code
+        self.content = response.content
+
+
+def message_text(message: Message) -> str:
+    """The text of a message, with list content joined."""
+    if isinstance(message.content, list):
+        return "".join(part.text or "" for part in message.content if part.type == "text")
+    return message.content or ""
+
+
+def system_instruction(messages: List[Message]) -> Optional[Dict]:
+    """Gemini `systemInstruction` holding the text of all system messages, or None if there are none."""
+    texts = [message_text(message) for message in messages if message.role in SYSTEM_ROLES]
+    if not any(texts):
+        return None
+    return {"parts": [{"text": "\n\n".join(text for text in texts if text)}]}
+
+
+def guess_image_mime_type(content_type: Optional[str], url: str) -> str:
+    """Use the response content-type if it is an image, else guess from the URL extension."""
+    content_type = (content_type or "image/jpeg").split(";")[0].strip()
+    if content_type.startswith("image/"):
+        return content_type
+    lower_url = url.lower()
+    if lower_url.endswith(".png"):
+        return "image/png"
+    elif lower_url.endswith(".webp"):
+        return "image/webp"
+    elif lower_url.endswith(".gif"):
+        return "image/gif"
+    return "image/jpeg"
+
+
+def inline_data_from_data_url(data_url: str) -> Dict:
+    """Convert a `data:<mime>;base64,<data>` URL into a Gemini inline_data part."""
+    mime_type, base64_data = data_url.split(",", 1)
+    mime_type = mime_type.split(":")[1].split(";")[0]
+    return {
+        "inline_data": {
+            "mime_type": mime_type,
+            "data": base64_data
+        }
+    }
 
 
 class MessageConverter:
-    def __init__(self, messages: List[Message]):
+    def __init__(self,
+                 messages: List[Message],
+                 max_concurrency: int = IMAGE_FETCH_CONCURRENCY,
+                 image_timeout: float = IMAGE_FETCH_TIMEOUT,
+                 max_total_bytes: int = IMAGE_MAX_TOTAL_BYTES):
         self.messages = messages
+        self.max_concurrency = max_concurrency
+        self.image_timeout = image_timeout
+        self.max_total_bytes = max_total_bytes
 
-    def convert(self) -> List[Dict]:
+    def _convert(self, remote_image: typing.Callable[[str], Dict]) -> List[Dict]:
         converted_messages = []
+        # tool call id -> function name, for the tool messages answering them
+        call_names: Dict[str, str] = {}
         for message in self.messages:
+            if message.role in SYSTEM_ROLES:
+                continue
+            if message.role == "tool":
+                part = function_response_part(call_names.get(message.tool_call_id) or message.name or "",
+                                              message_text(message))
+                previous = converted_messages[-1] if converted_messages else None
+                # Answers to parallel calls go together in one turn, as Gemini expects.
+                if previous and previous["parts"] and all("functionResponse" in p for p in previous["parts"]):
+                    previous["parts"].append(part)
+                else:
+                    converted_messages.append({"role": "user", "parts": [part]})
+                continue
+
             role = "user" if message.role == "user" else "model"
             parts = []
-            
+
             # Handle both string content and multimodal content
             if isinstance(message.content, str):
-                parts.append({"text": message.content})
+                if message.content or not message.tool_calls:
+                    parts.append({"text": message.content})
+            elif message.content is None:
+                if not message.tool_calls:
+                    parts.append({"text": ""})
             elif isinstance(message.content, list):
                 for part in message.content:
                     if part.type == "text":
                         parts.append({"text": part.text})
                     elif part.type == "image_url":
-                        # Convert image URL to Gemini format
                         image_url = part.image_url.url
                         if image_url.startswith("data:"):
-                            # Handle base64 encoded images
-                            mime_type, base64_data = image_url.split(",", 1)
-                            mime_type = mime_type.split(":")[1].split(";")[0]
-                            parts.append({
-                                "inline_data": {
-                                    "mime_type": mime_type,
-                                    "data": base64_data
-                                }
-                            })
+                            parts.append(inline_data_from_data_url(image_url))
                         else:
-                            # Handle image URLs - fetch and convert to base64
-                            try:
-                                import httpx
-                                import base64
-                                # Fetch the image
-                                with httpx.Client() as client:
-                                    img_response = client.get(image_url)
-                                    if img_response.status_code == 200:
-                                        # Determine MIME type from content-type header or URL extension
-                                        content_type = img_response.headers.get('content-type', 'image/jpeg')
-                                        if not content_type.startswith('image/'):
-                                            # Fallback based on URL extension
-                                            if image_url.lower().endswith('.png'):
-                                                content_type = 'image/png'
-                                            elif image_url.lower().endswith('.webp'):
-                                                content_type = 'image/webp'
-                                            elif image_url.lower().endswith('.gif'):
-                                                content_type = 'image/gif'
-                                            else:
-                                                content_type = 'image/jpeg'
-                                        
-                                        # Convert to base64
-                                        base64_data = base64.b64encode(img_response.content).decode('utf-8')
-                                        parts.append({
-                                            "inline_data": {
-                                                "mime_type": content_type,
-                                                "data": base64_data
-                                            }
-                                        })
-                                    else:
-                                        logger.error(f"Failed to fetch image from URL: {image_url}, status: {img_response.status_code}")
-                                        # Add error message as text
-                                        parts.append({"text": f"[Error: Could not fetch image from {image_url}]"})
-                            except Exception as e:
-                                logger.error(f"Error processing image URL {image_url}: {e}")
-                                # Add error message as text
-                                parts.append({"text": f"[Error: Could not process image from {image_url}]"})
-            
+                            parts.append(remote_image(image_url))
+            for call in message.tool_calls or ():
+                call_names[call.id] = call.function.name
+                parts.append(function_call_part(call.function.name, call.function.arguments))
+
             converted_messages.append({
                 "role": role,
                 "parts": parts
             })
         return converted_messages
 
+    def convert(self) -> List[Dict]:
+        """Synchronous conversion, fetching remote images one after another.
+
+        Blocks the calling thread; async routes should use `aconvert` instead.
+        """
+        def fetch(image_url: str) -> Dict:
+            try:
+                with httpx.Client(timeout=self.image_timeout) as client:
+                    img_response = client.get(image_url)
+                if img_response.status_code != 200:
+                    logger.error(f"Failed to fetch image from URL: {image_url}, status: {img_response.status_code}")
+                    return {"text": f"[Error: Could not fetch image from {image_url}]"}
+                return {
+                    "inline_data": {
+                        "mime_type": guess_image_mime_type(img_response.headers.get("content-type"), image_url),
+                        "data": base64.b64encode(img_response.content).decode("utf-8")
+                    }
+                }
+            except Exception as e:
+                logger.error(f"Error processing image URL {image_url}: {e}")
+                return {"text": f"[Error: Could not process image from {image_url}]"}
+
+        return self._convert(fetch)
+
+    async def aconvert(self) -> List[Dict]:
+        """Convert messages, fetching all remote images across all messages concurrently.
+
+        Fetches are capped at `max_concurrency` in flight, each one is bounded
+        by `image_timeout` seconds, and all of them share a budget of
+        `max_total_bytes` downloaded bytes. Part order is preserved; failed
+        images become `[Error: ...]` text parts as in `convert`. Images are
+        served from `image_cache` when fresh, or revalidated with a
+        conditional GET when stale.
+        """
+        pending: List[typing.Tuple[Dict, str]] = []
+
+        def placeholder(image_url: str) -> Dict:
+            part: Dict = {}
+            pending.append((part, image_url))
+            return part
+
+        converted_messages = self._convert(placeholder)
+        if not pending:
+            return converted_messages
+
+        client = get_client("images")
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        budget = {"remaining": self.max_total_bytes}
+
+        async def download(image_url: str, headers: Dict[str, str]) -> typing.Tuple[httpx.Response, bytes]:
+            async with client.stream("GET", image_url, headers=headers, timeout=self.image_timeout) as img_response:
+                if img_response.status_code == 304:
+                    return img_response, b""
+                if img_response.status_code != 200:
+                    raise httpx.HTTPStatusError(
+                        f"status: {img_response.status_code}",
+                        request=img_response.request, response=img_response)
+                chunks = []
+                async for chunk in img_response.aiter_bytes():
+                    budget["remaining"] -= len(chunk)
+                    if budget["remaining"] < 0:
+                        raise ImageBudgetExceeded(
+                            f"total image size exceeds {self.max_total_bytes} bytes")
+                    chunks.append(chunk)
+                return img_response, b"".join(chunks)
+
+        async def fetch(part: Dict, image_url: str):
+            entry, cached = image_cache.lookup(image_url)
+            if entry is not None and entry.is_fresh():
+                image_cache.record_hit(entry)
+                part["inline_data"] = {"mime_type": cached[0], "data": cached[1]}
+                return
+            try:
+                started = time.monotonic()
+                async with semaphore:
+                    img_response, content = await asyncio.wait_for(
+                        download(image_url, entry.validators() if entry else {}),
+                        self.image_timeout)
+                if img_response.status_code == 304 and cached is not None:
+                    image_cache.refresh(image_url, img_response.headers)
+                    image_cache.record_hit(entry, revalidated=True)
+                    part["inline_data"] = {"mime_type": cached[0], "data": cached[1]}
+                    return
+                image_cache.record_miss(time.monotonic() - started)
+                mime_type = guess_image_mime_type(img_response.headers.get("content-type"), image_url)
+                data = base64.b64encode(content).decode("utf-8")
+                image_cache.store(image_url, mime_type, data, len(content), img_response.headers)
+                part["inline_data"] = {"mime_type": mime_type, "data": data}
+            except httpx.HTTPStatusError as e:
+                logger.error(f"Failed to fetch image from URL: {image_url}, {e}")
+                part["text"] = f"[Error: Could not fetch image from {image_url}]"
+            except Exception as e:
+                logger.error(f"Error processing image URL {image_url}: {e!r}")
+                part["text"] = f"[Error: Could not process image from {image_url}]"
+
+        await asyncio.gather(*(fetch(part, url) for part, url in pending))
+        return converted_messages
+
+
+def map_finish_reason(reason: Optional[str]) -> Optional[str]:
+    if not reason or reason == "FINISH_REASON_UNSPECIFIED":
+        return None
+    return FINISH_REASONS.get(reason, "stop")
+
+
+def convert_gemini_usage(usage_metadata: Dict) -> Dict:
+    """Map Gemini `usageMetadata` to an OpenAI `usage` object."""
+    prompt_tokens = usage_metadata.get("promptTokenCount", 0)
+    completion_tokens = usage_metadata.get("candidatesTokenCount", 0)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": usage_metadata.get("totalTokenCount", prompt_tokens + completion_tokens)
+    }
+
+
+def estimate_usage_metadata(messages: Optional[List[Message]], completion_tokens: int) -> Dict:
+    """A locally estimated `usageMetadata`, for responses where Gemini left it out."""
+    prompt_tokens = estimate_message_tokens(messages) if messages else 0
+    return {
+        "promptTokenCount": prompt_tokens,
+        "candidatesTokenCount": completion_tokens,
+        "totalTokenCount": prompt_tokens + completion_tokens
+    }
+
+
+def candidate_text(candidate: dict) -> str:
+    """All text parts of a Gemini candidate, joined."""
+    return "".join(part.get("text", "") for part in candidate.get("content", {}).get("parts", []))
+
+
+def candidate_choice(candidate: dict, index: int) -> Dict:
+    """An OpenAI choice for a Gemini candidate, with its functionCall parts as `tool_calls`."""
+    message: Dict = {"role": "assistant", "content": candidate_text(candidate)}
+    tool_calls = [openai_tool_call(part["functionCall"])
+                  for part in candidate.get("content", {}).get("parts", []) if "functionCall" in part]
+    finish_reason = map_finish_reason(candidate.get("finishReason")) or "stop"
+    if tool_calls:
+        message["content"] = message["content"] or None
+        message["tool_calls"] = tool_calls
+        if finish_reason == "stop":
+            finish_reason = "tool_calls"
+    return {"message": message, "finish_reason": finish_reason, "index": candidate.get("index", index)}
+
 
 def convert_gemini_to_openai_response(gemini_response: dict, model: str) -> dict:
-    """Convert Gemini API response to OpenAI-compatible format."""
+    """Convert Gemini API response to OpenAI-compatible format.
+
+    Every candidate becomes a choice (Gemini's `candidateCount` is OpenAI's
+    `n`). A prompt blocked before any candidate was generated yields a single
+    empty choice with finish_reason "content_filter".
+    """
+    choices = [candidate_choice(candidate, i) for i, candidate in enumerate(gemini_response.get("candidates", []))]
+    if not choices and gemini_response.get("promptFeedback", {}).get("blockReason"):
+        choices.append({"message": {"role": "assistant", "content": ""},
+                        "finish_reason": "content_filter", "index": 0})
+    created = int(time.time())
     return {
-        "id": gemini_response.get("candidates", [{}])[0].get("content", {}).get("role", ""),
+        "id": f"chatcmpl-{created}",
         "object": "chat.completion",
-        "created": int(time.time()),
+        "created": created,
         "model": model,
-        "usage": {
-            "prompt_tokens": 0,  # Gemini doesn't provide token counts
-            "completion_tokens": 0,
-            "total_tokens": 0
-        },
-        "choices": [{
-            "message": {
-                "role": "assistant",
-                "content": gemini_response.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
-            },
-            "finish_reason": "stop",
-            "index": 0
-        }]
+        "usage": convert_gemini_usage(gemini_response.get("usageMetadata", {})),
+        "choices": choices
     }
 
 
-async def stream_gemini_response(model: str, payload: dict, api_key: str):
-    text_pattern = re.compile(r'"text": "(.*?)"')
+async def stream_gemini_response(response: httpx.Response, model: str,
+                                 on_usage: Optional[typing.Callable[[Dict], None]] = None,
+                                 include_usage: bool = False,
+                                 messages: Optional[List[Message]] = None):
+    """Stream Gemini SSE events (`alt=sse`) as OpenAI chat.completion.chunk events.
 
-    async with httpx.AsyncClient() as client:
-        async with client.stream(
-            "POST",
-            GEMINI_STREAM_ENDPOINT.format(model),
-            json=payload,
-            headers={
-                "Content-Type": "application/json",
-                "x-goog-api-key": api_key
-            }
-        ) as response:
-            async for line in response.aiter_lines():
-                line = line.strip()
-                match = text_pattern.search(line)
-                if match:
-                    text_content = match.group(1)
-                    text_content = json.loads(f'"{text_content}"')
-
-                    openai_format = {
-                        "id": f"chatcmpl-{int(time.time())}",
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": model,
-                        "choices": [{
-                            "index": 0,
-                            "delta": {
-                                "content": text_content
-                            },
-                            "finish_reason": None
-                        }]
-                    }
+    Each SSE event is a complete GenerateContentResponse, so it is decoded
+    once and every text part of every candidate becomes one chunk. A
+    functionCall part becomes `tool_calls` deltas as soon as it arrives.
+    Each candidate index gets its own final chunk carrying its mapped
+    `finishReason` ("tool_calls" if it called a tool). The last `usageMetadata`
+    (estimated from `messages` and the streamed text if Gemini sent none) is
+    passed to `on_usage` and, with `include_usage`, sent as a final chunk
+    without choices. `response` has been sent with `stream=True` and is
+    closed when done.
+    """
+    created = int(time.time())
+    template = ChunkTemplate(f"chatcmpl-{created}", model, created)
+    # candidate index -> OpenAI finish_reason
+    finish_reasons: Dict[int, Optional[str]] = {}
+    # candidate index -> tool calls streamed so far
+    tool_calls: Dict[int, int] = {}
+    usage_metadata = None
+    # Only counted for events without usageMetadata, which Gemini normally sends on each event.
+    estimated_tokens = 0
 
-                    yield f"data: {json.dumps(openai_format, ensure_ascii=False)}\n\n"
+    try:
+        async for data in iter_sse_data(response):
+            event = codec.loads(data)
+            has_usage = "usageMetadata" in event
+            for candidate in event.get("candidates", []):
+                index = candidate.get("index", 0)
+                finish_reasons.setdefault(index, None)
+                for part in candidate.get("content", {}).get("parts", []):
+                    text_content = part.get("text")
+                    if text_content:
+                        if not has_usage:
+                            estimated_tokens += estimate_tokens(text_content)
+                        yield template.content(text_content, index)
+                    elif "functionCall" in part:
+                        position = tool_calls.get(index, 0)
+                        tool_calls[index] = position + 1
+                        if not has_usage:
+                            arguments = codec.dumps(part["functionCall"].get("args") or {}).decode()
+                            estimated_tokens += estimate_tokens(arguments)
+                        for delta in tool_call_deltas(part["functionCall"], position):
+                            yield template.event([{"index": index, "delta": delta, "finish_reason": None}])
+                if candidate.get("finishReason"):
+                    finish_reasons[index] = map_finish_reason(candidate["finishReason"])
+            if has_usage:
+                usage_metadata = event["usageMetadata"]
+    finally:
+        await response.aclose()
 
-    final_chunk = {
-        "id": f"chatcmpl-{int(time.time())}",
-        "object": "chat.completion.chunk",
-        "created": int(time.time()),
-        "model": model,
-        "choices": [{
-            "index": 0,
-            "delta": {},
-            "finish_reason": "stop"
-        }]
+    if usage_metadata is None:
+        usage_metadata = estimate_usage_metadata(messages, estimated_tokens)
+    if on_usage:
+        on_usage(usage_metadata)
+    for index in sorted(finish_reasons) or [0]:
+        finish_reason = finish_reasons.get(index) or "stop"
+        if tool_calls.get(index) and finish_reason == "stop":
+            finish_reason = "tool_calls"
+        yield template.finish(finish_reason, index)
+    if include_usage:
+        yield template.event([], usage=convert_gemini_usage(usage_metadata))
+    yield codec.DONE
+
+
+async def send_gemini_request(model: str, payload: Dict, api_key: str, stream: bool,
+                              retry_statuses: typing.Collection[int] = RETRY_STATUSES) -> httpx.Response:
+    """POST `payload` to (stream)generateContent through the Gemini upstream pool.
+
+    Returns the response with its body unread; the caller must consume or close it.
+    """
+    client = get_client("gemini")
+    endpoint = GEMINI_STREAM_ENDPOINT if stream else GEMINI_ENDPOINT
+    headers = {
+        "Content-Type": "application/json",
+        "x-goog-api-key": api_key
+    }
+    content = payload_kwargs(payload)["content"]
+    return await get_pool("gemini", GEMINI_API_BASE).send(
+        client, lambda base_url: client.build_request(
+            "POST", endpoint.format(base_url, model), headers=headers, content=content),
+        retry_statuses)
+
+
+async def create_cached_content(api_key: str, body: Dict) -> Optional[str]:
+    """Upload a cachedContents resource; returns its name, or None if Gemini refused it."""
+    client = get_client("gemini")
+    headers = {
+        "Content-Type": "application/json",
+        "x-goog-api-key": api_key
     }
-    yield f"data: {json.dumps(final_chunk, ensure_ascii=False)}\n\n"
-    yield "data: [DONE]\n\n"
+    content = payload_kwargs(body)["content"]
+    response = await get_pool("gemini", GEMINI_API_BASE).send(
+        client, lambda base_url: client.build_request(
+            "POST", GEMINI_CACHE_ENDPOINT.format(base_url), headers=headers, content=content))
+    await response.aread()
+    await response.aclose()
+    if response.status_code != 200:
+        logger.warning(f"Gemini context cache upload returned {response.status_code}: {response.text[:200]}")
+        return None
+    return codec.loads(response.content).get("name")
+
+
+def cache_rejected(response: httpx.Response) -> bool:
+    """Whether Gemini refused a request because of its cachedContent reference.
+
+    A 403 or 404 alone is not enough: a revoked key or an unknown model fails
+    the same way and must reach the client rather than be retried uncached.
+    """
+    if response.status_code not in (400, 403, 404):
+        return False
+    body = response.content.lower()
+    return any(marker in body for marker in CACHE_ERROR_MARKERS)
+
+
+async def send_with_context_cache(model: str, payload: Dict, api_key: str, stream: bool) -> httpx.Response:
+    """Send `payload`, referencing a cached prefix of it when context caching has one."""
+    if context_cache is None:
+        return await send_gemini_request(model, payload, api_key, stream)
+    sent, key = context_cache.prepare(model, api_key, payload, lambda body: create_cached_content(api_key, body))
+    response = await send_gemini_request(model, sent, api_key, stream)
+    if key is None or response.status_code == 200:
+        return response
+    await response.aread()
+    await response.aclose()
+    if not cache_rejected(response):
+        return response
+    context_cache.invalidate(key)
+    return await send_gemini_request(model, payload, api_key, stream)
+
+
+async def send_with_key_pool(key_pool: KeyPool, model: str, payload: Dict,
+                             stream: bool) -> typing.Tuple[httpx.Response, KeyState]:
+    """Send through the key with the most headroom, moving on to another key after a 429."""
+    tried: List[str] = []
+    while len(tried) < len(key_pool):
+        state = key_pool.select(tuple(tried))
+        if state is None:
+            break
+        # 429s are handled here by switching keys rather than by the upstream pool.
+        response = await send_gemini_request(
+            model, payload, state.key, stream, retry_statuses=RETRY_STATUSES - {429})
+        if response.status_code != 429:
+            return response, state
+        await response.aread()
+        await response.aclose()
+        key_pool.rate_limited(state, response)
+        tried.append(state.key)
+    raise HTTPException(status_code=429, detail="All Gemini API keys are rate limited",
+                        headers={"Retry-After": str(math.ceil(key_pool.retry_after()))})
 
 
 @router.post("/chat/completions")
 async def proxy_chat_completions(
     args: OpenAIProxyArgs,
+    request: Request,
     authorization: str = Header(...),
 ):
-    api_key = authorization.split(" ")[1]
-    model = args.model
+    tracker = RequestTracker("gemini", args.model, int(request.headers.get("content-length") or 0),
+                             estimate_request_tokens(0, args.max_tokens))
+    try:
+        response = await forward_chat_completions(args, request, authorization, tracker)
+    except HTTPException as e:
+        tracker.finish(e.status_code)
+        raise
+    except BaseException as e:
+        tracker.finish(failure_status(e))
+        raise
+    return tracker.observe_response(response)
 
-    if not api_key:
-        raise HTTPException(status_code=400, detail="API key not provided")
 
-    # Transform args into Gemini API format
+async def build_gemini_payload(args: OpenAIProxyArgs) -> Dict:
+    """Transform OpenAI-style args into a Gemini generateContent request."""
+    contents = await MessageConverter(args.messages).aconvert()
+    system = system_instruction(args.messages)
+    if system is not None and not contents:
+        # Gemini needs at least one turn, so a system-only prompt is sent as the user's.
+        contents, system = [dict(system, role="user")], None
     gemini_payload = {
-        "contents": MessageConverter(args.messages).convert(),
+        "contents": contents,
         "safetySettings": [
             {
                 "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
@@ -212,27 +563,158 @@ async def proxy_chat_completions(
             "topK": 10
         }
     }
+    if system is not None:
+        gemini_payload["systemInstruction"] = system
+    if args.n > 1:
+        gemini_payload["generationConfig"]["candidateCount"] = args.n
+    if args.tools:
+        gemini_payload["tools"] = convert_tools(args.tools)
+    tool_config = convert_tool_choice(args.tool_choice)
+    if tool_config is not None:
+        gemini_payload["toolConfig"] = tool_config
+    return gemini_payload
 
-    if args.stream:
-        return StreamingResponse(stream_gemini_response(model, gemini_payload, api_key), media_type="text/event-stream")
-    else:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                GEMINI_ENDPOINT.format(model),
-                json=gemini_payload,
-                headers={
-                    "Content-Type": "application/json",
-                    "x-goog-api-key": api_key
-                }
-            )
 
-            if response.status_code != 200:
-                return JSONResponse(content=response.json(), status_code=response.status_code)
+UsageCallback = Optional[typing.Callable[[Dict], None]]
+
 
-            response_json = response.json()
+async def send_chat_request(args: OpenAIProxyArgs, api_key: str, gemini_payload: Dict,
+                            on_headers: Optional[typing.Callable[[], None]] = None,
+                            priority: int = PRIORITY_NORMAL) -> typing.Tuple[httpx.Response, UsageCallback]:
+    """Send through the caller's key pool (or with `api_key` itself).
 
-            # Use the new conversion function
-            openai_compatible_response = convert_gemini_to_openai_response(
-                response_json, args.model)
+    Returns the response, read unless streaming, and a callback recording
+    token usage against the key that was used. Raises GeminiHTTPError for
+    non-200 answers, and a 429 HTTPException when admission control or the
+    concurrency limit turns the request away.
+    """
+    await admit("gemini", api_key, args.model,
+                estimate_request_tokens(estimate_message_tokens(args.messages), args.max_tokens))
+    key_pool = get_key_pool(api_key)
+    key_state: Optional[KeyState] = None
 
-            return JSONResponse(openai_compatible_response)
+    async def send() -> httpx.Response:
+        nonlocal key_state
+        if key_pool is None:
+            return await send_with_context_cache(args.model, gemini_payload, api_key, args.stream)
+        response, key_state = await send_with_key_pool(key_pool, args.model, gemini_payload, args.stream)
+        return response
+
+    response = await limited_send("gemini", args.model, priority, send)
+    record_usage = None
+    if key_state is not None:
+        def record_usage(usage_metadata: Dict):
+            key_state.record_tokens(usage_metadata.get("totalTokenCount", 0))
+
+    if on_headers:
+        on_headers()
+    if response.status_code != 200 or not args.stream:
+        await response.aread()
+        await response.aclose()
+    if response.status_code != 200:
+        raise GeminiHTTPError(response)
+    return response, record_usage
+
+
+def read_completion(args: OpenAIProxyArgs, response: httpx.Response, record_usage: UsageCallback) -> Dict:
+    """Convert a read generateContent response, estimating usage when Gemini left it out."""
+    response_json = codec.loads(response.content)
+    if "usageMetadata" not in response_json:
+        response_json["usageMetadata"] = estimate_usage_metadata(
+            args.messages, sum(estimate_tokens(candidate_text(c)) for c in response_json.get("candidates", [])))
+    if record_usage:
+        record_usage(response_json["usageMetadata"])
+    return convert_gemini_to_openai_response(response_json, args.model)
+
+
+async def forward_chat_completions(args: OpenAIProxyArgs, request: Request, authorization: str,
+                                   tracker: RequestTracker) -> Response:
+    api_key = authorization.split(" ")[1]
+    model = args.model
+
+    if not api_key:
+        raise HTTPException(status_code=400, detail="API key not provided")
+
+    gemini_payload = await build_gemini_payload(args)
+
+    cache_body = dict(args.dict(exclude={"messages"}), contents=gemini_payload["contents"],
+                      systemInstruction=gemini_payload.get("systemInstruction"))
+    include_usage = args.stream and wants_usage(cache_body)
+    cache_policy = None
+    if response_cache is not None:
+        cache_policy = response_cache.policy("gemini", cache_body, request.headers, api_key)
+        if cache_policy is not None:
+            cached = await response_cache.get(cache_policy)
+            if cached is not None:
+                return cached_response(cached, args.stream, include_usage)
+    semantic = None
+    if semantic_cache is not None:
+        semantic = semantic_cache.query("gemini", args.dict(), request.headers, api_key)
+        hit = semantic_cache.get(semantic) if semantic is not None else None
+        if hit is not None:
+            return semantic_response(*hit, args.stream, include_usage)
+    flight_key = coalesce_key("gemini", cache_body, api_key, args.stream)
+
+    async def send() -> typing.Tuple[httpx.Response, UsageCallback]:
+        return await send_chat_request(args, api_key, gemini_payload, tracker.upstream_headers,
+                                       request_priority(request.headers))
+
+    async def open_stream():
+        response, record_usage = await send()
+        return shape_stream(stream_gemini_response(response, model, record_usage, include_usage, args.messages))
+
+    async def complete() -> bytes:
+        response, record_usage = await send()
+        content = codec.dumps(read_completion(args, response, record_usage))
+        if cache_policy is not None:
+            await response_cache.set(cache_policy, content)
+        if semantic is not None:
+            semantic_cache.set(semantic, content)
+        return content
+
+    try:
+        if args.stream and flight_key is not None:
+            return StreamRelayResponse(await singleflight.stream(flight_key, open_stream),
+                                       media_type="text/event-stream")
+        elif args.stream:
+            response, record_usage = await send()
+            return StreamRelayResponse(relay_stream(shape_stream(stream_gemini_response(
+                response, model, record_usage, include_usage, args.messages))),
+                                       media_type="text/event-stream",
+                                       background=BackgroundTask(response.aclose))
+        else:
+            content = await singleflight.call(flight_key, complete) if flight_key else await complete()
+            return Response(content=content, media_type="application/json",
+                            headers={CACHE_HEADER: "MISS"} if cache_policy is not None else None)
+    except GeminiHTTPError as e:
+        # Relay Gemini's own error body and status.
+        return Response(content=e.content, status_code=e.status_code, media_type="application/json")
+
+
+async def complete_chat(api_key: str, item) -> bytes:
+    """Run one non-streaming chat completion for a batch item; returns OpenAI-format JSON.
+
+    Failures are raised as BatchItemError.
+    """
+    try:
+        args = OpenAIProxyArgs.parse_obj(dict(item, stream=False) if isinstance(item, dict) else item)
+    except ValidationError as e:
+        raise BatchItemError(422, str(e))
+    try:
+        response, record_usage = await send_chat_request(args, api_key, await build_gemini_payload(args),
+                                                         priority=PRIORITY_LOW)
+    except GeminiHTTPError as e:
+        raise BatchItemError(e.status_code, e.content.decode(errors="replace"))
+    except HTTPException as e:
+        raise BatchItemError(e.status_code, e.detail)
+    return codec.dumps(read_completion(args, response, record_usage))
+
+
+@router.post("/batch/chat/completions")
+async def proxy_batch_chat_completions(request: Request, authorization: str = Header(...)):
+    """Run many non-streaming chat completions; results are streamed back as NDJSON."""
+    api_key = authorization.split(" ")[1]
+    if not api_key:
+        raise HTTPException(status_code=400, detail="API key not provided")
+    items = parse_batch_body(await request.body())
+    return StreamRelayResponse(run_batch(items, lambda item: complete_chat(api_key, item)), media_type=NDJSON)
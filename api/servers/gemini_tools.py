@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+''' OpenAI tool calling <-> Gemini function calling
+
+Requests: `tools` become `functionDeclarations` (with their JSON schemas cut
+down to the subset Gemini accepts), `tool_choice` becomes
+`toolConfig.functionCallingConfig`, an assistant message's `tool_calls`
+become `functionCall` parts and `role: tool` messages become
+`functionResponse` parts. Gemini matches responses to calls by function
+name, so a tool message's name is looked up from the call it answers.
+
+Responses: `functionCall` parts become `tool_calls`, with finish_reason
+"tool_calls". Gemini has no call ids, so ids are generated unless Gemini
+sends one.
+'''
+import uuid
+from typing import Any, Dict, List, Optional, Union
+from fastapi import HTTPException
+from . import codec
+
+# JSON schema keywords Gemini's OpenAPI-subset `Schema` accepts; others are dropped.
+SCHEMA_FIELDS = frozenset({
+    "type", "format", "description", "nullable", "enum", "items", "properties", "required",
+    "minItems", "maxItems", "minimum", "maximum", "anyOf",
+})
+SCHEMA_FORMATS = frozenset({"enum", "date-time", "int32", "int64", "float", "double"})
+
+TOOL_CHOICE_MODES = {"none": "NONE", "auto": "AUTO", "required": "ANY"}
+
+
+def clean_schema(schema: Any) -> Any:
+    """`schema` with the keywords Gemini rejects (`additionalProperties`, `$schema`, ...) removed.
+
+    A `type` list including "null" becomes the single type plus `nullable`.
+    """
+    if not isinstance(schema, dict):
+        return schema
+    cleaned: Dict[str, Any] = {}
+    for key, value in schema.items():
+        if key not in SCHEMA_FIELDS:
+            continue
+        if key == "properties" and isinstance(value, dict):
+            value = {name: clean_schema(prop) for name, prop in value.items()}
+        elif key == "items":
+            value = clean_schema(value)
+        elif key == "anyOf" and isinstance(value, list):
+            value = [clean_schema(option) for option in value]
+        elif key == "format" and value not in SCHEMA_FORMATS:
+            continue
+        elif key == "type" and isinstance(value, list):
+            types = [t for t in value if t != "null"]
+            if len(types) < len(value):
+                cleaned["nullable"] = True
+            value = types[0] if types else "string"
+        cleaned[key] = value
+    return cleaned
+
+
+def convert_tools(tools: List[Dict]) -> List[Dict]:
+    """OpenAI `tools` as a Gemini `tools` list with one functionDeclarations entry."""
+    declarations = []
+    for tool in tools:
+        function = tool.get("function") if isinstance(tool, dict) else None
+        if tool.get("type", "function") != "function" or not isinstance(function, dict) or not function.get("name"):
+            raise HTTPException(status_code=400, detail="Only function tools with a name are supported")
+        declaration = {"name": function["name"]}
+        if function.get("description"):
+            declaration["description"] = function["description"]
+        parameters = clean_schema(function.get("parameters"))
+        # Gemini rejects object schemas without properties; a function without parameters has none.
+        if isinstance(parameters, dict) and (parameters.get("properties") or parameters.get("type") != "object"):
+            declaration["parameters"] = parameters
+        declarations.append(declaration)
+    return [{"functionDeclarations": declarations}] if declarations else []
+
+
+def convert_tool_choice(tool_choice: Union[str, Dict, None]) -> Optional[Dict]:
+    """OpenAI `tool_choice` as a Gemini `toolConfig`, or None to leave Gemini's default (AUTO)."""
+    if tool_choice is None:
+        return None
+    if isinstance(tool_choice, dict):
+        name = (tool_choice.get("function") or {}).get("name")
+        if not name:
+            raise HTTPException(status_code=400, detail="tool_choice must name a function")
+        return {"functionCallingConfig": {"mode": "ANY", "allowedFunctionNames": [name]}}
+    mode = TOOL_CHOICE_MODES.get(tool_choice)
+    if mode is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported tool_choice: {tool_choice!r}")
+    return {"functionCallingConfig": {"mode": mode}}
+
+
+def _loads_or_raw(text: str) -> Any:
+    try:
+        return codec.loads(text)
+    except ValueError:
+        return text
+
+
+def function_call_part(name: str, arguments: str) -> Dict:
+    """A Gemini functionCall part for an OpenAI tool call (`arguments` is a JSON string)."""
+    args = _loads_or_raw(arguments) if arguments else {}
+    return {"functionCall": {"name": name, "args": args if isinstance(args, dict) else {"value": args}}}
+
+
+def function_response_part(name: str, content: str) -> Dict:
+    """A Gemini functionResponse part for a tool message; Gemini wants an object as the response."""
+    result = _loads_or_raw(content)
+    return {"functionResponse": {"name": name,
+                                 "response": result if isinstance(result, dict) else {"content": result}}}
+
+
+def new_call_id() -> str:
+    return f"call_{uuid.uuid4().hex[:24]}"
+
+
+def openai_tool_call(function_call: Dict) -> Dict:
+    """An OpenAI `tool_calls` entry for a Gemini functionCall."""
+    return {
+        "id": function_call.get("id") or new_call_id(),
+        "type": "function",
+        "function": {"name": function_call.get("name", ""),
+                     "arguments": codec.dumps(function_call.get("args") or {}).decode()},
+    }
+
+
+def tool_call_deltas(function_call: Dict, position: int) -> List[Dict]:
+    """Stream deltas for one functionCall: the call's id and name, then its arguments.
+
+    Gemini sends each call complete in a single part, so it is emitted as
+    soon as that event arrives rather than at the end of the stream.
+    """
+    call = openai_tool_call(function_call)
+    return [
+        {"tool_calls": [{"index": position, "id": call["id"], "type": "function",
+                         "function": {"name": call["function"]["name"], "arguments": ""}}]},
+        {"tool_calls": [{"index": position, "function": {"arguments": call["function"]["arguments"]}}]},
+    ]
@@ -1,9 +1,28 @@
-from fastapi import APIRouter, Header, HTTPException
-from fastapi.responses import JSONResponse, StreamingResponse
-from pydantic import BaseModel
+from fastapi import APIRouter, Header, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, ValidationError
 import httpx
-from typing import Dict
-from .base import stream_openai_response, OpenAIProxyArgs
+import time
+from loguru import logger
+from typing import Dict, Optional, Union
+from .base import (stream_openai_response, scan_top_level_fields, payload_kwargs, wants_usage, relay_stream,
+                   StreamRelayResponse, OpenAIProxyArgs)
+from .clients import get_client
+from .upstream import get_pool
+from .response_cache import CACHE_HEADER, cached_response, response_cache
+from .semantic_cache import semantic_cache, semantic_response
+from .singleflight import coalesce_key, singleflight
+from .metrics import RequestTracker, failure_status
+from .admission import admit, admission, estimate_request_tokens
+from .tokens import estimate_prompt_tokens
+from .concurrency import PRIORITY_LOW, limited_send, request_priority
+from .shaping import shape_stream
+from .routing import AUTO_PLATFORM, counts_against_backend, model_router, resolve_keys, should_fail_over
+from .batch import NDJSON, BatchItemError, parse_batch_body, run_batch
+from . import codec
+from .config import env_bool
 
 router = APIRouter()
 
@@ -16,36 +35,256 @@ PLATFORM_API_URLS: Dict[str, str] = {
     "sambanova": "https://api.sambanova.ai/v1/chat/completions",
 }
 
+# Forward the client's request body as-is instead of re-serializing OpenAIProxyArgs.
+RAW_FORWARD = env_bool("LLMPROXY_RAW_FORWARD", True)
+
+
+def parse_request_body(body: bytes):
+    """Return (payload, fields) for a chat completion request body.
+
+    `fields` holds `model`, `stream`, `temperature` and `max_tokens`. With RAW_FORWARD the
+    original bytes are returned untouched and only those fields are read from
+    them, so fields the proxy does not model (`tools`, `response_format`,
+    ...) reach the upstream. Otherwise the body is validated with
+    OpenAIProxyArgs as before. A body that is not a JSON object is a 400.
+    """
+    if RAW_FORWARD:
+        try:
+            fields = scan_top_level_fields(body, ("model", "stream", "temperature", "max_tokens"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+        if not isinstance(fields.get("model"), str):
+            raise HTTPException(status_code=422, detail="Field 'model' is required")
+        return body, fields
+    try:
+        args = OpenAIProxyArgs.parse_raw(body)
+    except ValidationError as e:
+        raise RequestValidationError(e.raw_errors)
+    return args.dict(exclude_none=True), {"model": args.model, "stream": args.stream,
+                                          "temperature": args.temperature, "max_tokens": args.max_tokens}
+
+
+def decode_body(payload: Union[Dict, bytes]) -> Optional[Dict]:
+    if isinstance(payload, dict):
+        return payload
+    try:
+        body = codec.loads(payload)
+    except ValueError:
+        return None
+    return body if isinstance(body, dict) else None
+
+
+# Registered before the per-platform route, which would otherwise take "auto" as a platform.
+@router.post(f"/{AUTO_PLATFORM}/chat/completions")
+async def proxy_auto_chat_completions(request: Request, authorization: str = Header(...)):
+    """Serve a model alias from the backend expected to finish first, failing over to the others."""
+    raw_body = await request.body()
+    payload, fields = parse_request_body(raw_body)
+    body = decode_body(payload)
+    if body is None:
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+    alias = fields["model"]
+    if alias not in model_router.aliases:
+        raise HTTPException(status_code=404, detail=f"Model alias '{alias}' not configured")
+    keys = resolve_keys(authorization.split(" ")[1])
+    backends = model_router.rank(alias, estimate_request_tokens(0, fields.get("max_tokens")),
+                                 [platform for platform in keys if platform in PLATFORM_API_URLS])
+    if not backends:
+        raise HTTPException(status_code=401, detail=f"No API key for any backend of '{alias}'")
+
+    tracker = RequestTracker(AUTO_PLATFORM, alias, len(raw_body),
+                             estimate_request_tokens(0, fields.get("max_tokens")))
+    try:
+        for position, backend in enumerate(backends):
+            started = time.perf_counter()
+            try:
+                response = await forward_chat_completions(
+                    backend.platform, request, f"Bearer {keys[backend.platform]}",
+                    dict(body, model=backend.model), dict(fields, model=backend.model), tracker)
+            except HTTPException as e:
+                if not should_fail_over(e.status_code):
+                    raise
+                if counts_against_backend(e.status_code):
+                    model_router.record_failure(backend)
+                if position == len(backends) - 1:
+                    raise
+                logger.warning(f"{backend.label} failed with {e.status_code}, failing over")
+                continue
+            response = model_router.observe(backend, response, started)
+            break
+    except HTTPException as e:
+        tracker.finish(e.status_code)
+        raise
+    except BaseException as e:
+        tracker.finish(failure_status(e))
+        raise
+    return tracker.observe_response(response)
+
 
 @router.post("/{platform}/chat/completions")
-async def proxy_chat_completions(platform: str, args: OpenAIProxyArgs, authorization: str = Header(...)):
+async def proxy_chat_completions(platform: str, request: Request, authorization: str = Header(...)):
     if platform not in PLATFORM_API_URLS:
         raise HTTPException(
             status_code=404, detail=f"Platform '{platform}' not supported")
 
-    api_url = PLATFORM_API_URLS[platform]
+    raw_body = await request.body()
+    payload, fields = parse_request_body(raw_body)
+    tracker = RequestTracker(platform, fields.get("model"), len(raw_body),
+                             estimate_request_tokens(0, fields.get("max_tokens")))
+    try:
+        response = await forward_chat_completions(platform, request, authorization, payload, fields, tracker)
+    except HTTPException as e:
+        tracker.finish(e.status_code)
+        raise
+    except BaseException as e:
+        tracker.finish(failure_status(e))
+        raise
+    return tracker.observe_response(response)
+
+
+async def forward_chat_completions(platform: str, request: Request, authorization: str,
+                                   payload: Union[Dict, bytes], fields: Dict,
+                                   tracker: RequestTracker) -> Response:
     api_key = authorization.split(" ")[1]
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
-    payload = args.dict(exclude_none=True)
+    stream = fields.get("stream") is True
+    content = payload_kwargs(payload)["content"]
+
+    # The full body is only decoded when caching or coalescing may apply.
+    body = None
+    if fields.get("temperature") == 0 or request.headers.get(CACHE_HEADER):
+        body = decode_body(payload)
+
+    cache_policy = None
+    if response_cache is not None and body is not None:
+        cache_policy = response_cache.policy(platform, body, request.headers, api_key)
+        if cache_policy is not None:
+            cached = await response_cache.get(cache_policy)
+            if cached is not None:
+                return cached_response(cached, stream, wants_usage(body))
+    semantic = None
+    if semantic_cache is not None and body is not None:
+        semantic = semantic_cache.query(platform, body, request.headers, api_key)
+        hit = semantic_cache.get(semantic) if semantic is not None else None
+        if hit is not None:
+            return semantic_response(*hit, stream, wants_usage(body))
+    flight_key = coalesce_key(platform, body, api_key, stream) if body is not None else None
+
+    client = get_client(platform)
+    pool = get_pool(platform, PLATFORM_API_URLS[platform])
+
+    # Admission is only charged for requests that actually go upstream; the prompt is
+    # estimated from the messages, so base64 images and JSON framing do not count as text.
+    tokens = 0
+    if admission is not None:
+        prompt = body if body is not None else decode_body(payload)
+        tokens = estimate_request_tokens(estimate_prompt_tokens(prompt), fields.get("max_tokens"))
+    priority = request_priority(request.headers)
+
+    async def send() -> httpx.Response:
+        await admit(platform, api_key, fields["model"], tokens)
+        try:
+            response = await limited_send(platform, fields["model"], priority, lambda: pool.send(
+                client, lambda url: client.build_request("POST", url, headers=headers, content=content)))
+            tracker.upstream_headers()
+            if response.is_error or not stream:
+                await response.aread()
+                await response.aclose()
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+        if response.is_error:
+            raise HTTPException(
+                status_code=response.status_code, detail=str(response.text))
+        return response
 
-    if args.stream:
-        return StreamingResponse(
-            stream_openai_response(api_url, payload, headers),
+    if stream:
+        stream_headers = {"X-Content-Type-Options": "nosniff",
+                          "X-Experimental-Stream-Data": "true"}
+        if flight_key is not None:
+            async def open_stream():
+                return shape_stream(stream_openai_response(await send()))
+
+            return StreamRelayResponse(
+                await singleflight.stream(flight_key, open_stream),
+                media_type="text/event-stream",
+                headers=stream_headers
+            )
+        response = await send()
+        return StreamRelayResponse(
+            relay_stream(shape_stream(stream_openai_response(response))),
             media_type="text/event-stream",
-            headers={"X-Content-Type-Options": "nosniff",
-                     "X-Experimental-Stream-Data": "true"}
+            headers=stream_headers,
+            background=BackgroundTask(response.aclose)
         )
     else:
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(api_url, json=payload, headers=headers)
-                response.raise_for_status()
-                return JSONResponse(response.json())
-            except httpx.HTTPStatusError as e:
-                raise HTTPException(
-                    status_code=e.response.status_code, detail=str(e.response.text))
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=str(e))
+        async def complete() -> bytes:
+            response = await send()
+            if cache_policy is not None:
+                await response_cache.set(cache_policy, response.content)
+            if semantic is not None:
+                semantic_cache.set(semantic, response.content)
+            return response.content
+
+        completion = await singleflight.call(flight_key, complete) if flight_key else await complete()
+        # Already JSON from the upstream; relay the bytes without a parse/dump round trip.
+        return Response(content=completion, media_type="application/json",
+                        headers={CACHE_HEADER: "MISS"} if cache_policy is not None else None)
+
+
+async def complete_chat(platform: str, api_key: str, item) -> bytes:
+    """Run one non-streaming chat completion for a batch item; returns the upstream JSON.
+
+    Failures are raised as BatchItemError.
+    """
+    if not isinstance(item, dict) or not isinstance(item.get("model"), str):
+        raise BatchItemError(422, "Field 'model' is required")
+    if RAW_FORWARD:
+        payload = dict(item, stream=False)
+    else:
+        try:
+            payload = OpenAIProxyArgs.parse_obj(dict(item, stream=False)).dict(exclude_none=True)
+        except ValidationError as e:
+            raise BatchItemError(422, str(e))
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    content = codec.dumps(payload)
+    try:
+        await admit(platform, api_key, item["model"],
+                    estimate_request_tokens(estimate_prompt_tokens(item), item.get("max_tokens")))
+    except HTTPException as e:
+        raise BatchItemError(e.status_code, e.detail)
+    client = get_client(platform)
+    pool = get_pool(platform, PLATFORM_API_URLS[platform])
+    try:
+        response = await limited_send(platform, item["model"], PRIORITY_LOW, lambda: pool.send(
+            client, lambda url: client.build_request("POST", url, headers=headers, content=content)))
+    except HTTPException as e:
+        raise BatchItemError(e.status_code, e.detail)
+    try:
+        await response.aread()
+    finally:
+        await response.aclose()
+    if response.is_error:
+        raise BatchItemError(response.status_code, response.text)
+    return response.content
+
+
+@router.post("/{platform}/batch/chat/completions")
+async def proxy_batch_chat_completions(platform: str, request: Request, authorization: str = Header(...)):
+    """Run many non-streaming chat completions; results are streamed back as NDJSON."""
+    if platform not in PLATFORM_API_URLS:
+        raise HTTPException(
+            status_code=404, detail=f"Platform '{platform}' not supported")
+
+    api_key = authorization.split(" ")[1]
+    items = parse_batch_body(await request.body())
+    return StreamRelayResponse(run_batch(items, lambda item: complete_chat(platform, api_key, item)),
+                               media_type=NDJSON)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+''' In-process cache for image URL -> Gemini inline_data conversion
+
+Multi-turn chats resend the same image URLs on every turn. Entries are keyed
+by URL and point at a content-addressed blob (sha256 of the image bytes), so
+the same image served from several URLs is stored once. The cache is bounded
+in bytes with LRU eviction, honours upstream `Cache-Control` (no-store,
+no-cache, max-age) for freshness and keeps `ETag`/`Last-Modified` so stale
+entries can be revalidated with a conditional GET instead of a full download.
+'''
+from collections import OrderedDict
+from dataclasses import dataclass
+import hashlib
+import re
+import time
+from typing import Dict, Optional, Tuple
+from .config import env_float, env_int
+
+
+@dataclass
+class ImageEntry:
+    digest: str
+    expires: float
+    size: int
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    def is_fresh(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) < self.expires
+
+    def validators(self) -> Dict[str, str]:
+        """Conditional request headers for revalidating this entry."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+_MAX_AGE_PATTERN = re.compile(r"max-age=(\d+)")
+
+
+def parse_cache_control(value: Optional[str], default_ttl: float) -> Optional[float]:
+    """Return the TTL allowed by a Cache-Control header, or None if it must not be stored."""
+    directives = (value or "").lower()
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0.0
+    match = _MAX_AGE_PATTERN.search(directives)
+    if match:
+        return min(float(match.group(1)), default_ttl)
+    return default_ttl
+
+
+class ImageCache:
+    def __init__(self, max_bytes: int, default_ttl: float):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entries: "OrderedDict[str, ImageEntry]" = OrderedDict()
+        # digest -> [mime_type, base64 data, refcount]
+        self._blobs: Dict[str, list] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        self.fetch_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def lookup(self, url: str) -> Tuple[Optional[ImageEntry], Optional[Tuple[str, str]]]:
+        """Return (entry, (mime_type, data)) for `url`.
+
+        The entry may be stale, in which case the caller should revalidate it
+        with `entry.validators()`. Stale entries without validators are dropped.
+        """
+        entry = self._entries.get(url)
+        if entry is None:
+            return None, None
+        if not entry.is_fresh() and not entry.validators():
+            self._remove(url)
+            return None, None
+        self._entries.move_to_end(url)
+        mime_type, data, _ = self._blobs[entry.digest]
+        return entry, (mime_type, data)
+
+    def record_hit(self, entry: ImageEntry, revalidated: bool = False):
+        self.hits += 1
+        self.bytes_saved += entry.size
+        if revalidated:
+            self.revalidated += 1
+
+    def record_miss(self, fetch_seconds: float):
+        self.misses += 1
+        self.fetch_seconds += fetch_seconds
+
+    def refresh(self, url: str, headers: Dict[str, str]):
+        """Extend the lifetime of `url` after a 304 Not Modified response."""
+        entry = self._entries.get(url)
+        if entry is None:
+            return
+        ttl = parse_cache_control(headers.get("cache-control"), self.default_ttl)
+        if ttl is None:
+            self._remove(url)
+            return
+        entry.expires = time.time() + ttl
+        entry.etag = headers.get("etag", entry.etag)
+        entry.last_modified = headers.get("last-modified", entry.last_modified)
+
+    def store(self, url: str, mime_type: str, data: str, raw_size: int, headers: Dict[str, str]):
+        if not self.enabled:
+            return
+        ttl = parse_cache_control(headers.get("cache-control"), self.default_ttl)
+        size = len(data)
+        if ttl is None or size > self.max_bytes:
+            return
+        etag = headers.get("etag")
+        last_modified = headers.get("last-modified")
+        if ttl == 0 and not etag and not last_modified:
+            return  # never fresh and cannot be revalidated
+
+        digest = hashlib.sha256(data.encode()).hexdigest()
+        if url in self._entries:
+            self._remove(url)
+        blob = self._blobs.get(digest)
+        if blob is None:
+            self._blobs[digest] = [mime_type, data, 1]
+            self._bytes += size
+        else:
+            blob[2] += 1
+        self._entries[url] = ImageEntry(
+            digest=digest,
+            expires=time.time() + ttl,
+            size=raw_size,
+            etag=etag,
+            last_modified=last_modified,
+        )
+        while self._bytes > self.max_bytes and self._entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, url: str):
+        entry = self._entries.pop(url)
+        blob = self._blobs[entry.digest]
+        blob[2] -= 1
+        if blob[2] == 0:
+            del self._blobs[entry.digest]
+            self._bytes -= len(blob[1])
+
+    def clear(self):
+        self._entries.clear()
+        self._blobs.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        avg_fetch = self.fetch_seconds / self.misses if self.misses else 0.0
+        return {
+            "entries": len(self._entries),
+            "blobs": len(self._blobs),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "revalidated": self.revalidated,
+            "evictions": self.evictions,
+            "bytes_saved": self.bytes_saved,
+            # Estimated from the average download time of misses.
+            "seconds_saved": (self.hits - self.revalidated) * avg_fetch,
+        }
+
+
+image_cache = ImageCache(
+    max_bytes=env_int("LLMPROXY_IMAGE_CACHE_BYTES", 64 * 1024 * 1024),
+    default_ttl=env_float("LLMPROXY_IMAGE_CACHE_TTL", 3600),
+)
@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+''' OpenAI Batch API compatible job queue
+
+Clients upload a JSONL file in OpenAI Batch format (one
+`{"custom_id", "method", "url", "body"}` request per line) to
+`/{platform}/files`, then create a job for it at `/{platform}/batches`. This
+mirrors the OpenAI SDK's `client.files.create` / `client.batches.create` when
+its base URL is the proxy's platform URL. Jobs run in the background on a
+local asyncio worker pool, paced per platform to stay under its request rate,
+and results are written to output/error JSONL files that can be downloaded
+from `/{platform}/files/{file_id}/content`.
+
+Everything lives under LLMPROXY_JOBS_DIR. Result lines are appended as items
+finish and serve as the checkpoint: after a restart, unfinished jobs resume
+with the requests that have no result line yet. The upstream API key is kept
+in plain text in the job record (`batches/<id>/batch.json`) so the job can
+resume; records are written with mode 0600 and job directories created with
+mode 0700.
+
+- LLMPROXY_JOBS_DIR: storage directory (default .llmproxy-jobs)
+- LLMPROXY_JOB_WORKERS: concurrent requests across all jobs (default 4)
+- LLMPROXY_JOB_RPM: requests per minute per platform (default 60)
+- LLMPROXY_JOB_RATE_LIMITS: JSON mapping platform -> requests per minute,
+  overriding LLMPROXY_JOB_RPM
+'''
+from dataclasses import asdict, dataclass, field, fields
+from loguru import logger
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from fastapi import APIRouter, File, Form, Header, HTTPException, UploadFile
+from fastapi.responses import FileResponse
+from pydantic import BaseModel
+from . import codec
+from .batch import BatchItemError
+from .config import env_float, env_int
+from . import gemini, generic
+from .response_cache import caller_id
+
+router = APIRouter()
+
+JOBS_DIR = os.environ.get("LLMPROXY_JOBS_DIR", ".llmproxy-jobs")
+JOB_WORKERS = env_int("LLMPROXY_JOB_WORKERS", 4)
+JOB_RPM = env_float("LLMPROXY_JOB_RPM", 60)
+# Attempts per request when the upstream answers 429 or 5xx.
+JOB_MAX_ATTEMPTS = 3
+
+SUPPORTED_ENDPOINTS = ("/v1/chat/completions", "/chat/completions")
+ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def _write_json(path: str, data: Dict):
+    tmp = f"{path}.tmp"
+    # Owner-only: job records hold the upstream API key.
+    with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _append(path: str, line: bytes):
+    with open(path, "ab") as f:
+        f.write(line)
+
+
+def _finished_ids(path: str) -> Set[str]:
+    """custom_ids with a result line in `path`, dropping a torn last line left by a crash."""
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb") as f:
+        content = f.read()
+    end = content.rfind(b"\n") + 1
+    if end < len(content):
+        with open(path, "r+b") as f:
+            f.truncate(end)
+    return {codec.loads(line)["custom_id"] for line in content[:end].splitlines() if line}
+
+
+class FileStore:
+    """Uploaded and generated files, as `<id>.jsonl` plus `<id>.json` metadata."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _meta_path(self, file_id: str) -> str:
+        return os.path.join(self.root, f"{os.path.basename(file_id)}.json")
+
+    def path(self, file_id: str) -> str:
+        return os.path.join(self.root, f"{os.path.basename(file_id)}.jsonl")
+
+    def create(self, owner: str, filename: str, purpose: str, content: Optional[bytes] = None,
+               file_id: Optional[str] = None) -> Dict:
+        """Register a file; with `content` None the caller puts the `.jsonl` in place itself."""
+        os.makedirs(self.root, mode=0o700, exist_ok=True)
+        file_id = file_id or f"file-{uuid.uuid4().hex}"
+        if content is not None:
+            with open(self.path(file_id), "wb") as f:
+                f.write(content)
+        meta = {"id": file_id, "object": "file", "bytes": len(content or b""), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "owner": owner}
+        _write_json(self._meta_path(file_id), meta)
+        return meta
+
+    def get(self, file_id: str, owner: str) -> Dict:
+        try:
+            with open(self._meta_path(file_id)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            meta = None
+        if meta is None or meta["owner"] != owner:
+            raise HTTPException(status_code=404, detail=f"No such file: {file_id}")
+        if os.path.exists(self.path(file_id)):
+            meta["bytes"] = os.path.getsize(self.path(file_id))
+        return meta
+
+
+@dataclass
+class Job:
+    id: str
+    platform: str
+    owner: str
+    api_key: str
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+    status: str = "validating"
+    created_at: int = 0
+    in_progress_at: Optional[int] = None
+    finalizing_at: Optional[int] = None
+    completed_at: Optional[int] = None
+    failed_at: Optional[int] = None
+    cancelling_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+    errors: Optional[Dict] = None
+    metadata: Optional[Dict] = None
+    request_counts: Dict[str, int] = field(default_factory=lambda: {"total": 0, "completed": 0, "failed": 0})
+
+    def to_openai(self) -> Dict:
+        data = asdict(self)
+        for private in ("platform", "owner", "api_key"):
+            del data[private]
+        data["object"] = "batch"
+        return data
+
+
+class RateLimiter:
+    """Spaces requests to each platform evenly to stay under its requests per minute."""
+
+    def __init__(self, rpm: Dict[str, float], default_rpm: float):
+        self.rpm = rpm
+        self.default_rpm = default_rpm
+        self._next: Dict[str, float] = {}
+
+    async def acquire(self, platform: str):
+        interval = 60 / self.rpm.get(platform, self.default_rpm)
+        now = time.monotonic()
+        slot = max(now, self._next.get(platform, 0.0))
+        self._next[platform] = slot + interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, platform: str, seconds: float):
+        """Hold back all requests to `platform` for `seconds`, e.g. after a 429."""
+        self._next[platform] = max(self._next.get(platform, 0.0), time.monotonic() + seconds)
+
+
+RunItem = Callable[[str, str, Dict], Awaitable[bytes]]
+
+
+async def complete_for_platform(platform: str, api_key: str, body: Dict) -> bytes:
+    if platform == "gemini":
+        return await gemini.complete_chat(api_key, body)
+    return await generic.complete_chat(platform, api_key, body)
+
+
+class JobManager:
+    def __init__(self, root: str, run_item: RunItem = complete_for_platform,
+                 workers: int = JOB_WORKERS, limiter: Optional[RateLimiter] = None):
+        self.root = root
+        self.files = FileStore(os.path.join(root, "files"))
+        self.run_item = run_item
+        self.workers = workers
+        self.limiter = limiter or RateLimiter({}, JOB_RPM)
+        self.jobs: Dict[str, Job] = {}
+        # job id -> requests queued or in flight
+        self._pending: Dict[str, int] = {}
+        self._queue: "asyncio.Queue[Tuple[Job, Dict]]" = None
+        self._tasks: List[asyncio.Task] = []
+
+    def _job_dir(self, job_id: str) -> str:
+        return os.path.join(self.root, "batches", os.path.basename(job_id))
+
+    def _output_path(self, job: Job, kind: str) -> str:
+        return os.path.join(self._job_dir(job.id), f"{kind}.jsonl")
+
+    async def _save(self, job: Job):
+        await asyncio.to_thread(_write_json, os.path.join(self._job_dir(job.id), "batch.json"), asdict(job))
+
+    async def start(self):
+        """Start the workers and resume jobs left unfinished by a previous run."""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+        batches_dir = os.path.join(self.root, "batches")
+        if not os.path.isdir(batches_dir):
+            return
+        for job_id in os.listdir(batches_dir):
+            try:
+                with open(os.path.join(batches_dir, job_id, "batch.json")) as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable batch {job_id}: {e!r}")
+                continue
+            job = Job(**{k: v for k, v in data.items() if k in {f.name for f in fields(Job)}})
+            self.jobs[job.id] = job
+            if job.status in ACTIVE_STATUSES:
+                logger.info(f"Resuming batch {job.id} ({job.status})")
+                await self._schedule(job)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _read_requests(self, job: Job) -> List[Dict]:
+        with open(self.files.path(job.input_file_id), "rb") as f:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+        requests = []
+        custom_ids = set()
+        for number, line in enumerate(lines, 1):
+            try:
+                request = codec.loads(line)
+            except ValueError:
+                raise ValueError(f"Line {number} is not valid JSON")
+            if not isinstance(request, dict) or not isinstance(request.get("body"), dict):
+                raise ValueError(f"Line {number} has no request body")
+            if request.get("url", job.endpoint) != job.endpoint:
+                raise ValueError(f"Line {number} targets {request.get('url')}, not {job.endpoint}")
+            custom_id = request.get("custom_id")
+            if not isinstance(custom_id, str) or custom_id in custom_ids:
+                raise ValueError(f"Line {number} has a missing or duplicate custom_id")
+            custom_ids.add(custom_id)
+            requests.append(request)
+        return requests
+
+    async def create(self, platform: str, api_key: str, input_file_id: str, endpoint: str,
+                     completion_window: str = "24h", metadata: Optional[Dict] = None) -> Job:
+        owner = caller_id(api_key)
+        self.files.get(input_file_id, owner)
+        if endpoint not in SUPPORTED_ENDPOINTS:
+            raise HTTPException(status_code=400, detail=f"Unsupported endpoint: {endpoint}")
+        await self.start()
+        job = Job(id=f"batch_{uuid.uuid4().hex}", platform=platform, owner=owner, api_key=api_key,
+                  input_file_id=input_file_id, endpoint=endpoint, completion_window=completion_window,
+                  created_at=int(time.time()), metadata=metadata)
+        os.makedirs(self._job_dir(job.id), mode=0o700, exist_ok=True)
+        self.jobs[job.id] = job
+        await self._schedule(job)
+        return job
+
+    async def _schedule(self, job: Job):
+        """Validate the input (first run only) and queue requests that have no result yet."""
+        try:
+            requests = await asyncio.to_thread(self._read_requests, job)
+        except (OSError, ValueError) as e:
+            job.status = "failed"
+            job.failed_at = int(time.time())
+            job.errors = {"object": "list", "data": [{"code": "invalid_input", "message": str(e)}]}
+            await self._save(job)
+            return
+        finished = await asyncio.to_thread(_finished_ids, self._output_path(job, "output"))
+        failed = await asyncio.to_thread(_finished_ids, self._output_path(job, "errors"))
+        job.request_counts = {"total": len(requests), "completed": len(finished), "failed": len(failed)}
+        if job.status == "validating":
+            job.status = "in_progress"
+            job.in_progress_at = int(time.time())
+        await self._save(job)
+
+        pending = [r for r in requests if r["custom_id"] not in finished and r["custom_id"] not in failed]
+        self._pending[job.id] = len(pending)
+        if not pending or job.status != "in_progress":
+            await self._finalize(job)
+            return
+        for request in pending:
+            self._queue.put_nowait((job, request))
+
+    async def cancel(self, job: Job) -> Job:
+        if job.status in ("validating", "in_progress"):
+            job.status = "cancelling"
+            job.cancelling_at = int(time.time())
+            await self._save(job)
+        return job
+
+    async def _work(self):
+        while True:
+            job, request = await self._queue.get()
+            try:
+                if job.status == "in_progress":
+                    await self._process(job, request)
+            except Exception as e:
+                logger.error(f"Batch {job.id} request {request['custom_id']} failed: {e!r}")
+            # Not reached when cancelled at shutdown, so the job stays unfinished and resumes.
+            try:
+                self._pending[job.id] -= 1
+                if self._pending[job.id] == 0:
+                    await self._finalize(job)
+            except Exception as e:
+                # The job stays active and is finalized again on the next start.
+                logger.error(f"Finalizing batch {job.id} failed: {e!r}")
+
+    async def _process(self, job: Job, request: Dict):
+        response = error = None
+        for attempt in range(JOB_MAX_ATTEMPTS):
+            await self.limiter.acquire(job.platform)
+            try:
+                body = await self.run_item(job.platform, job.api_key, request["body"])
+                response = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": codec.loads(body)}
+                break
+            except BatchItemError as e:
+                try:
+                    error_body = codec.loads(e.message)
+                except ValueError:
+                    error_body = {"error": {"message": e.message}}
+                response = {"status_code": e.status_code, "request_id": uuid.uuid4().hex, "body": error_body}
+                if e.status_code not in RETRYABLE_STATUSES:
+                    break
+                delay = random.uniform(1, 2) * 2 ** attempt
+                if e.status_code == 429:
+                    self.limiter.pause(job.platform, delay)
+                if attempt < JOB_MAX_ATTEMPTS - 1:
+                    await asyncio.sleep(delay)
+            except Exception as e:
+                response = None
+                error = {"code": "request_failed", "message": repr(e)}
+                break
+
+        ok = response is not None and response["status_code"] == 200
+        line = codec.dumps({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"],
+                            "response": response, "error": error}) + b"\n"
+        await asyncio.to_thread(_append, self._output_path(job, "output" if ok else "errors"), line)
+        job.request_counts["completed" if ok else "failed"] += 1
+
+    async def _finalize(self, job: Job):
+        if job.status not in ACTIVE_STATUSES:
+            return
+        now = int(time.time())
+        job.finalizing_at = job.finalizing_at or now
+        for kind, attr in (("output", "output_file_id"), ("errors", "error_file_id")):
+            path = self._output_path(job, kind)
+            if os.path.exists(path) and getattr(job, attr) is None:
+                file_id = f"file-{job.id}-{kind}"
+                self.files.create(job.owner, f"{job.id}_{kind}.jsonl", "batch_output", file_id=file_id)
+                os.replace(path, self.files.path(file_id))
+                setattr(job, attr, file_id)
+        if job.status == "cancelling":
+            job.status = "cancelled"
+            job.cancelled_at = now
+        else:
+            job.status = "completed"
+            job.completed_at = now
+        await self._save(job)
+        logger.info(f"Batch {job.id} {job.status}: {job.request_counts}")
+
+    def get(self, job_id: str, owner: str) -> Job:
+        job = self.jobs.get(job_id)
+        if job is None or job.owner != owner:
+            raise HTTPException(status_code=404, detail=f"No such batch: {job_id}")
+        return job
+
+
+def _rate_limits() -> Dict[str, float]:
+    raw = os.environ.get("LLMPROXY_JOB_RATE_LIMITS")
+    return {platform: float(rpm) for platform, rpm in json.loads(raw).items()} if raw else {}
+
+
+job_manager = JobManager(JOBS_DIR, limiter=RateLimiter(_rate_limits(), JOB_RPM))
+
+
+def _check_platform(platform: str):
+    if platform != "gemini" and platform not in generic.PLATFORM_API_URLS:
+        raise HTTPException(
+            status_code=404, detail=f"Platform '{platform}' not supported")
+
+
+def _public_file(meta: Dict) -> Dict:
+    return {k: v for k, v in meta.items() if k != "owner"}
+
+
+class CreateBatchArgs(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+    metadata: Optional[Dict[str, str]] = None
+
+
+@router.post("/{platform}/files")
+async def upload_file(platform: str, file: UploadFile = File(...), purpose: str = Form(...),
+                      authorization: str = Header(...)):
+    _check_platform(platform)
+    content = await file.read()
+    meta = await asyncio.to_thread(job_manager.files.create, caller_id(authorization.split(" ")[1]),
+                                   file.filename, purpose, content)
+    return _public_file(meta)
+
+
+@router.get("/{platform}/files/{file_id}")
+async def retrieve_file(platform: str, file_id: str, authorization: str = Header(...)):
+    _check_platform(platform)
+    return _public_file(job_manager.files.get(file_id, caller_id(authorization.split(" ")[1])))
+
+
+@router.get("/{platform}/files/{file_id}/content")
+async def download_file(platform: str, file_id: str, authorization: str = Header(...)):
+    _check_platform(platform)
+    meta = job_manager.files.get(file_id, caller_id(authorization.split(" ")[1]))
+    return FileResponse(job_manager.files.path(file_id), media_type="application/jsonl",
+                        filename=meta["filename"])
+
+
+@router.post("/{platform}/batches")
+async def create_batch(platform: str, args: CreateBatchArgs, authorization: str = Header(...)):
+    _check_platform(platform)
+    job = await job_manager.create(platform, authorization.split(" ")[1], args.input_file_id,
+                                   args.endpoint, args.completion_window, args.metadata)
+    return job.to_openai()
+
+
+@router.get("/{platform}/batches")
+async def list_batches(platform: str, authorization: str = Header(...)):
+    _check_platform(platform)
+    owner = caller_id(authorization.split(" ")[1])
+    jobs = sorted((job for job in job_manager.jobs.values() if job.owner == owner and job.platform == platform),
+                  key=lambda job: job.created_at, reverse=True)
+    return {"object": "list", "data": [job.to_openai() for job in jobs], "has_more": False}
+
+
+@router.get("/{platform}/batches/{batch_id}")
+async def retrieve_batch(platform: str, batch_id: str, authorization: str = Header(...)):
+    _check_platform(platform)
+    return job_manager.get(batch_id, caller_id(authorization.split(" ")[1])).to_openai()
+
+
+@router.post("/{platform}/batches/{batch_id}/cancel")
+async def cancel_batch(platform: str, batch_id: str, authorization: str = Header(...)):
+    _check_platform(platform)
+    job = job_manager.get(batch_id, caller_id(authorization.split(" ")[1]))
+    return (await job_manager.cancel(job)).to_openai()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+''' Server-side Gemini API key pools
+
+A client authenticates with a proxy token instead of a Gemini key; the proxy
+picks one of the token's keys per request, preferring the key with the most
+remaining quota in the current minute. Keys that get a 429 are put on
+cooldown (for the upstream `Retry-After`/`retryDelay` when given) and the
+request is retried on another key.
+
+Configured through environment variables:
+- LLMPROXY_GEMINI_KEY_POOLS: JSON mapping proxy token -> list of Gemini keys
+- LLMPROXY_GEMINI_KEY_RPM: requests per minute allowed per key (default 15)
+- LLMPROXY_GEMINI_KEY_TPM: tokens per minute allowed per key (default 1000000)
+- LLMPROXY_GEMINI_KEY_COOLDOWN: cooldown in seconds after a 429 without a
+  retry hint (default 60)
+'''
+from collections import deque
+from loguru import logger
+import json
+import os
+import re
+import time
+from typing import Deque, Dict, List, Optional, Tuple
+import httpx
+from .config import env_float, env_int
+
+WINDOW = 60.0
+_RETRY_DELAY = re.compile(r'"retryDelay"\s*:\s*"([\d.]+)s"')
+
+
+class KeyState:
+    def __init__(self, key: str, rpm: int, tpm: int):
+        self.key = key
+        self.rpm = rpm
+        self.tpm = tpm
+        # (timestamp, tokens) per request in the last WINDOW seconds
+        self._window: Deque[Tuple[float, int]] = deque()
+        self._tokens = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.rate_limited = 0
+
+    def _trim(self, now: float):
+        while self._window and now - self._window[0][0] >= WINDOW:
+            self._tokens -= self._window.popleft()[1]
+
+    def headroom(self, now: float) -> float:
+        """Fraction of the tighter of RPM/TPM quota still free, or -1 while cooling down."""
+        if now < self.cooldown_until:
+            return -1.0
+        self._trim(now)
+        return min(1 - len(self._window) / self.rpm, 1 - self._tokens / self.tpm)
+
+    def acquire(self, now: float):
+        self.requests += 1
+        self._window.append((now, 0))
+
+    def record_tokens(self, tokens: int):
+        if self._window:
+            at, counted = self._window[-1]
+            self._window[-1] = (at, counted + tokens)
+            self._tokens += tokens
+
+    def cooldown(self, seconds: float):
+        self.rate_limited += 1
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    def masked(self) -> str:
+        return f"...{self.key[-4:]}"
+
+
+class KeyPool:
+    def __init__(self, keys: List[str], rpm: int = 15, tpm: int = 1_000_000, cooldown: float = 60.0):
+        self.keys = [KeyState(key, rpm, tpm) for key in keys]
+        self.default_cooldown = cooldown
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def select(self, exclude: Tuple[str, ...] = ()) -> Optional[KeyState]:
+        """The key with the most headroom, or None if every key is cooling down."""
+        now = time.monotonic()
+        best, best_headroom = None, -1.0
+        for state in self.keys:
+            if state.key in exclude:
+                continue
+            headroom = state.headroom(now)
+            if headroom > best_headroom:
+                best, best_headroom = state, headroom
+        if best is not None and best_headroom >= 0:
+            best.acquire(now)
+            return best
+        return None
+
+    def retry_after(self) -> float:
+        """Seconds until the first key leaves its cooldown."""
+        return max(0.0, min(s.cooldown_until for s in self.keys) - time.monotonic())
+
+    def rate_limited(self, state: KeyState, response: httpx.Response):
+        """Put `state` on cooldown after a 429, honouring Retry-After or Gemini's retryDelay."""
+        delay = self.default_cooldown
+        retry_after = response.headers.get("retry-after")
+        match = _RETRY_DELAY.search(response.text) if response.is_stream_consumed else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                pass
+        elif match:
+            delay = float(match.group(1))
+        state.cooldown(delay)
+        logger.warning(f"Gemini key {state.masked()} rate limited, cooling down for {delay:.0f}s")
+
+    def stats(self) -> List[Dict]:
+        now = time.monotonic()
+        stats = []
+        for state in self.keys:
+            state._trim(now)
+            stats.append({
+                "key": state.masked(),
+                "requests": state.requests,
+                "rate_limited": state.rate_limited,
+                "rpm_used": len(state._window),
+                "tpm_used": state._tokens,
+                "cooldown": max(0.0, state.cooldown_until - now),
+            })
+        return stats
+
+
+def _load_pools() -> Dict[str, KeyPool]:
+    raw = os.environ.get("LLMPROXY_GEMINI_KEY_POOLS")
+    if not raw:
+        return {}
+    rpm = env_int("LLMPROXY_GEMINI_KEY_RPM", 15)
+    tpm = env_int("LLMPROXY_GEMINI_KEY_TPM", 1_000_000)
+    cooldown = env_float("LLMPROXY_GEMINI_KEY_COOLDOWN", 60)
+    return {token: KeyPool(keys, rpm, tpm, cooldown) for token, keys in json.loads(raw).items()}
+
+
+key_pools: Dict[str, KeyPool] = _load_pools()
+
+
+def get_key_pool(token: str) -> Optional[KeyPool]:
+    return key_pools.get(token)
+
+
+def key_pool_stats() -> Dict[str, List[Dict]]:
+    return {f"...{token[-4:]}": pool.stats() for token, pool in key_pools.items()}
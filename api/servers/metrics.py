@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+''' Prometheus-style metrics
+
+A minimal registry of counters, gauges and histograms rendered in the
+Prometheus text exposition format at /metrics. Everything runs on the event
+loop thread, so recording is a dict lookup plus a few integer/float updates
+with no locks; histograms find their bucket with `bisect`.
+
+Requests are tracked per (platform, model); model labels are capped at
+MAX_MODELS distinct values per platform, extra ones are reported as "other".
+'''
+import asyncio
+from bisect import bisect_left
+import re
+import time
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+import httpx
+from starlette.responses import Response, StreamingResponse
+
+MAX_MODELS = 100
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+GAP_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 400, 800, 1600)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str]):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def _label_str(self, values: Tuple, extra: str = "") -> str:
+        pairs = [f'{k}="{_escape(str(v))}"' for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, labels: Tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines.extend(f"{self.name}{self._label_str(k)} {v}" for k, v in self.values.items())
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, labels: Tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, labels: Tuple, value: float):
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self.values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, labels: Tuple, value: float):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for labels, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self._label_str(labels, f"le={chr(34)}{bound}{chr(34)}")} {cumulative}')
+            lines.append(f"{self.name}_sum{self._label_str(labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{self._label_str(labels)} {cumulative}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    "llmproxy_requests_total", "Chat completion requests", ("platform", "model", "status")))
+IN_FLIGHT = registry.register(Gauge(
+    "llmproxy_requests_in_flight", "Requests currently being served", ("platform",)))
+DURATION = registry.register(Histogram(
+    "llmproxy_request_duration_seconds", "Total request duration, including streaming",
+    ("platform", "model", "status")))
+TTFB = registry.register(Histogram(
+    "llmproxy_upstream_ttfb_seconds", "Time until upstream response headers", ("platform", "model")))
+TTFT = registry.register(Histogram(
+    "llmproxy_ttft_seconds", "Time until the first streamed chunk is sent to the client", ("platform", "model")))
+CHUNK_GAP = registry.register(Histogram(
+    "llmproxy_stream_chunk_gap_seconds", "Gap between consecutive streamed chunks", ("platform", "model"),
+    buckets=GAP_BUCKETS))
+TOKENS_PER_SECOND = registry.register(Histogram(
+    "llmproxy_tokens_per_second", "Completion tokens per second (SSE events when usage is unknown)",
+    ("platform", "model"), buckets=RATE_BUCKETS))
+REQUEST_BYTES = registry.register(Counter(
+    "llmproxy_request_bytes_total", "Request body bytes received from clients", ("platform", "model")))
+RESPONSE_BYTES = registry.register(Counter(
+    "llmproxy_response_bytes_total", "Response body bytes sent to clients", ("platform", "model")))
+RATE_LIMIT_QUEUED = registry.register(Gauge(
+    "llmproxy_rate_limit_queued", "Requests waiting for admission", ("platform",)))
+RATE_LIMIT_WAIT = registry.register(Histogram(
+    "llmproxy_rate_limit_wait_seconds", "Time admitted requests waited for rate limit tokens", ("platform",)))
+RATE_LIMIT_REJECTED = registry.register(Counter(
+    "llmproxy_rate_limit_rejected_total", "Requests rejected with 429 by admission control", ("platform",)))
+SEMANTIC_LOOKUPS = registry.register(Counter(
+    "llmproxy_semantic_cache_lookups_total", "Semantic cache lookups by result", ("result",)))
+SEMANTIC_SIMILARITY = registry.register(Histogram(
+    "llmproxy_semantic_cache_similarity", "Best similarity found per semantic cache lookup", (),
+    buckets=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.925, 0.95, 0.975, 0.99, 1.0)))
+CONCURRENCY_LIMIT = registry.register(Gauge(
+    "llmproxy_concurrency_limit", "Adaptive limit on upstream requests in flight", ("platform", "model")))
+CONCURRENCY_IN_FLIGHT = registry.register(Gauge(
+    "llmproxy_concurrency_in_flight", "Upstream requests holding a concurrency slot", ("platform", "model")))
+CONCURRENCY_QUEUED = registry.register(Gauge(
+    "llmproxy_concurrency_queued", "Requests waiting for an upstream concurrency slot", ("platform", "model")))
+STREAM_CANCELLATIONS = registry.register(Counter(
+    "llmproxy_stream_cancellations_total", "Streams cut short because the client disconnected",
+    ("platform", "model")))
+CANCELLED_TOKENS_SAVED = registry.register(Counter(
+    "llmproxy_cancelled_tokens_saved_total",
+    "Estimated completion tokens not generated because a cancelled stream was closed upstream",
+    ("platform", "model")))
+CANCELLED_SECONDS_SAVED = registry.register(Counter(
+    "llmproxy_cancelled_seconds_saved_total",
+    "Estimated upstream generation seconds saved by closing cancelled streams", ("platform", "model")))
+
+_models: Dict[str, set] = {}
+_COMPLETION_TOKENS = re.compile(rb'"(?:completion_tokens|candidatesTokenCount)"\s*:\s*(\d+)')
+
+
+def _model_label(platform: str, model: str) -> str:
+    seen = _models.setdefault(platform, set())
+    if model in seen:
+        return model
+    if len(seen) < MAX_MODELS:
+        seen.add(model)
+        return model
+    return "other"
+
+
+# nginx's "client closed request", for requests the client abandoned.
+CLIENT_CLOSED = 499
+
+
+def failure_status(error: BaseException) -> int:
+    """Status to record for a request that ended with `error` instead of a response."""
+    if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+        return CLIENT_CLOSED
+    return 502 if isinstance(error, httpx.HTTPError) else 500
+
+
+class RequestTracker:
+    """Records the metrics of one proxied request."""
+    __slots__ = ("platform", "model", "completion_budget", "started", "finished")
+
+    def __init__(self, platform: str, model: str, request_bytes: int = 0,
+                 completion_budget: Optional[int] = None):
+        self.platform = platform
+        self.model = _model_label(platform, model or "unknown")
+        # Expected completion size (`max_tokens` or a default), to estimate what a cancellation saves.
+        self.completion_budget = completion_budget
+        self.started = time.perf_counter()
+        self.finished = False
+        IN_FLIGHT.inc((platform,))
+        REQUEST_BYTES.inc((platform, self.model), request_bytes)
+
+    def upstream_headers(self):
+        """Call when upstream response headers arrive."""
+        TTFB.observe((self.platform, self.model), time.perf_counter() - self.started)
+
+    def finish(self, status: int, response_bytes: int = 0, completion_tokens: Optional[int] = None,
+               generation_seconds: Optional[float] = None):
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.perf_counter() - self.started
+        labels = (self.platform, self.model)
+        IN_FLIGHT.dec((self.platform,))
+        REQUESTS.inc(labels + (str(status),))
+        DURATION.observe(labels + (str(status),), duration)
+        RESPONSE_BYTES.inc(labels, response_bytes)
+        seconds = generation_seconds if generation_seconds is not None else duration
+        if completion_tokens and seconds > 0:
+            TOKENS_PER_SECOND.observe(labels, completion_tokens / seconds)
+
+    def cancelled(self, events: int, generation_seconds: Optional[float]):
+        """Record a stream the client abandoned after `events` SSE events."""
+        labels = (self.platform, self.model)
+        STREAM_CANCELLATIONS.inc(labels)
+        if not self.completion_budget:
+            return
+        saved = max(self.completion_budget - events, 0)
+        CANCELLED_TOKENS_SAVED.inc(labels, saved)
+        if generation_seconds and events > 1:
+            CANCELLED_SECONDS_SAVED.inc(labels, saved * generation_seconds / (events - 1))
+
+    async def wrap(self, chunks: AsyncIterator, status: int = 200) -> AsyncIterator:
+        """Pass `chunks` through, recording TTFT, chunk gaps, bytes and token rate.
+
+        If the consumer stops early, `chunks` is closed right away so the
+        upstream request is cancelled rather than left to run out.
+        """
+        labels = (self.platform, self.model)
+        observe_gap = CHUNK_GAP.observe
+        first = last = None
+        size = events = 0
+        tokens = None
+        try:
+            async for chunk in chunks:
+                now = time.perf_counter()
+                if first is None:
+                    first = now
+                    TTFT.observe(labels, now - self.started)
+                else:
+                    observe_gap(labels, now - last)
+                last = now
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                size += len(chunk)
+                events += chunk.count(b"\n\n")
+                if b'"usage' in chunk:
+                    match = _COMPLETION_TOKENS.search(chunk)
+                    if match:
+                        tokens = int(match.group(1))
+                yield chunk
+        except (GeneratorExit, asyncio.CancelledError):
+            # Client went away.
+            if first is not None:
+                self.cancelled(events, last - first)
+            self.finish(CLIENT_CLOSED, size)
+            aclose = getattr(chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            raise
+        except BaseException as e:
+            # The upstream or the relay failed mid-stream.
+            self.finish(failure_status(e), size)
+            raise
+        generation = (last - first) if first is not None and last != first else None
+        self.finish(status, size, tokens if tokens is not None else max(events - 1, 0), generation)
+
+    def observe_response(self, response: Response) -> Response:
+        """Finish tracking for a plain response, or wrap a streaming one."""
+        if isinstance(response, StreamingResponse):
+            response.body_iterator = self.wrap(response.body_iterator, response.status_code)
+        else:
+            match = _COMPLETION_TOKENS.search(response.body) if response.status_code < 400 else None
+            self.finish(response.status_code, len(response.body), int(match.group(1)) if match else None)
+        return response
+
+
+def render() -> str:
+    return registry.render()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+''' Exact-match cache for chat completion responses
+
+Opt-in (LLMPROXY_RESPONSE_CACHE=memory or sqlite). Only deterministic
+requests (temperature 0) are cached unless the client sends
+`X-LLMProxy-Cache: force`. Keys are a sha256 over the platform and the
+canonical request (sorted keys, `stream` options dropped, inline image data
+replaced by its sha256), so a streamed and a non-streamed request share an
+entry. Entries are scoped to the caller's API key, so a hit never serves
+another key's completion without the upstream having checked the key. Entries are filled from non-streaming responses and replayed as SSE
+when the request asks for `stream=true`.
+
+Per-request headers:
+- X-LLMProxy-Cache: bypass (no lookup, no store), refresh (no lookup, store),
+  force (cache even when temperature is not 0)
+- X-LLMProxy-Cache-TTL: entry lifetime in seconds
+
+Environment variables:
+- LLMPROXY_RESPONSE_CACHE: off (default), memory or sqlite
+- LLMPROXY_RESPONSE_CACHE_BYTES: memory budget (default 64MB)
+- LLMPROXY_RESPONSE_CACHE_TTL: default TTL in seconds (default 3600)
+- LLMPROXY_RESPONSE_CACHE_PATH: SQLite file (default .llmproxy-cache.sqlite3)
+'''
+from collections import OrderedDict
+from dataclasses import dataclass
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterator, Mapping, Optional, Tuple
+from fastapi.responses import Response, StreamingResponse
+from . import codec
+from .codec import ChunkTemplate
+from .config import env_float, env_int
+
+CACHE_HEADER = "X-LLMProxy-Cache"
+TTL_HEADER = "X-LLMProxy-Cache-TTL"
+# Request fields that change the transport, not the completion.
+_TRANSPORT_FIELDS = ("stream", "stream_options")
+
+
+class MemoryBackend:
+    """LRU over response bytes, bounded by total size, with per-entry expiry."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._bytes = 0
+        self.evictions = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() >= entry[1]:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        if len(value) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, time.time() + ttl)
+        self._bytes += len(value)
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        value, _ = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def stats(self) -> Dict:
+        return {"backend": "memory", "entries": len(self._entries), "bytes": self._bytes,
+                "max_bytes": self.max_bytes, "evictions": self.evictions}
+
+
+class SQLiteBackend:
+    """On-disk cache; queries run in a worker thread to keep the event loop free."""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                         "key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL)")
+        self._lock = asyncio.Lock()
+
+    def _get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        row = self._db.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if now >= row[1]:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            return None
+        self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def _set(self, key: str, value: bytes, ttl: float):
+        now = time.time()
+        self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, value, now + ttl, now))
+        self._db.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+        total = self._db.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM responses").fetchone()[0]
+        while total > self.max_bytes:
+            row = self._db.execute("SELECT key, LENGTH(value) FROM responses ORDER BY accessed LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+            total -= row[1]
+
+    async def get(self, key: str) -> Optional[bytes]:
+        async with self._lock:
+            return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        async with self._lock:
+            await asyncio.to_thread(self._set, key, value, ttl)
+
+    def stats(self) -> Dict:
+        entries, size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM responses").fetchone()
+        return {"backend": "sqlite", "path": self.path, "entries": entries, "bytes": size,
+                "max_bytes": self.max_bytes}
+
+
+@dataclass
+class CachePolicy:
+    key: str
+    lookup: bool
+    store: bool
+    ttl: float
+
+
+class ResponseCache:
+    def __init__(self, backend, default_ttl: float):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def policy(self, platform: str, body: Dict, headers: Mapping[str, str],
+               api_key: str) -> Optional[CachePolicy]:
+        """How this request may use the cache, or None if it must not touch it."""
+        mode = headers.get(CACHE_HEADER, "").lower()
+        if mode == "bypass":
+            return None
+        if mode != "force" and body.get("temperature") != 0:
+            return None
+        try:
+            ttl = float(headers.get(TTL_HEADER) or self.default_ttl)
+        except ValueError:
+            ttl = self.default_ttl
+        return CachePolicy(key=f"{caller_id(api_key)}:{cache_key(platform, body)}", lookup=mode != "refresh", store=ttl > 0, ttl=ttl)
+
+    async def get(self, policy: CachePolicy) -> Optional[bytes]:
+        if not policy.lookup:
+            return None
+        value = await self.backend.get(policy.key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, policy: CachePolicy, value: bytes):
+        if policy.store:
+            self.stores += 1
+            await self.backend.set(policy.key, value, policy.ttl)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return dict(self.backend.stats(), hits=self.hits, misses=self.misses, stores=self.stores,
+                    hit_rate=self.hits / lookups if lookups else 0.0)
+
+
+def _canonical(value: Any) -> Any:
+    """Replace inline image data (data: URLs, Gemini inline_data) with its sha256."""
+    if isinstance(value, dict):
+        if "data" in value and "mime_type" in value:
+            return {"mime_type": value["mime_type"], "sha256": hashlib.sha256(value["data"].encode()).hexdigest()}
+        return {k: _canonical(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_canonical(v) for v in value]
+    if isinstance(value, str) and value.startswith("data:"):
+        return "sha256:" + hashlib.sha256(value.encode()).hexdigest()
+    return value
+
+
+def caller_id(api_key: str) -> str:
+    """Short hash of an API key, for scoping shared state to one caller."""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+
+def cache_key(platform: str, body: Dict) -> str:
+    request = {k: v for k, v in body.items() if k not in _TRANSPORT_FIELDS}
+    canonical = json.dumps([platform, _canonical(request)], sort_keys=True, separators=(",", ":"),
+                           ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def replay_as_sse(completion: Dict, include_usage: bool = True) -> Iterator[bytes]:
+    """Turn a cached chat.completion into the equivalent chat.completion.chunk stream.
+
+    With `include_usage`, the usage is sent in a final chunk without choices,
+    as for `stream_options.include_usage`.
+    """
+    template = ChunkTemplate(completion.get("id", ""), completion.get("model", ""),
+                             completion.get("created", int(time.time())))
+    for choice in completion.get("choices", []):
+        index = choice.get("index", 0)
+        message = choice.get("message", {})
+        delta = {k: v for k, v in message.items() if k != "content" and v is not None}
+        if "tool_calls" in delta:
+            delta["tool_calls"] = [dict(call, index=i) for i, call in enumerate(delta["tool_calls"])]
+        yield template.event([{"index": index, "delta": delta, "finish_reason": None}])
+        if message.get("content"):
+            yield template.content(message["content"], index)
+        yield template.finish(choice.get("finish_reason") or "stop", index)
+    if include_usage and completion.get("usage"):
+        yield template.event([], usage=completion["usage"])
+    yield codec.DONE
+
+
+def cached_response(value: bytes, stream: bool, include_usage: bool = False) -> Response:
+    headers = {CACHE_HEADER: "HIT"}
+    if stream:
+        return StreamingResponse(replay_as_sse(codec.loads(value), include_usage), media_type="text/event-stream",
+                                 headers=headers)
+    return Response(content=value, media_type="application/json", headers=headers)
+
+
+def _create_cache() -> Optional[ResponseCache]:
+    mode = os.environ.get("LLMPROXY_RESPONSE_CACHE", "off").lower()
+    max_bytes = env_int("LLMPROXY_RESPONSE_CACHE_BYTES", 64 * 1024 * 1024)
+    if mode == "memory":
+        backend = MemoryBackend(max_bytes)
+    elif mode == "sqlite":
+        backend = SQLiteBackend(os.environ.get("LLMPROXY_RESPONSE_CACHE_PATH", ".llmproxy-cache.sqlite3"),
+                                max_bytes)
+    else:
+        return None
+    return ResponseCache(backend, env_float("LLMPROXY_RESPONSE_CACHE_TTL", 3600))
+
+
+response_cache: Optional[ResponseCache] = _create_cache()
+
+
+def response_cache_stats() -> Dict:
+    return response_cache.stats() if response_cache else {"backend": "off"}
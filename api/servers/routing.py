@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+''' Latency-aware routing of one logical model across equivalent backends
+
+`POST /auto/chat/completions` takes a model alias and serves it from one of
+several (platform, model) backends, e.g. the same open-weights Llama on
+groq, cerebras, sambanova and nvidia:
+
+    LLMPROXY_MODEL_ALIASES='{"llama-3.3-70b": ["groq/llama-3.3-70b-versatile",
+                                               "cerebras/llama-3.3-70b",
+                                               "nvidia/meta/llama-3.3-70b-instruct"]}'
+
+Backends are ranked by expected completion time, i.e. the EWMA time to
+first token plus the request's `max_tokens` (or a default) at the EWMA
+decode rate, inflated by the EWMA error rate. Backends without measurements
+yet are tried first, and a small share of requests goes to a random backend
+so that estimates stay current. When a backend fails before anything was
+sent to the client (429, 5xx, auth errors, connection errors) the request
+fails over to the next one. Timeouts, throttling, 5xx and connection errors
+also put the backend on a short cooldown; auth errors do not, as they come
+from the caller's own key rather than the backend. The backend that
+served the request is named in `X-LLMProxy-Backend`.
+
+Every platform needs its own API key. The client sends them as
+`Authorization: Bearer groq=gsk_...,cerebras=csk-...`, or a proxy token
+listed in LLMPROXY_AUTO_KEYS ({"token": {"groq": "gsk_...", ...}}).
+Backends without a key are skipped.
+
+- LLMPROXY_MODEL_ALIASES: JSON alias -> list of "platform/model"
+- LLMPROXY_AUTO_KEYS: JSON proxy token -> {platform: key}
+- LLMPROXY_ROUTING_EXPLORE: share of requests sent to a random backend (default 0.05)
+'''
+from dataclasses import dataclass
+import json
+import os
+import random
+import re
+import time
+from typing import AsyncIterator, Dict, List, Optional
+from starlette.responses import Response, StreamingResponse
+from .config import env_float
+from .response_cache import CACHE_HEADER
+
+AUTO_PLATFORM = "auto"
+BACKEND_HEADER = "X-LLMProxy-Backend"
+# Statuses after which another backend is tried; others (400, 422) are the request's fault.
+FAILOVER_STATUSES = frozenset({401, 403, 404, 408, 409, 429})
+# Of those, the ones that say something about the backend's health rather than the caller's request or key.
+UNHEALTHY_STATUSES = frozenset({408, 429})
+
+# Weight of each new sample in the moving averages.
+EWMA_WEIGHT = 0.2
+MAX_COOLDOWN = 60.0
+
+_COMPLETION_TOKENS = re.compile(rb'"completion_tokens"\s*:\s*(\d+)')
+
+
+@dataclass
+class Backend:
+    platform: str
+    model: str
+    ttft: Optional[float] = None
+    tokens_per_second: Optional[float] = None
+    error_rate: float = 0.0
+    served: int = 0
+    failed: int = 0
+    consecutive_failures: int = 0
+    cooldown_until: float = 0.0
+
+    @property
+    def label(self) -> str:
+        return f"{self.platform}/{self.model}"
+
+    def expected_seconds(self, tokens: int) -> Optional[float]:
+        if self.ttft is None:
+            return None
+        seconds = self.ttft + (tokens / self.tokens_per_second if self.tokens_per_second else 0)
+        return seconds / (1 - min(self.error_rate, 0.9))
+
+    def stats(self) -> Dict:
+        return {
+            "ttft": self.ttft,
+            "tokens_per_second": self.tokens_per_second,
+            "error_rate": round(self.error_rate, 4),
+            "served": self.served,
+            "failed": self.failed,
+            "cooldown": max(0.0, self.cooldown_until - time.monotonic()),
+        }
+
+
+def _ewma(average: Optional[float], sample: float) -> float:
+    return sample if average is None else average + EWMA_WEIGHT * (sample - average)
+
+
+def should_fail_over(status_code: int) -> bool:
+    return status_code in FAILOVER_STATUSES or status_code >= 500
+
+
+def counts_against_backend(status_code: int) -> bool:
+    # Connection errors reach the router as 500s.
+    return status_code in UNHEALTHY_STATUSES or status_code >= 500
+
+
+class ModelRouter:
+    def __init__(self, aliases: Dict[str, List[str]], explore: float = 0.05):
+        self.explore = explore
+        self.aliases: Dict[str, List[Backend]] = {}
+        for alias, targets in aliases.items():
+            backends = []
+            for target in targets:
+                platform, _, model = target.partition("/")
+                backends.append(Backend(platform, model))
+            self.aliases[alias] = backends
+
+    def rank(self, alias: str, tokens: int, platforms) -> List[Backend]:
+        """Backends for `alias` on `platforms`, best first; cooling down ones last."""
+        now = time.monotonic()
+        backends = [b for b in self.aliases.get(alias, ()) if b.platform in platforms]
+
+        def score(backend: Backend):
+            expected = backend.expected_seconds(tokens)
+            # Unmeasured backends first, in configuration order.
+            return (backend.cooldown_until > now, -1.0 if expected is None else expected)
+
+        ranked = sorted(backends, key=score)
+        if len(ranked) > 1 and random.random() < self.explore:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+        return ranked
+
+    def record_success(self, backend: Backend, ttft: Optional[float], tokens: int, seconds: float):
+        """Record a served request: `ttft` for streams, or None with `seconds` the total time."""
+        backend.served += 1
+        backend.consecutive_failures = 0
+        backend.error_rate = _ewma(backend.error_rate, 0.0)
+        if ttft is None:
+            # A non-streamed answer arrives whole; attribute the decode time at the known rate.
+            decode = tokens / backend.tokens_per_second if backend.tokens_per_second and tokens else 0.0
+            backend.ttft = _ewma(backend.ttft, max(seconds - decode, 0.0))
+            return
+        backend.ttft = _ewma(backend.ttft, ttft)
+        if tokens > 1 and seconds > 0:
+            backend.tokens_per_second = _ewma(backend.tokens_per_second, tokens / seconds)
+
+    def record_failure(self, backend: Backend):
+        backend.failed += 1
+        backend.consecutive_failures += 1
+        backend.error_rate = _ewma(backend.error_rate, 1.0)
+        backend.cooldown_until = time.monotonic() + min(2.0 ** (backend.consecutive_failures - 1), MAX_COOLDOWN)
+
+    async def _watch_stream(self, backend: Backend, chunks: AsyncIterator, started: float) -> AsyncIterator:
+        first = None
+        events = 0
+        tokens = None
+        try:
+            async for chunk in chunks:
+                if first is None:
+                    first = time.perf_counter()
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                events += chunk.count(b"\n\n")
+                if b'"usage' in chunk:
+                    match = _COMPLETION_TOKENS.search(chunk)
+                    if match:
+                        tokens = int(match.group(1))
+                yield chunk
+        except Exception:
+            self.record_failure(backend)
+            raise
+        finally:
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+        if first is not None:
+            # Without usage, count content events (all but the final chunk and [DONE]).
+            self.record_success(backend, first - started, tokens if tokens is not None else max(events - 2, 0),
+                                time.perf_counter() - first)
+
+    def observe(self, backend: Backend, response: Response, started: float) -> Response:
+        """Tag `response` with its backend and feed its timing into the backend's estimates."""
+        response.headers[BACKEND_HEADER] = backend.label
+        if response.headers.get(CACHE_HEADER) in ("HIT", "SEMANTIC"):
+            # Served locally; says nothing about the backend.
+            return response
+        if isinstance(response, StreamingResponse):
+            response.body_iterator = self._watch_stream(backend, response.body_iterator, started)
+        else:
+            match = _COMPLETION_TOKENS.search(response.body)
+            self.record_success(backend, None, int(match.group(1)) if match else 0, time.perf_counter() - started)
+        return response
+
+    def stats(self) -> Dict:
+        return {alias: {backend.label: backend.stats() for backend in backends}
+                for alias, backends in self.aliases.items()}
+
+
+def _load_json(name: str) -> Dict:
+    raw = os.environ.get(name)
+    return json.loads(raw) if raw else {}
+
+
+model_router = ModelRouter(_load_json("LLMPROXY_MODEL_ALIASES"),
+                           explore=env_float("LLMPROXY_ROUTING_EXPLORE", 0.05))
+auto_keys: Dict[str, Dict[str, str]] = _load_json("LLMPROXY_AUTO_KEYS")
+
+
+def resolve_keys(token: str) -> Dict[str, str]:
+    """Per-platform API keys for a /auto request: a configured proxy token, or "platform=key,..." pairs."""
+    if token in auto_keys:
+        return auto_keys[token]
+    keys = {}
+    for pair in token.split(","):
+        platform, sep, key = pair.partition("=")
+        if sep and key:
+            keys[platform.strip()] = key.strip()
+    return keys
+
+
+def routing_stats() -> Dict:
+    return model_router.stats()
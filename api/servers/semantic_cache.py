@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+''' Semantic (embedding similarity) cache for chat completions
+
+Opt-in (LLMPROXY_SEMANTIC_CACHE=1). Complements the exact-match response
+cache: when that misses, the last user message is embedded and compared
+(cosine similarity) with earlier questions asked in the same context, i.e.
+by the same API key with the same platform, model, parameters and preceding
+messages. A match above the threshold returns the stored completion.
+
+The same requests qualify as for the exact cache (temperature 0, or
+`X-LLMProxy-Cache: force`; `bypass` and `refresh` apply too). Questions that
+carry images are not cached. Hits are marked with
+`X-LLMProxy-Cache: SEMANTIC` and `X-LLMProxy-Similarity`.
+
+The default embedder hashes words and character trigrams into a sparse
+vector, so it works offline with no model. Another embedder can be plugged in
+with LLMPROXY_SEMANTIC_EMBEDDER=module:factory; the factory returns an object
+with a `dim` attribute and an `embed(text)` method returning a dense sequence
+or a sparse {index: weight} dict. Search uses a NumPy matrix when NumPy is
+installed and sparse dot products otherwise.
+
+- LLMPROXY_SEMANTIC_CACHE: set to 1 to enable
+- LLMPROXY_SEMANTIC_THRESHOLD: minimum cosine similarity for a hit (default 0.9)
+- LLMPROXY_SEMANTIC_CACHE_ENTRIES: index size limit, LRU eviction (default 10000)
+- LLMPROXY_SEMANTIC_CACHE_TTL: entry lifetime in seconds (default 3600)
+- LLMPROXY_SEMANTIC_CACHE_AUDIT: set to 1 to keep the last hits (query, matched
+  question, similarity) at /stats/semantic-cache for false-hit review
+'''
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass
+import hashlib
+import importlib
+import math
+import os
+import re
+import time
+import zlib
+from typing import Any, Deque, Dict, List, Mapping, Optional, Sequence, Set, Tuple, Union
+from fastapi.responses import Response
+from .config import env_bool, env_float, env_int
+from .metrics import SEMANTIC_LOOKUPS, SEMANTIC_SIMILARITY
+from .response_cache import CACHE_HEADER, cache_key, cached_response, caller_id
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SIMILARITY_HEADER = "X-LLMProxy-Similarity"
+AUDIT_SIZE = 100
+
+SparseVector = Dict[int, float]
+
+_WORD = re.compile(r"\w+")
+_CJK = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+
+
+class HashingEmbedder:
+    """Feature-hashed bag of words and character trigrams, L2-normalised.
+
+    CJK runs, which have no spaces, contribute characters and character
+    bigrams instead of words.
+    """
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+
+    def _features(self, text: str) -> Counter:
+        features: Counter = Counter()
+        for word in _WORD.findall(text.lower()):
+            if _CJK.match(word):
+                features.update(word)
+                features.update(word[i:i + 2] for i in range(len(word) - 1))
+                continue
+            features[word] += 1
+            padded = f"<{word}>"
+            features.update(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def embed(self, text: str) -> SparseVector:
+        vector: SparseVector = {}
+        for feature, count in self._features(text).items():
+            h = zlib.crc32(feature.encode())
+            index = h % self.dim
+            weight = (1 + math.log(count)) * (1 if h & 0x80000000 else -1)
+            vector[index] = vector.get(index, 0.0) + weight
+        return _normalize(vector)
+
+
+def _normalize(vector: SparseVector) -> SparseVector:
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    return {i: v / norm for i, v in vector.items() if v} if norm else {}
+
+
+def _as_sparse(vector: Union[SparseVector, Sequence[float]]) -> SparseVector:
+    if isinstance(vector, dict):
+        return _normalize(vector)
+    return _normalize({i: float(v) for i, v in enumerate(vector) if v})
+
+
+class VectorIndex:
+    """Cosine similarity search among the vectors of one partition."""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self._slots: Dict[str, int] = {}
+        self._free: List[int] = []
+        self._partitions: Dict[int, Set[int]] = {}
+        self._slot_partition: Dict[int, int] = {}
+        if np is not None:
+            self._matrix = np.zeros((64, dim), dtype=np.float32)
+        else:
+            self._vectors: Dict[int, SparseVector] = {}
+        self._keys: Dict[int, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def add(self, key: str, partition: int, vector: SparseVector):
+        self.remove(key)
+        slot = self._free.pop() if self._free else len(self._slots)
+        if np is not None:
+            if slot >= len(self._matrix):
+                self._matrix = np.concatenate([self._matrix, np.zeros_like(self._matrix)])
+            row = self._matrix[slot]
+            row[:] = 0
+            row[list(vector)] = list(vector.values())
+        else:
+            self._vectors[slot] = vector
+        self._slots[key] = slot
+        self._keys[slot] = key
+        self._slot_partition[slot] = partition
+        self._partitions.setdefault(partition, set()).add(slot)
+
+    def remove(self, key: str):
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            return
+        del self._keys[slot]
+        partition = self._slot_partition.pop(slot)
+        members = self._partitions[partition]
+        members.discard(slot)
+        if not members:
+            del self._partitions[partition]
+        if np is None:
+            del self._vectors[slot]
+        self._free.append(slot)
+
+    def search(self, partition: int, vector: SparseVector) -> Tuple[Optional[str], float]:
+        """The most similar key in `partition` and its similarity."""
+        members = self._partitions.get(partition)
+        if not members or not vector:
+            return None, 0.0
+        slots = list(members)
+        if np is not None:
+            query = np.zeros(self.dim, dtype=np.float32)
+            query[list(vector)] = list(vector.values())
+            scores = self._matrix[slots] @ query
+            best = int(scores.argmax())
+            return self._keys[slots[best]], float(scores[best])
+        best_slot, best_score = None, -1.0
+        for slot in slots:
+            stored = self._vectors[slot]
+            score = sum(weight * stored.get(i, 0.0) for i, weight in vector.items())
+            if score > best_score:
+                best_slot, best_score = slot, score
+        return self._keys[best_slot], best_score
+
+
+@dataclass
+class SemanticQuery:
+    partition: int
+    text: str
+    vector: SparseVector
+    lookup: bool
+
+
+@dataclass
+class SemanticEntry:
+    text: str
+    value: bytes
+    expires: float
+
+
+def split_question(body: Mapping[str, Any]) -> Optional[Tuple[str, Dict]]:
+    """(last user message text, rest of the request), or None if it cannot be cached semantically."""
+    messages = body.get("messages")
+    if not isinstance(messages, list) or not messages:
+        return None
+    last = messages[-1]
+    if not isinstance(last, dict) or last.get("role") != "user":
+        return None
+    content = last.get("content")
+    if isinstance(content, list):
+        if any(not isinstance(part, dict) or part.get("type") != "text" for part in content):
+            return None
+        content = "\n".join(part.get("text") or "" for part in content)
+    if not isinstance(content, str) or not content.strip():
+        return None
+    return content, dict(body, messages=messages[:-1])
+
+
+class SemanticCache:
+    def __init__(self, embedder, threshold: float = 0.9, max_entries: int = 10000,
+                 ttl: float = 3600, audit: bool = False):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index = VectorIndex(embedder.dim)
+        self._entries: "OrderedDict[str, SemanticEntry]" = OrderedDict()
+        self.audit: Optional[Deque[Dict]] = deque(maxlen=AUDIT_SIZE) if audit else None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def query(self, platform: str, body: Mapping[str, Any], headers: Mapping[str, str],
+              api_key: str) -> Optional[SemanticQuery]:
+        """Embed the request's question, or None if this request must not use the cache."""
+        mode = headers.get(CACHE_HEADER, "").lower()
+        if mode == "bypass" or (mode != "force" and body.get("temperature") != 0):
+            return None
+        split = split_question(body)
+        if split is None:
+            return None
+        text, context = split
+        # Callers never see each other's entries, even for the same context.
+        scope = f"{caller_id(api_key)}:{cache_key(platform, context)}"
+        partition = int(hashlib.sha256(scope.encode()).hexdigest()[:15], 16)
+        return SemanticQuery(partition=partition, text=text, vector=_as_sparse(self.embedder.embed(text)),
+                             lookup=mode != "refresh")
+
+    def get(self, query: SemanticQuery) -> Optional[Tuple[bytes, float]]:
+        if not query.lookup:
+            return None
+        key, score = self.index.search(query.partition, query.vector)
+        if key is not None:
+            SEMANTIC_SIMILARITY.observe((), score)
+        entry = self._entries.get(key) if key is not None and score >= self.threshold else None
+        if entry is not None and time.time() >= entry.expires:
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            SEMANTIC_LOOKUPS.inc(("miss",))
+            return None
+        self.hits += 1
+        SEMANTIC_LOOKUPS.inc(("hit",))
+        self._entries.move_to_end(key)
+        if self.audit is not None:
+            self.audit.append({"at": int(time.time()), "similarity": round(score, 4),
+                               "query": query.text[:500], "matched": entry.text[:500]})
+        return entry.value, score
+
+    def set(self, query: SemanticQuery, value: bytes):
+        key = f"{query.partition:x}:{zlib.crc32(query.text.encode()):x}:{len(query.text)}"
+        self.index.add(key, query.partition, query.vector)
+        self._entries[key] = SemanticEntry(query.text, value, time.time() + self.ttl)
+        self._entries.move_to_end(key)
+        self.stores += 1
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        del self._entries[key]
+        self.index.remove(key)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        stats = {"enabled": True, "backend": "numpy" if np is not None else "python",
+                 "entries": len(self._entries), "max_entries": self.max_entries,
+                 "threshold": self.threshold, "hits": self.hits, "misses": self.misses,
+                 "stores": self.stores, "evictions": self.evictions,
+                 "hit_rate": self.hits / lookups if lookups else 0.0}
+        if self.audit is not None:
+            stats["recent_hits"] = list(self.audit)
+        return stats
+
+
+def semantic_response(value: bytes, similarity: float, stream: bool, include_usage: bool = False) -> Response:
+    response = cached_response(value, stream, include_usage)
+    response.headers[CACHE_HEADER] = "SEMANTIC"
+    response.headers[SIMILARITY_HEADER] = f"{similarity:.4f}"
+    return response
+
+
+def _load_embedder():
+    spec = os.environ.get("LLMPROXY_SEMANTIC_EMBEDDER")
+    if not spec:
+        return HashingEmbedder()
+    module, _, factory = spec.partition(":")
+    return getattr(importlib.import_module(module), factory)()
+
+
+def _create_cache() -> Optional[SemanticCache]:
+    if not env_bool("LLMPROXY_SEMANTIC_CACHE"):
+        return None
+    return SemanticCache(_load_embedder(),
+                         threshold=env_float("LLMPROXY_SEMANTIC_THRESHOLD", 0.9),
+                         max_entries=env_int("LLMPROXY_SEMANTIC_CACHE_ENTRIES", 10000),
+                         ttl=env_float("LLMPROXY_SEMANTIC_CACHE_TTL", 3600),
+                         audit=env_bool("LLMPROXY_SEMANTIC_CACHE_AUDIT"))
+
+
+semantic_cache: Optional[SemanticCache] = _create_cache()
+
+
+def semantic_cache_stats() -> Dict:
+    return semantic_cache.stats() if semantic_cache else {"enabled": False}
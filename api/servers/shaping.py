@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+''' Re-chunking of streamed chat completions
+
+Opt-in (LLMPROXY_STREAM_SHAPING=1). Some upstreams send one SSE event per
+token, and every event costs the client framing, a flush and a wakeup, which
+adds up on slow mobile connections. With shaping, consecutive events that only
+carry delta text for the same choice are merged into one
+chat.completion.chunk, which is sent once its text reaches
+LLMPROXY_STREAM_SHAPING_BYTES or once the oldest merged text has waited
+LLMPROXY_STREAM_SHAPING_INTERVAL, whichever comes first.
+
+The first delta text of a stream is always sent immediately so time to first
+token is unchanged. Every other event (role, tool calls, finish_reason, usage,
+`[DONE]`) ends the merge and is relayed as-is, after the text before it. A
+lone event is relayed byte for byte; merged events keep the first event's id,
+model and other fields.
+
+- LLMPROXY_STREAM_SHAPING: set to 1 to enable
+- LLMPROXY_STREAM_SHAPING_BYTES: merged delta text that triggers a send (default 256)
+- LLMPROXY_STREAM_SHAPING_INTERVAL: longest hold of merged text in seconds (default 0.02)
+'''
+import asyncio
+import re
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from . import codec
+from .config import env_bool, env_float, env_int
+
+SHAPING = env_bool("LLMPROXY_STREAM_SHAPING")
+SHAPING_BYTES = env_int("LLMPROXY_STREAM_SHAPING_BYTES", 256)
+SHAPING_INTERVAL = env_float("LLMPROXY_STREAM_SHAPING_INTERVAL", 0.02)
+
+_EVENT_END = re.compile(rb"\r?\n\r?\n")
+# Fields that may accompany mergeable delta text as long as they are null.
+_CHOICE_FIELDS = frozenset({"index", "delta", "finish_reason"})
+_DELTA_FIELDS = frozenset({"content", "role"})
+
+
+def text_delta(event: bytes) -> Optional[Tuple[Dict, str]]:
+    """(chunk, text) if the SSE `event` only carries delta text for one choice, else None."""
+    line = event.strip()
+    if not line.startswith(b"data:") or b"\n" in line or b'"content"' not in line:
+        return None
+    try:
+        chunk = codec.loads(line[5:])
+    except ValueError:
+        return None
+    if not isinstance(chunk, dict) or chunk.get("usage") is not None:
+        return None
+    choices = chunk.get("choices")
+    if not isinstance(choices, list) or len(choices) != 1 or not isinstance(choices[0], dict):
+        return None
+    choice = choices[0]
+    delta = choice.get("delta")
+    if not isinstance(delta, dict) or choice.get("finish_reason") is not None:
+        return None
+    text = delta.get("content")
+    if not isinstance(text, str) or not text:
+        return None
+    if any(value is not None for key, value in choice.items() if key not in _CHOICE_FIELDS):
+        return None
+    if any(value is not None for key, value in delta.items() if key not in _DELTA_FIELDS):
+        return None
+    return chunk, text
+
+
+def _merge_key(chunk: Dict) -> Tuple:
+    choice = chunk["choices"][0]
+    return chunk.get("id"), choice.get("index"), choice["delta"].get("role")
+
+
+class EventShaper:
+    """Merges SSE events of one stream; the caller supplies the clock."""
+
+    def __init__(self, max_bytes: int = SHAPING_BYTES, interval: float = SHAPING_INTERVAL):
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.deadline: Optional[float] = None
+        self._buffer = b""
+        # (chunk, raw event, text) waiting to be merged
+        self._pending: List[Tuple[Dict, bytes, str]] = []
+        self._pending_bytes = 0
+        self._first_sent = False
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._pending)
+
+    def feed(self, data: bytes, now: float) -> List[bytes]:
+        """Take upstream bytes; returns the events to send now."""
+        self._buffer += data
+        out: List[bytes] = []
+        while True:
+            end = _EVENT_END.search(self._buffer)
+            if end is None:
+                return out
+            event, self._buffer = self._buffer[:end.end()], self._buffer[end.end():]
+            self._event(event, now, out)
+
+    def _event(self, event: bytes, now: float, out: List[bytes]):
+        delta = text_delta(event)
+        if delta is None or not self._first_sent:
+            self._flush_into(out)
+            self._first_sent = self._first_sent or delta is not None
+            out.append(event)
+            return
+        chunk, text = delta
+        if self._pending and _merge_key(chunk) != _merge_key(self._pending[0][0]):
+            self._flush_into(out)
+        if not self._pending:
+            self.deadline = now + self.interval
+        self._pending.append((chunk, event, text))
+        self._pending_bytes += len(text.encode())
+        if self._pending_bytes >= self.max_bytes or now >= self.deadline:
+            self._flush_into(out)
+
+    def flush(self) -> List[bytes]:
+        """Send the merged text now, e.g. because its deadline passed."""
+        out: List[bytes] = []
+        self._flush_into(out)
+        return out
+
+    def _flush_into(self, out: List[bytes]):
+        if not self._pending:
+            return
+        if len(self._pending) == 1:
+            out.append(self._pending[0][1])
+        else:
+            chunk = self._pending[0][0]
+            choice = chunk["choices"][0]
+            merged = dict(choice, delta=dict(choice["delta"], content="".join(text for _, _, text in self._pending)))
+            out.append(b"data: " + codec.dumps(dict(chunk, choices=[merged])) + b"\n\n")
+        self._pending = []
+        self._pending_bytes = 0
+        self.deadline = None
+
+    def close(self) -> List[bytes]:
+        """Everything still held at the end of the stream, including a trailing partial event."""
+        out = self.flush()
+        if self._buffer:
+            out.append(self._buffer)
+            self._buffer = b""
+        return out
+
+
+async def _shape(chunks: AsyncIterator[bytes], shaper: EventShaper) -> AsyncIterator[bytes]:
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    # Read of the next chunk that outlives a deadline, so held text goes out while upstream is quiet.
+    reading: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if reading is None and not shaper.pending:
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                if reading is None:
+                    reading = asyncio.ensure_future(iterator.__anext__())
+                timeout = max(shaper.deadline - loop.time(), 0) if shaper.pending else None
+                done, _ = await asyncio.wait((reading,), timeout=timeout)
+                if not done:
+                    for event in shaper.flush():
+                        yield event
+                    continue
+                finished, reading = reading, None
+                try:
+                    chunk = finished.result()
+                except StopAsyncIteration:
+                    break
+            for event in shaper.feed(chunk if isinstance(chunk, bytes) else chunk.encode(), loop.time()):
+                yield event
+        for event in shaper.close():
+            yield event
+    finally:
+        if reading is not None:
+            reading.cancel()
+            await asyncio.gather(reading, return_exceptions=True)
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+
+
+def shape_stream(chunks: AsyncIterator[bytes], enabled: Optional[bool] = None) -> AsyncIterator[bytes]:
+    """`chunks` re-chunked by an EventShaper, or unchanged when shaping is off."""
+    if not (SHAPING if enabled is None else enabled):
+        return chunks
+    return _shape(chunks, EventShaper())
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+''' In-flight request coalescing ("singleflight")
+
+Identical deterministic requests that arrive while one is already in flight
+attach to that upstream call instead of making their own. Non-streaming
+callers share the result; streaming callers subscribe to a fan-out of the same
+SSE chunks, and late joiners first replay what has been buffered so far.
+
+The upstream call runs in its own task, so one caller disconnecting does not
+cancel it for the others; a stream is cancelled once its last subscriber
+leaves. The producer pauses while the slowest subscriber is more than
+`max_lag` chunks behind, so a slow client holds back the upstream rather than
+letting the buffer grow.
+
+- LLMPROXY_COALESCE: set to 0 to disable (default on)
+'''
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+from .config import env_bool
+from .base import STREAM_BUFFER, wants_usage
+from .response_cache import cache_key, caller_id
+
+T = TypeVar("T")
+
+COALESCE = env_bool("LLMPROXY_COALESCE", True)
+
+
+class StreamFlight:
+    def __init__(self):
+        self.opened: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.chunks: List[bytes] = []
+        self.finished = False
+        self.subscribers = 0
+        # subscriber -> chunks it has consumed
+        self.positions: Dict[object, int] = {}
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+        # Raised to subscribers after the last chunk when the upstream failed mid-stream.
+        self.error: Optional[Exception] = None
+
+
+class SingleFlight:
+    def __init__(self, max_lag: int = STREAM_BUFFER):
+        self.max_lag = max_lag
+        self._calls: Dict[str, asyncio.Future] = {}
+        self._streams: Dict[str, StreamFlight] = {}
+        self.leaders = 0
+        self.joined = 0
+
+    async def call(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """Run `fn` once for all concurrent callers with the same `key`."""
+        future = self._calls.get(key)
+        if future is None:
+            self.leaders += 1
+            future = self._calls[key] = asyncio.ensure_future(fn())
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.joined += 1
+        return await asyncio.shield(future)
+
+    async def stream(self, key: str,
+                     open_stream: Callable[[], Awaitable[AsyncIterator[bytes]]]) -> "Subscription":
+        """Subscribe to the stream for `key`, opening it with `open_stream` if none is in flight.
+
+        Errors raised while opening (e.g. an upstream HTTP error) propagate to
+        every caller waiting for that flight; errors after that are raised by
+        each subscription once it has read the chunks before them. The caller
+        counts as a subscriber from the start, and must iterate or `aclose`
+        the returned subscription.
+        """
+        flight = self._streams.get(key)
+        if flight is None:
+            self.leaders += 1
+            flight = self._streams[key] = StreamFlight()
+            flight.task = asyncio.ensure_future(self._produce(key, flight, open_stream))
+        else:
+            self.joined += 1
+        subscription = Subscription(self, flight)
+        try:
+            await asyncio.shield(flight.opened)
+        except BaseException:
+            subscription.unsubscribe()
+            raise
+        return subscription
+
+    async def _produce(self, key: str, flight: StreamFlight,
+                       open_stream: Callable[[], Awaitable[AsyncIterator[bytes]]]):
+        chunks = None
+        try:
+            chunks = await open_stream()
+            flight.opened.set_result(None)
+            async for chunk in chunks:
+                async with flight.changed:
+                    await flight.changed.wait_for(lambda: self._lag(flight) < self.max_lag)
+                    flight.chunks.append(chunk)
+                    flight.changed.notify_all()
+        except BaseException as e:
+            if not flight.opened.done():
+                flight.opened.set_exception(e)
+            elif isinstance(e, Exception):
+                flight.error = e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            if self._streams.get(key) is flight:
+                del self._streams[key]
+            flight.finished = True
+            async with flight.changed:
+                flight.changed.notify_all()
+            if chunks is not None and hasattr(chunks, "aclose"):
+                await chunks.aclose()
+
+    @staticmethod
+    def _lag(flight: StreamFlight) -> int:
+        # Subscribers that have not started reading yet count as being at the start.
+        return len(flight.chunks) - min(flight.positions.values(), default=0)
+
+    @staticmethod
+    async def _notify(flight: StreamFlight):
+        async with flight.changed:
+            flight.changed.notify_all()
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": COALESCE,
+            "in_flight": len(self._calls) + len(self._streams),
+            "leaders": self.leaders,
+            "joined": self.joined,
+        }
+
+
+class Subscription:
+    """One caller's view of a StreamFlight, replaying from its first chunk.
+
+    Leaving (end of stream, error or `aclose`, even before the first read)
+    cancels the flight when no subscribers remain.
+    """
+
+    def __init__(self, flights: SingleFlight, flight: StreamFlight):
+        self._flights = flights
+        self._flight = flight
+        self._token: Optional[object] = object()
+        flight.subscribers += 1
+        flight.positions[self._token] = 0
+        self._chunks = self._iterate()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        try:
+            return await self._chunks.__anext__()
+        except BaseException:
+            self.unsubscribe()
+            raise
+
+    async def _iterate(self) -> AsyncIterator[bytes]:
+        flight = self._flight
+        position = 0
+        while True:
+            if position == len(flight.chunks):
+                if flight.finished:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                async with flight.changed:
+                    await flight.changed.wait_for(lambda: position < len(flight.chunks) or flight.finished)
+            end = len(flight.chunks)
+            for chunk in flight.chunks[position:end]:
+                yield chunk
+            position = flight.positions[self._token] = end
+            async with flight.changed:
+                flight.changed.notify_all()
+
+    def unsubscribe(self):
+        if self._token is None:
+            return
+        flight = self._flight
+        flight.subscribers -= 1
+        del flight.positions[self._token]
+        self._token = None
+        if flight.finished:
+            return
+        if flight.subscribers == 0:
+            if flight.task is not None:
+                flight.task.cancel()
+        else:
+            # The slowest subscriber may have left; let a paused producer recheck.
+            asyncio.ensure_future(self._flights._notify(flight))
+
+    async def aclose(self):
+        try:
+            await self._chunks.aclose()
+        finally:
+            self.unsubscribe()
+
+    def __del__(self):
+        try:
+            self.unsubscribe()
+        except RuntimeError:
+            # No event loop left to notify the producer on.
+            pass
+
+
+singleflight = SingleFlight()
+
+
+def coalesce_key(platform: str, body: Dict, api_key: str, stream: bool) -> Optional[str]:
+    """Key under which a request may be coalesced, or None if it is not deterministic."""
+    if not COALESCE or body.get("temperature") != 0:
+        return None
+    caller = caller_id(api_key)
+    # Streams with and without a usage chunk are different byte streams.
+    transport = ("stream+usage" if wants_usage(body) else "stream") if stream else "json"
+    return f"{transport}:{caller}:{cache_key(platform, body)}"
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+''' Local token count estimation
+
+Used when an upstream leaves out token usage, and to charge prompts against
+rate limits before they are sent. This is an approximation of a
+BPE tokenizer, not a tokenizer: each CJK character counts as one token, and
+other text counts the larger of its word/punctuation pieces and one token per
+four characters. Results for whole texts are memoized, so repeated messages
+across a multi-turn conversation are counted once.
+'''
+from functools import lru_cache
+import re
+from typing import Any, Dict, List, Optional, Union
+
+_CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_CJK = re.compile(f"[{_CJK_RANGES}]")
+# Runs of non-CJK word characters, and single punctuation marks.
+_PIECE = re.compile(f"[^\\W{_CJK_RANGES}]+|[^\\w\\s]")
+_SPACE = re.compile(r"\s+")
+
+# Per-message framing and reply priming, as in OpenAI's chat format accounting.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+# Gemini bills every image as a fixed 258 tokens.
+TOKENS_PER_IMAGE = 258
+
+
+@lru_cache(maxsize=4096)
+def _estimate(text: str) -> int:
+    cjk = len(_CJK.findall(text))
+    pieces = len(_PIECE.findall(text))
+    chars = len(_SPACE.sub("", text)) - cjk
+    return cjk + max(pieces, (chars + 3) // 4)
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate number of tokens in `text`."""
+    if not text:
+        return 0
+    # Only cache texts that are likely to repeat (messages, not stream deltas).
+    if len(text) < 64:
+        return _estimate.__wrapped__(text)
+    return _estimate(text)
+
+
+def _field(obj: Any, name: str) -> Any:
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+def estimate_message_tokens(messages: List) -> int:
+    """Approximate prompt tokens of OpenAI-style messages, as `Message`s or decoded JSON dicts."""
+    total = TOKENS_PER_REPLY
+    for message in messages:
+        content: Union[str, List, None] = _field(message, "content")
+        total += TOKENS_PER_MESSAGE + estimate_tokens(_field(message, "role") or "")
+        for call in _field(message, "tool_calls") or ():
+            function = _field(call, "function")
+            if function is not None:
+                total += (estimate_tokens(_field(function, "name") or "")
+                          + estimate_tokens(_field(function, "arguments") or ""))
+        if content is None:
+            continue
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+            continue
+        for part in content:
+            kind = _field(part, "type")
+            if kind == "text":
+                total += estimate_tokens(_field(part, "text") or "")
+            elif kind == "image_url":
+                total += TOKENS_PER_IMAGE
+    return total
+
+
+def estimate_prompt_tokens(body: Optional[Dict]) -> int:
+    """Approximate prompt tokens of a decoded chat completion request body (0 if it has no messages)."""
+    messages = body.get("messages") if isinstance(body, dict) else None
+    return estimate_message_tokens(messages) if isinstance(messages, list) else 0
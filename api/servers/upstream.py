@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+''' Upstream endpoint pools with retries, failover and hedged requests
+
+Each platform gets a pool of one or more endpoints. A request is retried on
+another endpoint (with jittered exponential backoff) when it fails before the
+upstream has sent response headers, i.e. before anything was streamed to the
+client, and the upstream cannot have processed it: connection errors, connect
+and pool timeouts, and 429/5xx responses. Read/write timeouts and dropped
+connections after the request was sent are not retried, since chat
+completions are not idempotent and the upstream may already bill for them. Optionally, a
+hedged second attempt is fired when the first one has not answered within
+the pool's observed p95 time-to-first-byte.
+
+Configured through environment variables:
+- LLMPROXY_UPSTREAMS: JSON mapping platform -> list of endpoints, each either
+  a URL or {"url": ..., "weight": ...}. Platforms not listed use their
+  built-in URL. Gemini endpoints are API base URLs, e.g.
+  {"gemini": ["https://generativelanguage.googleapis.com/v1beta"]}
+- LLMPROXY_UPSTREAM_RETRIES: retries after the first attempt (default 2)
+- LLMPROXY_BACKOFF_BASE / LLMPROXY_BACKOFF_MAX: backoff in seconds (0.2 / 2)
+- LLMPROXY_HEDGE: set to 1 to enable hedged requests
+- LLMPROXY_HEDGE_QUANTILE: TTFB quantile used as hedge deadline (0.95)
+'''
+from collections import deque
+from dataclasses import dataclass
+from loguru import logger
+import asyncio
+import httpx
+import json
+import os
+import random
+import time
+from typing import Callable, Collection, Deque, Dict, List, Optional, Set
+from .config import env_bool, env_float, env_int
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Failures where the request never reached the upstream.
+RETRY_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Samples needed before the TTFB quantile is trusted as a hedge deadline.
+HEDGE_MIN_SAMPLES = 20
+
+
+@dataclass
+class Endpoint:
+    url: str
+    weight: float = 1.0
+    failures: int = 0
+    cooldown_until: float = 0.0
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def mark_failure(self):
+        self.failures += 1
+        self.cooldown_until = time.monotonic() + min(0.5 * 2 ** (self.failures - 1), 30)
+
+    def mark_success(self):
+        self.failures = 0
+        self.cooldown_until = 0.0
+
+
+class UpstreamPool:
+    def __init__(self,
+                 platform: str,
+                 endpoints: List[Endpoint],
+                 retries: int = 2,
+                 backoff_base: float = 0.2,
+                 backoff_max: float = 2.0,
+                 hedge: bool = False,
+                 hedge_quantile: float = 0.95):
+        self.platform = platform
+        self.endpoints = endpoints
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self._ttfb: Deque[float] = deque(maxlen=512)
+        self.attempts = 0
+        self.retried = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def choose(self, exclude: Set[str] = frozenset()) -> Endpoint:
+        """Weighted random choice among endpoints not cooling down, preferring untried ones."""
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e.url not in exclude and e.available(now)] \
+            or [e for e in self.endpoints if e.available(now)] \
+            or self.endpoints
+        return random.choices(candidates, weights=[e.weight for e in candidates])[0]
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self._ttfb) < HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self._ttfb)
+        return samples[min(int(len(samples) * self.hedge_quantile), len(samples) - 1)]
+
+    def backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> Optional[float]:
+        """Full-jitter backoff, or None if the upstream asked us to wait longer than backoff_max."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                return delay
+            if wait > self.backoff_max:
+                return None
+            delay = max(delay, wait)
+        return delay
+
+    async def _attempt(self, client: httpx.AsyncClient, build_request: Callable[[str], httpx.Request],
+                       endpoint: Endpoint, retry_statuses: Collection[int]) -> httpx.Response:
+        self.attempts += 1
+        started = time.monotonic()
+        try:
+            response = await client.send(build_request(endpoint.url), stream=True)
+        except httpx.TransportError:
+            endpoint.mark_failure()
+            raise
+        if response.status_code in retry_statuses:
+            endpoint.mark_failure()
+        else:
+            endpoint.mark_success()
+            self._ttfb.append(time.monotonic() - started)
+        return response
+
+    async def _hedged_attempt(self, client: httpx.AsyncClient, build_request: Callable[[str], httpx.Request],
+                              tried: Set[str], retry_statuses: Collection[int]) -> httpx.Response:
+        endpoint = self.choose(tried)
+        tried.add(endpoint.url)
+        attempts = [asyncio.ensure_future(self._attempt(client, build_request, endpoint, retry_statuses))]
+        # The attempt whose outcome is returned; every other one is cancelled or closed.
+        winner: Optional[asyncio.Future] = None
+        try:
+            delay = self.hedge_delay()
+            if delay is None or (await asyncio.wait(attempts, timeout=delay))[0]:
+                response = await attempts[0]
+                winner = attempts[0]
+                return response
+
+            self.hedged += 1
+            endpoint = self.choose(tried)
+            tried.add(endpoint.url)
+            attempts.append(asyncio.ensure_future(self._attempt(client, build_request, endpoint, retry_statuses)))
+            pending = set(attempts)
+            fallback: Optional[asyncio.Future] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result().status_code not in retry_statuses:
+                        if task is attempts[1]:
+                            self.hedge_wins += 1
+                        winner = task
+                        return task.result()
+                    if fallback is None:
+                        fallback = task
+            winner = fallback
+            return fallback.result()
+        finally:
+            for task in attempts:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                    task.add_done_callback(_close_orphan)
+                else:
+                    _close_orphan(task)
+
+    async def send(self, client: httpx.AsyncClient,
+                   build_request: Callable[[str], httpx.Request],
+                   retry_statuses: Collection[int] = RETRY_STATUSES) -> httpx.Response:
+        """Send a request built by `build_request(endpoint_url)`, retrying across endpoints.
+
+        Returns once response headers have arrived, with the body unread; the
+        caller must consume or `aclose()` it. When every attempt fails, the
+        last error response is returned or the last transport error raised.
+        Callers that handle some statuses themselves (e.g. 429 with another
+        API key) can narrow `retry_statuses`.
+        """
+        tried: Set[str] = set()
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                response = await self._hedged_attempt(client, build_request, tried, retry_statuses)
+            except RETRY_EXCEPTIONS as e:
+                if last_attempt:
+                    raise
+                logger.warning(f"{self.platform} upstream error ({e!r}), retrying")
+                delay = self.backoff(attempt)
+            else:
+                if response.status_code not in retry_statuses or last_attempt:
+                    return response
+                delay = self.backoff(attempt, response)
+                if delay is None:
+                    return response
+                logger.warning(f"{self.platform} upstream returned {response.status_code}, retrying")
+                await response.aclose()
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict:
+        return {
+            "endpoints": [{"url": e.url, "weight": e.weight, "failures": e.failures,
+                           "cooling_down": not e.available(time.monotonic())} for e in self.endpoints],
+            "attempts": self.attempts,
+            "retried": self.retried,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "hedge_delay": self.hedge_delay(),
+        }
+
+
+def _close_orphan(task: asyncio.Future):
+    """Close the response of an attempt that lost a hedge or was abandoned."""
+    if task.cancelled() or task.exception() is not None:
+        return
+    asyncio.ensure_future(task.result().aclose())
+
+
+def _configured_endpoints() -> Dict[str, List[Endpoint]]:
+    raw = os.environ.get("LLMPROXY_UPSTREAMS")
+    if not raw:
+        return {}
+    configured = {}
+    for platform, entries in json.loads(raw).items():
+        configured[platform] = [
+            Endpoint(url=e) if isinstance(e, str) else Endpoint(url=e["url"], weight=float(e.get("weight", 1)))
+            for e in entries
+        ]
+    return configured
+
+
+_CONFIGURED = _configured_endpoints()
+_pools: Dict[str, UpstreamPool] = {}
+
+
+def get_pool(platform: str, default_url: str) -> UpstreamPool:
+    """Return the pool for `platform`, built from LLMPROXY_UPSTREAMS or `default_url`."""
+    pool = _pools.get(platform)
+    if pool is None:
+        pool = _pools[platform] = UpstreamPool(
+            platform,
+            _CONFIGURED.get(platform) or [Endpoint(url=default_url)],
+            retries=env_int("LLMPROXY_UPSTREAM_RETRIES", 2),
+            backoff_base=env_float("LLMPROXY_BACKOFF_BASE", 0.2),
+            backoff_max=env_float("LLMPROXY_BACKOFF_MAX", 2.0),
+            hedge=env_bool("LLMPROXY_HEDGE"),
+            hedge_quantile=env_float("LLMPROXY_HEDGE_QUANTILE", 0.95),
+        )
+    return pool
+
+
+def pool_stats() -> Dict[str, Dict]:
+    return {platform: pool.stats() for platform, pool in _pools.items()}
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+''' Load test: proxy overhead against a local mock upstream
+
+Starts benchmarks/mock_upstream.py and `main:app` under uvicorn, points the
+proxy at the mock through LLMPROXY_UPSTREAMS, and runs the same load once
+directly against the mock and once through the proxy, for OpenAI-compatible
+and Gemini requests, streaming and non-streaming. Reported per scenario:
+
+- throughput (requests/s and completion tokens/s through the proxy)
+- added latency at p50/p95/p99 (proxy minus direct, total request time)
+- TTFT overhead (median time to first streamed chunk, proxy minus direct)
+- proxy memory per concurrent stream (peak RSS growth / concurrency)
+- proxy CPU time per completion token
+
+    python benchmarks/bench_proxy.py [--requests 300] [--concurrency 20] [--save-baseline]
+
+Results are compared with benchmarks/baseline.json when it exists; the exit
+status is 1 if a metric regressed by more than `--tolerance`. Memory and CPU
+are read from /proc and reported as null on other systems. The load
+generator shares the machine with the proxy, so compare runs on the same host.
+'''
+import argparse
+import asyncio
+from dataclasses import dataclass
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from benchmarks.mock_upstream import MockConfig, add_arguments, config_from_args  # noqa: E402
+
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+MODEL = "mock-model"
+MESSAGES = [{"role": "user", "content": "Write a short story about a proxy server."}]
+
+# scenario -> (platform, stream)
+SCENARIOS: Dict[str, Tuple[str, bool]] = {
+    "openai-stream": ("openai", True),
+    "openai-json": ("openai", False),
+    "gemini-stream": ("gemini", True),
+    "gemini-json": ("gemini", False),
+}
+
+# metric -> (higher is better, absolute change always tolerated)
+METRICS: Dict[str, Tuple[bool, float]] = {
+    "requests_per_s": (True, 0.0),
+    "added_latency_p50_ms": (False, 10.0),
+    "added_latency_p95_ms": (False, 20.0),
+    "added_latency_p99_ms": (False, 40.0),
+    "ttft_overhead_ms": (False, 10.0),
+    "memory_per_stream_kb": (False, 64.0),
+    "cpu_us_per_token": (False, 5.0),
+}
+
+
+@dataclass
+class Sample:
+    ok: bool
+    latency: float
+    ttft: Optional[float]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_kb(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    # utime and stime are fields 14 and 15 of stat(5), counted after the command name.
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def start_server(args: List[str], port: int, env: Dict[str, str], ready_path: str) -> subprocess.Popen:
+    process = subprocess.Popen([sys.executable] + args, cwd=ROOT, env=dict(os.environ, **env))
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{' '.join(args)} exited with {process.returncode}")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}{ready_path}", timeout=1)
+            return process
+        except httpx.TransportError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{' '.join(args)} did not start")
+
+
+def proxy_request(base: str, platform: str, stream: bool, max_tokens: int) -> Tuple[str, Dict]:
+    path = "/gemini/chat/completions" if platform == "gemini" else f"/{platform}/chat/completions"
+    return base + path, {"model": MODEL, "messages": MESSAGES, "stream": stream,
+                         "temperature": 0.7, "max_tokens": max_tokens}
+
+
+def direct_request(base: str, platform: str, stream: bool, max_tokens: int) -> Tuple[str, Dict]:
+    if platform == "gemini":
+        method = "streamGenerateContent?alt=sse" if stream else "generateContent"
+        return f"{base}/v1beta/models/{MODEL}:{method}", {
+            "contents": [{"role": "user", "parts": [{"text": MESSAGES[0]["content"]}]}],
+            "generationConfig": {"temperature": 0.7, "maxOutputTokens": max_tokens}}
+    return f"{base}/v1/chat/completions", {"model": MODEL, "messages": MESSAGES, "stream": stream,
+                                           "temperature": 0.7, "max_tokens": max_tokens}
+
+
+async def send(client: httpx.AsyncClient, url: str, body: Dict, stream: bool) -> Sample:
+    started = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", url, json=body, headers={"Authorization": "Bearer mock-key"}) as response:
+        async for chunk in response.aiter_raw():
+            if ttft is None and chunk:
+                ttft = time.perf_counter() - started
+        ok = response.status_code == 200
+    return Sample(ok, time.perf_counter() - started, ttft if stream else None)
+
+
+async def run_load(url: str, body: Dict, stream: bool, requests: int, concurrency: int,
+                   on_tick: Optional[Callable[[], None]] = None) -> Tuple[List[Sample], float]:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        for _ in range(min(concurrency, 5)):
+            await send(client, url, body, stream)
+        remaining = iter(range(requests))
+        samples: List[Sample] = []
+
+        async def worker():
+            for _ in remaining:
+                samples.append(await send(client, url, body, stream))
+
+        async def sampler():
+            while True:
+                on_tick()
+                await asyncio.sleep(0.02)
+
+        ticker = asyncio.ensure_future(sampler()) if on_tick else None
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        if ticker:
+            ticker.cancel()
+    return samples, elapsed
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def run_scenario(name: str, proxy_base: str, mock_base: str, proxy_pid: int, args) -> Dict:
+    platform, stream = SCENARIOS[name]
+    tokens = args.completion_tokens
+    url, body = direct_request(mock_base, platform, stream, tokens)
+    direct, _ = asyncio.run(run_load(url, body, stream, args.requests, args.concurrency))
+
+    idle_rss = rss_kb(proxy_pid)
+    peak_rss = [idle_rss]
+    cpu_before = cpu_seconds(proxy_pid)
+    url, body = proxy_request(proxy_base, platform, stream, tokens)
+    proxied, elapsed = asyncio.run(run_load(
+        url, body, stream, args.requests, args.concurrency,
+        on_tick=lambda: peak_rss.append(rss_kb(proxy_pid)) if idle_rss is not None else None))
+    cpu_after = cpu_seconds(proxy_pid)
+
+    direct_ok = [s for s in direct if s.ok]
+    proxied_ok = [s for s in proxied if s.ok]
+    result = {
+        "requests": len(proxied),
+        "errors": len(proxied) - len(proxied_ok),
+        "requests_per_s": round(len(proxied_ok) / elapsed, 2),
+        "tokens_per_s": round(len(proxied_ok) * tokens / elapsed, 1),
+    }
+    if not direct_ok or not proxied_ok:
+        return result
+    for q in (0.5, 0.95, 0.99):
+        added = (percentile([s.latency for s in proxied_ok], q) - percentile([s.latency for s in direct_ok], q))
+        result[f"added_latency_p{round(q * 100)}_ms"] = round(added * 1000, 2)
+    if stream:
+        result["ttft_overhead_ms"] = round((statistics.median(s.ttft for s in proxied_ok if s.ttft)
+                                            - statistics.median(s.ttft for s in direct_ok if s.ttft)) * 1000, 2)
+        if idle_rss is not None:
+            result["memory_per_stream_kb"] = round((max(peak_rss) - idle_rss) / args.concurrency, 1)
+    if cpu_before is not None and cpu_after is not None:
+        result["cpu_us_per_token"] = round((cpu_after - cpu_before) / (len(proxied_ok) * tokens) * 1e6, 2)
+    return result
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    """Lines describing every metric that got worse than the baseline by more than `tolerance`."""
+    regressions = []
+    for scenario, metrics in results.items():
+        for metric, value in metrics.items():
+            before = baseline.get(scenario, {}).get(metric)
+            if metric not in METRICS or before is None:
+                continue
+            higher_is_better, slack = METRICS[metric]
+            allowed = max(abs(before) * tolerance, slack)
+            worse = before - value if higher_is_better else value - before
+            if worse > allowed:
+                regressions.append(f"{scenario} {metric}: {before} -> {value}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=300, help="requests per scenario and target")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--proxy-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the proxy, e.g. LLMPROXY_SSE_PASSTHROUGH=0")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    add_arguments(parser)
+    parser.set_defaults(tokens_per_second=500, tokens_per_chunk=2, completion_tokens=100,
+                        latency="fixed:0.02")
+    args = parser.parse_args()
+    config: MockConfig = config_from_args(args)
+
+    mock_port, proxy_port = free_port(), free_port()
+    mock_base = f"http://127.0.0.1:{mock_port}"
+    proxy_base = f"http://127.0.0.1:{proxy_port}"
+    mock_args = ["benchmarks/mock_upstream.py", "--port", str(mock_port),
+                 "--tokens-per-second", str(config.tokens_per_second),
+                 "--tokens-per-chunk", str(config.tokens_per_chunk),
+                 "--completion-tokens", str(config.completion_tokens), "--latency", config.latency,
+                 "--error-rate", str(config.error_rate), "--error-status", str(config.error_status),
+                 "--seed", str(config.seed)]
+    with tempfile.TemporaryDirectory() as jobs_dir:
+        proxy_env = {
+            "LLMPROXY_UPSTREAMS": json.dumps({"openai": [f"{mock_base}/v1/chat/completions"],
+                                              "gemini": [f"{mock_base}/v1beta"]}),
+            # Injected errors should reach the client rather than be retried away.
+            "LLMPROXY_UPSTREAM_RETRIES": "0",
+            "LLMPROXY_JOBS_DIR": jobs_dir,
+        }
+        proxy_env.update(item.split("=", 1) for item in args.proxy_env)
+        mock = start_server(mock_args, mock_port, {}, "/health")
+        proxy = None
+        try:
+            proxy = start_server(["-m", "uvicorn", "main:app", "--port", str(proxy_port), "--log-level", "warning"],
+                                 proxy_port, proxy_env, "/hello/")
+            results = {}
+            for name in args.scenarios.split(","):
+                results[name] = run_scenario(name, proxy_base, mock_base, proxy.pid, args)
+                print(f"{name:>14}: " + "  ".join(f"{k}={v}" for k, v in results[name].items()))
+        finally:
+            for process in (proxy, mock):
+                if process is not None:
+                    process.terminate()
+                    process.wait()
+
+    report = {"config": {"requests": args.requests, "concurrency": args.concurrency, **config.__dict__},
+              "results": results}
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("config") != report["config"]:
+        print("Baseline was recorded with a different configuration; not comparing.")
+        return
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if regressions:
+        sys.exit(1)
+    print("No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+''' Microbenchmark: SSE passthrough vs. line-based relay in stream_openai_response
+
+Feeds a synthetic OpenAI SSE stream through an in-memory httpx transport and
+measures relay throughput and per-chunk latency, i.e. the time from an upstream
+chunk being produced to the relay emitting bytes for it.
+
+    python benchmarks/bench_sse_passthrough.py [--events 20000] [--chunk-size 1024]
+'''
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api.servers.base import stream_openai_response  # noqa: E402
+
+
+def build_stream(events: int) -> bytes:
+    lines = []
+    for i in range(events):
+        chunk = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "bench",
+            "choices": [{"index": 0, "delta": {"content": f"tok{i} "}, "finish_reason": None}],
+        }
+        lines.append(f"data: {json.dumps(chunk)}\n\n")
+    lines.append("data: [DONE]\n\n")
+    return "".join(lines).encode()
+
+
+class ChunkedStream(httpx.AsyncByteStream):
+    def __init__(self, body: bytes, chunk_size: int, produced: list):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.produced = produced
+
+    async def __aiter__(self):
+        for i in range(0, len(self.body), self.chunk_size):
+            self.produced.append(time.perf_counter())
+            yield self.body[i:i + self.chunk_size]
+
+
+async def run(body: bytes, chunk_size: int, passthrough: bool):
+    produced = []
+    transport = httpx.MockTransport(
+        lambda request: httpx.Response(200, stream=ChunkedStream(body, chunk_size, produced)))
+    async with httpx.AsyncClient(transport=transport) as client:
+        latencies = []
+        writes = 0
+        total = 0
+        started = time.perf_counter()
+        response = await client.send(client.build_request("POST", "http://upstream/v1/chat/completions"),
+                                     stream=True)
+        async for chunk in stream_openai_response(response, passthrough=passthrough):
+            now = time.perf_counter()
+            latencies.extend(now - t for t in produced[len(latencies):])
+            writes += 1
+            total += len(chunk)
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "mode": "passthrough" if passthrough else "lines",
+        "MB/s": total / elapsed / 1e6,
+        "writes": writes,
+        "p50_us": statistics.median(latencies) * 1e6,
+        "p99_us": latencies[int(len(latencies) * 0.99)] * 1e6,
+        "elapsed_s": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    body = build_stream(args.events)
+    print(f"{len(body) / 1e6:.1f} MB, {args.events} events, {args.chunk_size} B upstream chunks")
+    for passthrough in (False, True):
+        best = min((asyncio.run(run(body, args.chunk_size, passthrough)) for _ in range(args.rounds)),
+                   key=lambda r: r["elapsed_s"])
+        print(f"{best['mode']:>12}: {best['MB/s']:8.1f} MB/s  {best['writes']:6d} writes  "
+              f"chunk latency p50 {best['p50_us']:6.1f} us  p99 {best['p99_us']:6.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+''' Mock OpenAI-compatible and Gemini upstream for load tests
+
+Serves `POST /v1/chat/completions` (OpenAI format) and
+`POST /v1beta/models/{model}:generateContent` / `:streamGenerateContent`
+(Gemini format) with synthetic completions, so the proxy can be measured
+without network noise or API costs:
+
+    python benchmarks/mock_upstream.py --port 9000 --tokens-per-second 200 \
+        --tokens-per-chunk 2 --latency lognormal:0.05:0.4 --error-rate 0.01
+
+Latency (time to response headers) is drawn from `fixed:S`, `uniform:LO:HI`,
+`exp:MEAN` or `lognormal:MEDIAN:SIGMA`. Tokens are then generated at the
+given rate, `--tokens-per-chunk` per SSE event. A fraction `--error-rate` of
+requests fails with `--error-status` after the latency.
+'''
+import argparse
+import asyncio
+from dataclasses import dataclass
+import json
+import math
+import random
+import time
+from typing import Callable, Dict, List
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def parse_latency(spec: str, rng: random.Random) -> Callable[[], float]:
+    """Sampler for a latency distribution spec such as `lognormal:0.05:0.4`."""
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: rng.uniform(*values)
+    if kind == "exp" and len(values) == 1:
+        return lambda: rng.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    if kind == "lognormal" and len(values) == 2:
+        return lambda: rng.lognormvariate(math.log(values[0]), values[1]) if values[0] > 0 else 0.0
+    raise ValueError(f"Unknown latency spec: {spec!r}")
+
+
+@dataclass
+class MockConfig:
+    tokens_per_second: float = 200
+    tokens_per_chunk: int = 1
+    completion_tokens: int = 200
+    latency: str = "fixed:0.05"
+    error_rate: float = 0.0
+    error_status: int = 503
+    seed: int = 0
+
+
+class Generator:
+    """Timing and content of one synthetic completion."""
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.latency = parse_latency(config.latency, self.rng)
+        self.requests = 0
+        self.errors = 0
+
+    def should_fail(self) -> bool:
+        self.requests += 1
+        if self.rng.random() < self.config.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    def max_tokens(self, requested) -> int:
+        tokens = self.config.completion_tokens
+        return min(tokens, requested) if isinstance(requested, int) and requested > 0 else tokens
+
+    def pieces(self, tokens: int) -> List[str]:
+        step = max(self.config.tokens_per_chunk, 1)
+        return ["tok " * min(step, tokens - i) for i in range(0, tokens, step)]
+
+    async def paced(self, pieces: List[str]):
+        """Yield `pieces` at the configured token rate, without drifting on slow event loops."""
+        started = time.perf_counter()
+        emitted = 0
+        for piece in pieces:
+            emitted += len(piece) // 4
+            delay = started + emitted / self.config.tokens_per_second - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield piece
+
+
+def error_response(status: int) -> JSONResponse:
+    return JSONResponse({"error": {"message": "injected error", "type": "mock_error", "code": status}},
+                        status_code=status)
+
+
+def openai_chunk(model: str, created: int, delta: Dict, finish_reason=None, usage=None) -> bytes:
+    chunk = {"id": f"chatcmpl-mock{created}", "object": "chat.completion.chunk", "created": created,
+             "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+    if usage is not None:
+        chunk["usage"] = usage
+    return b"data: " + json.dumps(chunk).encode() + b"\n\n"
+
+
+def create_app(config: MockConfig) -> FastAPI:
+    app = FastAPI()
+    generator = Generator(config)
+
+    @app.get("/health")
+    async def health():
+        return {"requests": generator.requests, "errors": generator.errors}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        await asyncio.sleep(generator.latency())
+        if generator.should_fail():
+            return error_response(config.error_status)
+        model = body.get("model", "mock")
+        created = int(time.time())
+        tokens = generator.max_tokens(body.get("max_tokens"))
+        usage = {"prompt_tokens": 10, "completion_tokens": tokens, "total_tokens": 10 + tokens}
+        pieces = generator.pieces(tokens)
+        if not body.get("stream"):
+            text = "".join([piece async for piece in generator.paced(pieces)])
+            return JSONResponse({
+                "id": f"chatcmpl-mock{created}", "object": "chat.completion", "created": created,
+                "model": model, "usage": usage,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                             "finish_reason": "length" if tokens < config.completion_tokens else "stop"}]})
+
+        async def events():
+            yield openai_chunk(model, created, {"role": "assistant", "content": ""})
+            async for piece in generator.paced(pieces):
+                yield openai_chunk(model, created, {"content": piece})
+            yield openai_chunk(model, created, {}, "stop",
+                               usage if (body.get("stream_options") or {}).get("include_usage") else None)
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1beta/models/{target}")
+    async def generate_content(target: str, request: Request):
+        model, _, method = target.partition(":")
+        body = await request.json()
+        await asyncio.sleep(generator.latency())
+        if generator.should_fail():
+            return error_response(config.error_status)
+        tokens = generator.max_tokens((body.get("generationConfig") or {}).get("maxOutputTokens"))
+        pieces = generator.pieces(tokens)
+        usage = {"promptTokenCount": 10, "candidatesTokenCount": tokens, "totalTokenCount": 10 + tokens}
+
+        def candidate(text: str, finish: bool) -> Dict:
+            result = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+            if finish:
+                result["finishReason"] = "MAX_TOKENS" if tokens < config.completion_tokens else "STOP"
+            return result
+
+        if method != "streamGenerateContent":
+            text = "".join([piece async for piece in generator.paced(pieces)])
+            return JSONResponse({"candidates": [candidate(text, True)], "usageMetadata": usage,
+                                 "modelVersion": model})
+
+        async def events():
+            last = len(pieces) - 1
+            i = 0
+            async for piece in generator.paced(pieces):
+                event = {"candidates": [candidate(piece, i == last)], "modelVersion": model}
+                if i == last:
+                    event["usageMetadata"] = usage
+                yield b"data: " + json.dumps(event).encode() + b"\r\n\r\n"
+                i += 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    defaults = MockConfig()
+    parser.add_argument("--tokens-per-second", type=float, default=defaults.tokens_per_second)
+    parser.add_argument("--tokens-per-chunk", type=int, default=defaults.tokens_per_chunk)
+    parser.add_argument("--completion-tokens", type=int, default=defaults.completion_tokens)
+    parser.add_argument("--latency", default=defaults.latency,
+                        help="fixed:S, uniform:LO:HI, exp:MEAN or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--error-status", type=int, default=defaults.error_status)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(tokens_per_second=args.tokens_per_second, tokens_per_chunk=args.tokens_per_chunk,
+                      completion_tokens=args.completion_tokens, latency=args.latency,
+                      error_rate=args.error_rate, error_status=args.error_status, seed=args.seed)
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    parse_latency(args.latency, random.Random())
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,29 @@
 from public.usage import USAGE as html
 from api.hello import router as hello_router
 from fastapi import FastAPI
-from fastapi.responses import Response
+from fastapi.responses import PlainTextResponse, Response
 from api.servers.generic import router as generic_router
 from api.servers.gemini import router as gemini_router
+from api.servers.jobs import router as jobs_router, job_manager
+from api.servers.generic import PLATFORM_API_URLS
+from api.servers.clients import registry as client_registry
+from api.servers.image_cache import image_cache
+from api.servers.upstream import pool_stats as upstream_pool_stats
+from api.servers.keypool import key_pool_stats
+from api.servers.response_cache import response_cache_stats
+from api.servers.semantic_cache import semantic_cache_stats
+from api.servers.singleflight import singleflight
+from api.servers import metrics
+from api.servers.admission import admission_stats
+from api.servers.context_cache import context_cache_stats
+from api.servers.concurrency import concurrency_stats
+from api.servers.routing import BACKEND_HEADER, routing_stats
 from fastapi.middleware.cors import CORSMiddleware
 app = FastAPI()
 
 app.include_router(hello_router, prefix="/hello")
 app.include_router(gemini_router, prefix="/gemini")
+app.include_router(jobs_router, prefix="")
 app.include_router(generic_router, prefix="") # put generic last
 
 app.add_middleware(
@@ -17,9 +32,81 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=[ "X-Experimental-Stream-Data"],  # this is needed for streaming data header to be read by the client
+    expose_headers=[ "X-Experimental-Stream-Data", BACKEND_HEADER],  # this is needed for streaming data header to be read by the client
 )
 
+@app.on_event("startup")
+async def _startup():
+    await client_registry.startup(list(PLATFORM_API_URLS) + ["gemini"])
+    await job_manager.start()
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    await job_manager.stop()
+    await client_registry.aclose()
+
+
 @app.get("/")
 def _root():
     return Response(content=html, media_type="text/html")
+
+
+@app.get("/stats/pool")
+def _pool_stats():
+    return client_registry.stats()
+
+
+@app.get("/stats/image-cache")
+def _image_cache_stats():
+    return image_cache.stats()
+
+
+@app.get("/stats/upstreams")
+def _upstream_stats():
+    return upstream_pool_stats()
+
+
+@app.get("/stats/gemini-keys")
+def _gemini_key_stats():
+    return key_pool_stats()
+
+
+@app.get("/stats/response-cache")
+def _response_cache_stats():
+    return response_cache_stats()
+
+
+@app.get("/stats/semantic-cache")
+def _semantic_cache_stats():
+    return semantic_cache_stats()
+
+
+@app.get("/stats/coalescing")
+def _coalescing_stats():
+    return singleflight.stats()
+
+
+@app.get("/stats/admission")
+def _admission_stats():
+    return admission_stats()
+
+
+@app.get("/stats/context-cache")
+def _context_cache_stats():
+    return context_cache_stats()
+
+
+@app.get("/stats/concurrency")
+def _concurrency_stats():
+    return concurrency_stats()
+
+
+@app.get("/stats/routing")
+def _routing_stats():
+    return routing_stats()
+
+
+@app.get("/metrics")
+def _metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
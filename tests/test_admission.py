@@ -0,0 +1,44 @@
+import asyncio
+import time
+import pytest
+from fastapi import HTTPException
+from api.servers.admission import AdmissionController
+
+
+@pytest.mark.asyncio
+async def test_admission_queues_then_rejects_with_retry_after():
+    # 120 requests per minute: a burst of 120, then one every 0.5s.
+    controller = AdmissionController({"groq": {"rpm": 120}}, max_wait=0.6, max_queue=10)
+    for _ in range(120):
+        await controller.admit("groq", "key", "m", 10)
+
+    started = time.monotonic()
+    await controller.admit("groq", "key", "m", 10)
+    assert 0.4 < time.monotonic() - started < 0.7
+
+    # The next request queues for ~0.5s; one behind it would wait ~1s, past the deadline.
+    queued = asyncio.ensure_future(controller.admit("groq", "key", "m", 10))
+    await asyncio.sleep(0)
+    with pytest.raises(HTTPException) as e:
+        await controller.admit("groq", "key", "m", 10)
+    assert e.value.status_code == 429 and int(e.value.headers["Retry-After"]) >= 1
+    await queued
+    # Other keys have their own buckets.
+    await asyncio.wait_for(controller.admit("groq", "other-key", "m", 10), 0.1)
+
+
+@pytest.mark.asyncio
+async def test_model_token_bucket_and_cancel_refund():
+    controller = AdmissionController({"gemini/pro": {"tpm": 600}}, max_wait=30)
+    await controller.admit("gemini", "key", "pro", 600)
+    # Unlimited model is not affected.
+    await asyncio.wait_for(controller.admit("gemini", "key", "flash", 10_000), 0.1)
+
+    waiter = asyncio.ensure_future(controller.admit("gemini", "key", "pro", 100))
+    await asyncio.sleep(0.05)
+    assert controller.stats()["queued"] == 1
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    assert controller.stats()["queued"] == 0
+    bucket = next(iter(controller._buckets.values()))
+    assert bucket.tokens > -1  # the cancelled reservation was given back
@@ -0,0 +1,31 @@
+import asyncio
+import json
+import pytest
+from fastapi import HTTPException
+from api.servers.batch import BatchItemError, parse_batch_body, run_batch
+
+
+def test_parse_batch_body_array_and_jsonl():
+    assert parse_batch_body(b'[{"model": "a"}, {"model": "b"}]') == [{"model": "a"}, {"model": "b"}]
+    items = parse_batch_body(b'{"model": "a"}\n\nnot json\n{"model": "b"}\n')
+    assert items[0] == {"model": "a"} and items[2] == {"model": "b"}
+    assert isinstance(items[1], BatchItemError) and items[1].status_code == 400
+    with pytest.raises(HTTPException):
+        parse_batch_body(b"  ")
+
+
+@pytest.mark.asyncio
+async def test_run_batch_streams_in_completion_order_and_isolates_errors():
+    async def complete(item):
+        await asyncio.sleep(item["delay"])
+        if item.get("fail"):
+            raise BatchItemError(429, "rate limited")
+        return json.dumps({"answer": item["delay"]}).encode()
+
+    items = [{"delay": 0.05}, {"delay": 0.01, "fail": True}, {"delay": 1}, {"delay": 0}]
+    lines = [json.loads(line) async for line in run_batch(items, complete, concurrency=4, timeout=0.2)]
+
+    assert [line["index"] for line in lines] == [3, 1, 0, 2]
+    assert lines[0]["response"] == {"answer": 0}
+    assert lines[1]["error"] == {"status": 429, "message": "rate limited"}
+    assert lines[3]["error"]["status"] == 504
@@ -0,0 +1,34 @@
+import httpx
+import pytest
+from api.servers.clients import ClientRegistry
+
+
+@pytest.mark.asyncio
+async def test_clients_are_pooled_per_provider_and_recreated_after_close():
+    registry = ClientRegistry(limits=httpx.Limits(max_connections=3, max_keepalive_connections=1,
+                                                  keepalive_expiry=5), http2=False)
+    groq = registry.get("groq")
+    gemini = registry.get("gemini")
+    assert registry.get("groq") is groq and gemini is not groq
+    for client in (groq, gemini):
+        pool = client._transport._pool
+        assert (pool._max_connections, pool._max_keepalive_connections, pool._keepalive_expiry) == (3, 1, 5)
+
+    await groq.event_hooks["request"][0](httpx.Request("POST", "https://api.groq.com/"))
+    stats = registry.stats()
+    assert sorted(stats) == ["gemini", "groq"]
+    assert stats["groq"]["requests"] == 1 and stats["gemini"]["requests"] == 0
+    assert stats["groq"]["connections"] == 0 and stats["groq"]["http2"] is False
+    assert (stats["groq"]["max_connections"], stats["groq"]["max_keepalive_connections"],
+            stats["groq"]["keepalive_expiry"]) == (3, 1, 5)
+
+    # A client closed behind the registry's back is replaced on next use; counts carry over.
+    await groq.aclose()
+    replacement = registry.get("groq")
+    assert replacement is not groq and not replacement.is_closed
+    assert registry.stats()["groq"]["requests"] == 1
+
+    await registry.aclose()
+    assert replacement.is_closed and gemini.is_closed and registry.stats() == {}
+    assert not registry.get("gemini").is_closed
+    await registry.aclose()
@@ -0,0 +1,35 @@
+import json
+import pytest
+from api.servers import codec
+from api.servers.codec import ChunkTemplate
+
+
+def parse_event(event: bytes) -> dict:
+    assert event.startswith(b"data: ") and event.endswith(b"\n\n")
+    return json.loads(event[6:-2])
+
+
+def test_dumps_is_compact_utf8():
+    assert codec.dumps({"text": "一二三"}) == '{"text":"一二三"}'.encode()
+
+
+def test_loads_raises_value_error_on_invalid_json():
+    for data in (b"{not json", b"", "[1,"):
+        with pytest.raises(ValueError):
+            codec.loads(data)
+
+
+def test_chunk_template_matches_full_envelope():
+    template = ChunkTemplate("chatcmpl-1", 'model-"x"', 123)
+    text = 'He said "hi"\n\\ 你好'
+
+    assert parse_event(template.content(text, index=2)) == {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 123,
+        "model": 'model-"x"',
+        "choices": [{"index": 2, "delta": {"content": text}, "finish_reason": None}],
+    }
+    final = parse_event(template.finish("stop", usage={"total_tokens": 3}))
+    assert final["choices"] == [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+    assert final["usage"] == {"total_tokens": 3}
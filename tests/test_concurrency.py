@@ -0,0 +1,88 @@
+import asyncio
+import httpx
+import pytest
+from fastapi import HTTPException
+from api.servers.concurrency import PRIORITIES, AdaptiveLimiter, ConcurrencyLimits
+
+
+@pytest.mark.asyncio
+async def test_waiters_are_served_by_priority_then_arrival():
+    limiter = AdaptiveLimiter(initial=1)
+    await limiter.acquire()
+    order = []
+
+    async def wait(name, priority):
+        await limiter.acquire(PRIORITIES[priority])
+        order.append(name)
+
+    tasks = [asyncio.ensure_future(wait(name, priority))
+             for name, priority in (("low", "low"), ("normal-1", "normal"), ("high", "high"), ("normal-2", "normal"))]
+    await asyncio.sleep(0)
+    assert limiter.queued == 4
+    for _ in range(4):
+        limiter.release()
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    assert order == ["high", "normal-1", "normal-2", "low"]
+
+
+@pytest.mark.asyncio
+async def test_full_queue_and_deadline_are_rejected():
+    limiter = AdaptiveLimiter(initial=1, max_queue=1, max_wait=0.05)
+    await limiter.acquire()
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    with pytest.raises(HTTPException) as e:
+        await limiter.acquire()
+    assert e.value.status_code == 429
+    with pytest.raises(HTTPException):
+        await waiter
+    assert limiter.in_flight == 1
+
+
+def test_limit_grows_while_used_and_backs_off_on_throttling():
+    limiter = AdaptiveLimiter(initial=10, max_limit=100)
+    for _ in range(50):
+        limiter.observe(0.2, 200, in_flight=int(limiter.limit))
+    grown = limiter.limit
+    assert grown > 10
+    # Idle traffic does not inflate the limit.
+    for _ in range(50):
+        limiter.observe(0.2, 200, in_flight=1)
+    assert limiter.limit == grown
+    # Latency inflation shrinks it, and so does throttling.
+    for _ in range(50):
+        limiter.observe(2.0, 200, in_flight=int(limiter.limit))
+    inflated = limiter.limit
+    assert inflated < grown
+    limiter.observe(0.1, 429, in_flight=1)
+    assert limiter.limit == pytest.approx(inflated * 0.8)
+
+
+@pytest.mark.asyncio
+async def test_slot_is_held_until_the_response_is_closed():
+    limits = ConcurrencyLimits({"groq": {"initial": 1}})
+    client = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, stream=httpx.ByteStream(b"{}"))))
+
+    async def send():
+        return await client.send(client.build_request("POST", "http://upstream/"), stream=True)
+
+    response = await limits.send("groq", "llama", 1, send)
+    limiter = limits.get("groq", "llama")
+    assert limiter.in_flight == 1 and limiter.limit < 2
+    await response.aread()
+    assert limiter.in_flight == 0
+    assert limits.get("gemini", "flash").limit == 16
+
+
+@pytest.mark.asyncio
+async def test_proxy_refusals_leave_the_limit_alone():
+    limits = ConcurrencyLimits({"gemini": {"initial": 4}})
+
+    async def send():
+        raise HTTPException(status_code=429, detail="All API keys are rate limited")
+
+    with pytest.raises(HTTPException):
+        await limits.send("gemini", "flash", 1, send)
+    limiter = limits.get("gemini", "flash")
+    assert limiter.limit == 4 and limiter.in_flight == 0 and limiter.throttled == limiter.errors == 0
@@ -0,0 +1,74 @@
+import asyncio
+import httpx
+import pytest
+from api.servers.base import Message
+from api.servers.context_cache import ContextCache
+from api.servers.gemini import OpenAIProxyArgs, build_gemini_payload, cache_rejected
+
+
+def turn(role, text):
+    return {"role": role, "parts": [{"text": text}]}
+
+
+@pytest.mark.asyncio
+async def test_system_messages_become_system_instruction():
+    payload = await build_gemini_payload(OpenAIProxyArgs(model="gemini-1.5-flash", messages=[
+        Message(role="system", content="Be brief."),
+        Message(role="user", content="Hi"),
+        Message(role="system", content="Answer in French."),
+    ]))
+    assert payload["systemInstruction"] == {"parts": [{"text": "Be brief.\n\nAnswer in French."}]}
+    assert payload["contents"] == [turn("user", "Hi")]
+
+    payload = await build_gemini_payload(OpenAIProxyArgs(model="gemini-1.5-flash", messages=[
+        Message(role="system", content="Tell a joke.")]))
+    assert "systemInstruction" not in payload
+    assert payload["contents"] == [turn("user", "Tell a joke.")]
+
+
+@pytest.mark.asyncio
+async def test_long_prefix_is_uploaded_once_and_referenced_later():
+    cache = ContextCache(min_tokens=100)
+    uploads = []
+
+    async def upload(body):
+        uploads.append(body)
+        return "cachedContents/abc"
+
+    system = {"parts": [{"text": "You are a lawyer. " * 100}]}
+    history = [turn("user", "Question one"), turn("model", "Answer one")]
+    payload = {"systemInstruction": system, "contents": history + [turn("user", "Question two")],
+               "generationConfig": {"temperature": 0}}
+
+    sent, key = cache.prepare("gemini-1.5-flash", "key", payload, upload)
+    assert sent is payload and key is None
+    await asyncio.sleep(0)
+    assert len(uploads) == 1
+    assert uploads[0]["systemInstruction"] == system and uploads[0]["contents"] == history
+    assert uploads[0]["model"] == "models/gemini-1.5-flash"
+
+    # The next turn reuses the uploaded prefix; the new turns are too small for another upload.
+    later = dict(payload, contents=payload["contents"] + [turn("model", "Answer two"), turn("user", "Three")])
+    sent, key = cache.prepare("gemini-1.5-flash", "key", later, upload)
+    assert sent["cachedContent"] == "cachedContents/abc"
+    assert "systemInstruction" not in sent
+    assert sent["contents"] == later["contents"][2:]
+    assert sent["generationConfig"] == {"temperature": 0}
+    await asyncio.sleep(0)
+    assert len(uploads) == 1
+
+    # Another key, or a changed system prompt, never sees the cache.
+    assert cache.prepare("gemini-1.5-flash", "other", later, upload)[1] is None
+    cache.invalidate(key)
+    assert cache.prepare("gemini-1.5-flash", "key", dict(later, contents=later["contents"][:3]), upload)[1] is None
+
+
+def test_only_errors_about_the_cache_drop_the_reference():
+    def error(status, message):
+        return httpx.Response(status, json={"error": {"code": status, "message": message}})
+
+    assert cache_rejected(error(403, "CachedContent not found (or permission denied)"))
+    assert cache_rejected(error(400, "Cache content 1a2b3c is expired."))
+    assert not cache_rejected(error(403, "Permission denied: Consumer 'api_key:AIza' has been suspended."))
+    assert not cache_rejected(error(404, "models/gemini-9 is not found for API version v1beta"))
+    assert not cache_rejected(error(429, "Resource exhausted for cachedContent"))
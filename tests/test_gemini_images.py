@@ -0,0 +1,84 @@
+import asyncio
+import base64
+import httpx
+import pytest
+from api.servers import gemini
+from api.servers.base import Message
+from api.servers.clients import registry
+from api.servers.gemini import MessageConverter
+from api.servers.image_cache import ImageCache
+
+
+def image_message(*items):
+    content = [{"type": "image_url", "image_url": {"url": item}} if item.startswith("http")
+               else {"type": "text", "text": item} for item in items]
+    return Message(role="user", content=content)
+
+
+def inline(data: bytes, mime_type="image/png"):
+    return {"inline_data": {"mime_type": mime_type, "data": base64.b64encode(data).decode()}}
+
+
+@pytest.fixture
+def images(monkeypatch):
+    """Routes the image client to `handler(request)`, set by the test, without the shared image cache."""
+    monkeypatch.setattr(gemini, "image_cache", ImageCache(max_bytes=0, default_ttl=0))
+    routes = {}
+
+    async def handler(request: httpx.Request):
+        return await routes["handler"](request)
+
+    monkeypatch.setitem(registry._clients, "images", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return routes
+
+
+@pytest.mark.asyncio
+async def test_fetches_are_capped_and_parts_keep_their_order(images):
+    in_flight = [0]
+    peak = [0]
+
+    async def handler(request: httpx.Request):
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        number = int(request.url.path[1:-len(".png")])
+        # Later images finish first.
+        await asyncio.sleep(0.01 * (5 - number))
+        in_flight[0] -= 1
+        return httpx.Response(200, headers={"content-type": "image/png"}, content=b"img%d" % number)
+
+    images["handler"] = handler
+    messages = [image_message("look", "http://img/1.png", "http://img/2.png", "and", "http://img/3.png"),
+                Message(role="assistant", content="ok"),
+                image_message("http://img/4.png", "http://img/5.png")]
+    async with registry.get("images"):
+        contents = await MessageConverter(messages, max_concurrency=2).aconvert()
+
+    assert peak[0] == 2
+    assert contents[0]["parts"] == [{"text": "look"}, inline(b"img1"), inline(b"img2"), {"text": "and"},
+                                    inline(b"img3")]
+    assert contents[1] == {"role": "model", "parts": [{"text": "ok"}]}
+    assert contents[2]["parts"] == [inline(b"img4"), inline(b"img5")]
+
+
+@pytest.mark.asyncio
+async def test_slow_missing_and_oversized_images_become_error_text(images):
+    async def handler(request: httpx.Request):
+        if request.url.path == "/slow.png":
+            await asyncio.sleep(1)
+        if request.url.path == "/missing.png":
+            return httpx.Response(404)
+        return httpx.Response(200, headers={"content-type": "image/png"}, content=b"12345678")
+
+    images["handler"] = handler
+    urls = ["http://img/slow.png", "http://img/missing.png", "http://img/a.png", "http://img/b.png"]
+    async with registry.get("images"):
+        parts = (await MessageConverter([image_message(*urls)], max_concurrency=1, image_timeout=0.05,
+                                        max_total_bytes=12).aconvert())[0]["parts"]
+
+    assert parts == [
+        {"text": "[Error: Could not process image from http://img/slow.png]"},
+        {"text": "[Error: Could not fetch image from http://img/missing.png]"},
+        inline(b"12345678"),
+        # Only 4 of the 12 bytes are left for the second image.
+        {"text": "[Error: Could not process image from http://img/b.png]"},
+    ]
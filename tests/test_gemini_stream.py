@@ -0,0 +1,112 @@
+import json
+import httpx
+import pytest
+from api.servers.clients import registry
+from api.servers.base import Message
+from api.servers.gemini import convert_gemini_to_openai_response, send_gemini_request, stream_gemini_response
+from api.servers.tokens import estimate_message_tokens, estimate_tokens
+
+
+def mock_gemini_stream(monkeypatch, events):
+    body = "".join(f"data: {json.dumps(e)}\r\n\r\n" for e in events).encode()
+
+    def handler(request: httpx.Request):
+        assert "alt=sse" in str(request.url)
+        return httpx.Response(200, stream=httpx.ByteStream(body))
+
+    monkeypatch.setitem(registry._clients, "gemini", httpx.AsyncClient(
+        transport=httpx.MockTransport(handler)))
+
+
+async def collect_chunks(model: str = "gemini-1.5-flash", **kwargs):
+    chunks = []
+    async with registry.get("gemini"):
+        response = await send_gemini_request(model, {}, "test-key", stream=True)
+        async for event in stream_gemini_response(response, model, **kwargs):
+            assert event.startswith(b"data: ") and event.endswith(b"\n\n")
+            data = event[6:-2]
+            if data != b"[DONE]":
+                chunks.append(json.loads(data))
+    return chunks
+
+
+@pytest.mark.asyncio
+async def test_gemini_stream_escaped_and_multipart_text(monkeypatch):
+    mock_gemini_stream(monkeypatch, [
+        {"candidates": [{"index": 0, "content": {"parts": [
+            {"text": 'He said "hi"\nthen left'}, {"text": " again"}]}}]},
+        {"candidates": [{"index": 0, "content": {"parts": [{"text": "."}]},
+                         "finishReason": "MAX_TOKENS"}],
+         "usageMetadata": {"promptTokenCount": 3, "candidatesTokenCount": 5, "totalTokenCount": 8}},
+    ])
+    chunks = await collect_chunks(include_usage=True)
+
+    contents = [c["choices"][0]["delta"].get("content") for c in chunks[:-2]]
+    assert contents == ['He said "hi"\nthen left', " again", "."]
+    assert len({c["id"] for c in chunks}) == 1
+    assert chunks[-2]["choices"][0]["finish_reason"] == "length"
+    assert chunks[-1]["choices"] == []
+    assert chunks[-1]["usage"] == {"prompt_tokens": 3, "completion_tokens": 5, "total_tokens": 8}
+
+
+@pytest.mark.asyncio
+async def test_gemini_stream_estimates_missing_usage(monkeypatch):
+    mock_gemini_stream(monkeypatch, [
+        {"candidates": [{"index": 0, "content": {"parts": [{"text": "Hello there, world"}]},
+                         "finishReason": "STOP"}]},
+    ])
+    recorded = []
+    messages = [Message(role="user", content="Say hello")]
+    chunks = await collect_chunks(on_usage=recorded.append, messages=messages)
+    assert "usage" not in chunks[-1]
+
+    assert recorded[0]["candidatesTokenCount"] == estimate_tokens("Hello there, world")
+    assert recorded[0]["promptTokenCount"] == estimate_message_tokens(messages) > 0
+
+
+@pytest.mark.asyncio
+async def test_gemini_stream_multiple_candidates(monkeypatch):
+    mock_gemini_stream(monkeypatch, [
+        {"candidates": [{"content": {"parts": [{"text": "A"}]}},
+                        {"index": 1, "content": {"parts": [{"text": "B"}]}}]},
+        {"candidates": [{"content": {"parts": [{"text": "!"}]}, "finishReason": "STOP"},
+                        {"index": 1, "content": {"parts": []}, "finishReason": "SAFETY"}]},
+    ])
+    chunks = await collect_chunks()
+    deltas = [(c["choices"][0]["index"], c["choices"][0]["delta"].get("content")) for c in chunks[:3]]
+    assert deltas == [(0, "A"), (1, "B"), (0, "!")]
+    finishes = [(c["choices"][0]["index"], c["choices"][0]["finish_reason"]) for c in chunks[3:]]
+    assert finishes == [(0, "stop"), (1, "content_filter")]
+
+
+def test_convert_multiple_candidates_and_parts():
+    response = convert_gemini_to_openai_response({
+        "candidates": [
+            {"content": {"parts": [{"text": "Hello"}, {"text": ", world"}]}, "finishReason": "STOP"},
+            {"index": 1, "content": {"parts": [{"text": "Hi"}]}, "finishReason": "MAX_TOKENS"},
+        ],
+        "usageMetadata": {"promptTokenCount": 4, "candidatesTokenCount": 6, "totalTokenCount": 10},
+    }, "gemini-1.5-flash")
+    assert [(c["index"], c["message"]["content"], c["finish_reason"]) for c in response["choices"]] == [
+        (0, "Hello, world", "stop"), (1, "Hi", "length")]
+    assert response["usage"]["total_tokens"] == 10
+
+
+@pytest.mark.asyncio
+async def test_gemini_stream_function_calls_become_tool_call_deltas(monkeypatch):
+    mock_gemini_stream(monkeypatch, [
+        {"candidates": [{"content": {"parts": [
+            {"functionCall": {"name": "get_weather", "args": {"city": "Paris"}}}]}}]},
+        {"candidates": [{"content": {"parts": [
+            {"functionCall": {"name": "get_time", "args": {}}}]}, "finishReason": "STOP"}]},
+    ])
+    recorded = []
+    chunks = await collect_chunks(on_usage=recorded.append)
+    deltas = [c["choices"][0]["delta"]["tool_calls"][0] for c in chunks[:4]]
+    assert [d["index"] for d in deltas] == [0, 0, 1, 1]
+    assert deltas[0]["function"] == {"name": "get_weather", "arguments": ""}
+    assert deltas[0]["id"].startswith("call_")
+    assert json.loads(deltas[1]["function"]["arguments"]) == {"city": "Paris"}
+    assert deltas[2]["function"]["name"] == "get_time"
+    assert chunks[-1]["choices"][0]["finish_reason"] == "tool_calls"
+    assert recorded[0]["candidatesTokenCount"] == estimate_tokens('{"city":"Paris"}') + estimate_tokens("{}")
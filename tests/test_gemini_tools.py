@@ -0,0 +1,57 @@
+import pytest
+from fastapi import HTTPException
+from api.servers.base import Message
+from api.servers.gemini import MessageConverter, convert_gemini_to_openai_response
+from api.servers.gemini_tools import clean_schema, convert_tool_choice, convert_tools
+
+
+def test_tools_and_tool_choice_translation():
+    tools = convert_tools([{"type": "function", "function": {
+        "name": "search", "description": "Search the web",
+        "parameters": {"type": "object", "additionalProperties": False, "properties": {
+            "query": {"type": "string", "format": "uri"},
+            "limit": {"type": ["integer", "null"]}}, "required": ["query"]}}},
+        {"type": "function", "function": {"name": "now", "parameters": {"type": "object", "properties": {}}}}])
+    assert tools == [{"functionDeclarations": [
+        {"name": "search", "description": "Search the web", "parameters": {
+            "type": "object", "properties": {"query": {"type": "string"},
+                                             "limit": {"nullable": True, "type": "integer"}},
+            "required": ["query"]}},
+        {"name": "now"}]}]
+    assert convert_tool_choice("required") == {"functionCallingConfig": {"mode": "ANY"}}
+    assert convert_tool_choice({"type": "function", "function": {"name": "search"}}) == {
+        "functionCallingConfig": {"mode": "ANY", "allowedFunctionNames": ["search"]}}
+    with pytest.raises(HTTPException):
+        convert_tool_choice("sometimes")
+    assert clean_schema({"$schema": "x", "type": "string"}) == {"type": "string"}
+
+
+def test_tool_call_round_trip_messages():
+    messages = [
+        Message(role="user", content="Weather in Paris and Rome?"),
+        Message(role="assistant", content=None, tool_calls=[
+            {"id": "call_1", "function": {"name": "get_weather", "arguments": '{"city": "Paris"}'}},
+            {"id": "call_2", "function": {"name": "get_weather", "arguments": '{"city": "Rome"}'}}]),
+        Message(role="tool", tool_call_id="call_1", content='{"temp": 21}'),
+        Message(role="tool", tool_call_id="call_2", content="sunny"),
+    ]
+    contents = MessageConverter(messages).convert()
+    assert contents[1] == {"role": "model", "parts": [
+        {"functionCall": {"name": "get_weather", "args": {"city": "Paris"}}},
+        {"functionCall": {"name": "get_weather", "args": {"city": "Rome"}}}]}
+    assert contents[2] == {"role": "user", "parts": [
+        {"functionResponse": {"name": "get_weather", "response": {"temp": 21}}},
+        {"functionResponse": {"name": "get_weather", "response": {"content": "sunny"}}}]}
+    assert len(contents) == 3
+
+
+def test_function_call_response_becomes_tool_calls():
+    response = convert_gemini_to_openai_response({"candidates": [{"content": {"parts": [
+        {"functionCall": {"name": "get_weather", "args": {"city": "Paris"}}}]}, "finishReason": "STOP"}]},
+        "gemini-1.5-flash")
+    choice = response["choices"][0]
+    assert choice["finish_reason"] == "tool_calls"
+    assert choice["message"]["content"] is None
+    call = choice["message"]["tool_calls"][0]
+    assert call["type"] == "function" and call["function"]["name"] == "get_weather"
+    assert call["function"]["arguments"] == '{"city":"Paris"}'
@@ -0,0 +1,107 @@
+import httpx
+import pytest
+from api.servers import gemini
+from api.servers.base import Message
+from api.servers.clients import registry
+from api.servers.gemini import MessageConverter
+from api.servers.image_cache import ImageCache, parse_cache_control
+
+
+def test_cache_control_sets_the_ttl():
+    assert parse_cache_control(None, 3600) == 3600
+    assert parse_cache_control("public, max-age=60", 3600) == 60
+    assert parse_cache_control("max-age=86400", 3600) == 3600
+    assert parse_cache_control("no-cache, max-age=60", 3600) == 0
+    assert parse_cache_control("private, No-Store", 3600) is None
+
+
+def test_no_store_and_unvalidatable_no_cache_are_not_stored():
+    cache = ImageCache(max_bytes=1024, default_ttl=60)
+    cache.store("http://a", "image/png", "AAAA", 3, {"cache-control": "no-store"})
+    cache.store("http://b", "image/png", "AAAA", 3, {"cache-control": "no-cache"})
+    assert cache.lookup("http://a") == (None, None) and cache.lookup("http://b") == (None, None)
+    assert cache.stats()["entries"] == 0
+
+
+def test_stale_entry_is_revalidated_and_refreshed_by_a_304():
+    cache = ImageCache(max_bytes=1024, default_ttl=60)
+    cache.store("http://a", "image/png", "AAAA", 3,
+                {"cache-control": "no-cache", "etag": '"v1"', "last-modified": "Mon, 01 Jan 2024 00:00:00 GMT"})
+    entry, cached = cache.lookup("http://a")
+    assert cached == ("image/png", "AAAA") and not entry.is_fresh()
+    assert entry.validators() == {"If-None-Match": '"v1"', "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT"}
+
+    cache.refresh("http://a", {"cache-control": "max-age=30", "etag": '"v2"'})
+    entry, _ = cache.lookup("http://a")
+    assert entry.is_fresh() and entry.etag == '"v2"'
+    assert entry.last_modified == "Mon, 01 Jan 2024 00:00:00 GMT"
+
+    # A 304 that forbids storing drops the entry.
+    cache.refresh("http://a", {"cache-control": "no-store"})
+    assert cache.lookup("http://a") == (None, None)
+
+
+@pytest.mark.asyncio
+async def test_converter_revalidates_a_stale_image_with_a_conditional_get(monkeypatch):
+    cache = ImageCache(max_bytes=1024, default_ttl=60)
+    cache.store("http://img/a.png", "image/png", "AAAA", 3, {"cache-control": "no-cache", "etag": '"v1"'})
+    monkeypatch.setattr(gemini, "image_cache", cache)
+    seen = []
+
+    def handler(request: httpx.Request):
+        seen.append(request.headers.get("if-none-match"))
+        return httpx.Response(304, headers={"etag": '"v1"', "cache-control": "max-age=60"})
+
+    message = Message(role="user", content=[{"type": "image_url", "image_url": {"url": "http://img/a.png"}}])
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        monkeypatch.setitem(registry._clients, "images", client)
+        for _ in range(2):
+            contents = await MessageConverter([message]).aconvert()
+            assert contents[0]["parts"] == [{"inline_data": {"mime_type": "image/png", "data": "AAAA"}}]
+
+    # The second conversion is served from the refreshed entry without a request.
+    assert seen == ['"v1"']
+    assert (cache.hits, cache.revalidated, cache.misses) == (2, 1, 0)
+
+
+def test_identical_images_share_one_blob():
+    cache = ImageCache(max_bytes=1024, default_ttl=60)
+    cache.store("http://a", "image/png", "AAAA", 3, {})
+    cache.store("http://mirror/a", "image/png", "AAAA", 3, {})
+    stats = cache.stats()
+    assert stats["entries"] == 2 and stats["blobs"] == 1 and stats["bytes"] == 4
+
+    cache.store("http://a", "image/png", "BBBB", 3, {})
+    assert cache.stats()["blobs"] == 2 and cache.stats()["bytes"] == 8
+    cache.store("http://mirror/a", "image/png", "BBBB", 3, {})
+    assert cache.stats()["blobs"] == 1 and cache.stats()["bytes"] == 4
+
+
+def test_least_recently_used_entries_are_evicted_over_the_byte_budget():
+    cache = ImageCache(max_bytes=10, default_ttl=60)
+    cache.store("http://a", "image/png", "AAAA", 3, {})
+    cache.store("http://b", "image/png", "BBBB", 3, {})
+    assert cache.lookup("http://a")[1] is not None
+    cache.store("http://c", "image/png", "CCCC", 3, {})
+    assert cache.lookup("http://b") == (None, None)
+    assert cache.lookup("http://a")[1] and cache.lookup("http://c")[1]
+    assert cache.stats()["evictions"] == 1 and cache.stats()["bytes"] == 8
+
+    # Larger than the whole budget: not stored, nothing evicted.
+    cache.store("http://d", "image/png", "D" * 11, 8, {})
+    assert cache.lookup("http://d") == (None, None) and cache.stats()["entries"] == 2
+
+
+def test_hit_miss_and_revalidated_counters():
+    cache = ImageCache(max_bytes=1024, default_ttl=60)
+    cache.record_miss(0.5)
+    cache.store("http://a", "image/png", "AAAA", 300, {"etag": '"v1"'})
+    entry, _ = cache.lookup("http://a")
+    cache.record_hit(entry)
+    cache.record_hit(entry, revalidated=True)
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["revalidated"]) == (2, 1, 1)
+    assert stats["hit_rate"] == pytest.approx(2 / 3)
+    assert stats["bytes_saved"] == 600
+    # Only the hit that skipped the download saved a fetch.
+    assert stats["seconds_saved"] == pytest.approx(0.5)
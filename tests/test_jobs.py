@@ -0,0 +1,150 @@
+import asyncio
+import json
+import os
+import httpx
+import pytest
+from api.servers.clients import registry
+from api.servers.batch import BatchItemError
+from api.servers.jobs import JOB_MAX_ATTEMPTS, JobManager, RateLimiter
+from api.servers.response_cache import caller_id
+
+
+def write_input(manager: JobManager, custom_ids):
+    lines = [json.dumps({"custom_id": cid, "method": "POST", "url": "/v1/chat/completions",
+                         "body": {"model": "m", "messages": [{"role": "user", "content": cid}]}})
+             for cid in custom_ids]
+    return manager.files.create(caller_id("key"), "input.jsonl", "batch", "\n".join(lines).encode())["id"]
+
+
+def read_lines(manager: JobManager, file_id):
+    with open(manager.files.path(file_id)) as f:
+        return [json.loads(line) for line in f]
+
+
+async def wait_done(manager: JobManager, job):
+    for _ in range(200):
+        if job.status in ("completed", "cancelled", "failed"):
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"batch still {job.status}")
+
+
+@pytest.mark.asyncio
+async def test_job_runs_against_mock_upstream(tmp_path, monkeypatch):
+    def handler(request: httpx.Request):
+        body = json.loads(request.content)
+        assert body["stream"] is False
+        content = body["messages"][0]["content"]
+        if content == "bad":
+            return httpx.Response(400, json={"error": {"message": "bad request"}})
+        return httpx.Response(200, json={"object": "chat.completion", "echo": content})
+
+    manager = JobManager(str(tmp_path), limiter=RateLimiter({}, 60000))
+    input_file_id = write_input(manager, ["a", "bad", "c"])
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        monkeypatch.setitem(registry._clients, "groq", client)
+        try:
+            job = await manager.create("groq", "key", input_file_id, "/v1/chat/completions")
+            await wait_done(manager, job)
+        finally:
+            await manager.stop()
+
+    assert job.status == "completed"
+    assert job.request_counts == {"total": 3, "completed": 2, "failed": 1}
+    output = read_lines(manager, job.output_file_id)
+    assert sorted(line["response"]["body"]["echo"] for line in output) == ["a", "c"]
+    errors = read_lines(manager, job.error_file_id)
+    assert errors[0]["custom_id"] == "bad" and errors[0]["response"]["status_code"] == 400
+
+
+@pytest.mark.asyncio
+async def test_job_resumes_from_checkpoint(tmp_path):
+    calls = []
+    hang = asyncio.Event()
+
+    async def run_item(platform, api_key, body):
+        content = body["messages"][0]["content"]
+        calls.append(content)
+        if content != "a":
+            await hang.wait()  # the process "dies" before these finish
+        return b'{"ok": true}'
+
+    manager = JobManager(str(tmp_path), run_item=run_item, workers=1, limiter=RateLimiter({}, 60000))
+    job = await manager.create("groq", "key", write_input(manager, ["a", "b", "c"]), "/v1/chat/completions")
+    while calls != ["a", "b"]:
+        await asyncio.sleep(0.01)
+    await manager.stop()
+    # A torn line from a crash in the middle of a write.
+    with open(manager._output_path(job, "output"), "a") as f:
+        f.write('{"custom_id": "b", "resp')
+
+    calls.clear()
+    hang.set()
+    restarted = JobManager(str(tmp_path), run_item=run_item, limiter=RateLimiter({}, 60000))
+    await restarted.start()
+    try:
+        resumed = restarted.jobs[job.id]
+        await wait_done(restarted, resumed)
+    finally:
+        await restarted.stop()
+
+    assert sorted(calls) == ["b", "c"]
+    assert resumed.request_counts == {"total": 3, "completed": 3, "failed": 0}
+    assert sorted(line["custom_id"] for line in read_lines(restarted, resumed.output_file_id)) == ["a", "b", "c"]
+
+
+@pytest.mark.asyncio
+async def test_retries_stop_without_a_final_backoff_and_records_are_private(tmp_path, monkeypatch):
+    backoffs = []
+    sleep = asyncio.sleep
+
+    async def fast_sleep(delay, *args, **kwargs):
+        if delay >= 1:
+            backoffs.append(delay)
+            delay = 0
+        return await sleep(delay, *args, **kwargs)
+
+    async def run_item(platform, api_key, body):
+        raise BatchItemError(503, "busy")
+
+    monkeypatch.setattr(asyncio, "sleep", fast_sleep)
+    manager = JobManager(str(tmp_path), run_item=run_item, workers=1, limiter=RateLimiter({}, 60000))
+    try:
+        job = await manager.create("groq", "key", write_input(manager, ["a"]), "/v1/chat/completions")
+        await wait_done(manager, job)
+    finally:
+        await manager.stop()
+    assert job.request_counts["failed"] == 1
+    assert len(backoffs) == JOB_MAX_ATTEMPTS - 1
+    assert os.stat(os.path.join(manager._job_dir(job.id), "batch.json")).st_mode & 0o777 == 0o600
+
+
+def test_empty_upload_has_an_empty_file(tmp_path):
+    manager = JobManager(str(tmp_path))
+    meta = manager.files.create(caller_id("key"), "empty.jsonl", "batch", b"")
+    assert meta["bytes"] == 0 and os.path.getsize(manager.files.path(meta["id"])) == 0
+
+
+@pytest.mark.asyncio
+async def test_worker_survives_a_failed_finalize(tmp_path, monkeypatch):
+    async def run_item(platform, api_key, body):
+        return b'{"ok": true}'
+
+    manager = JobManager(str(tmp_path), run_item=run_item, workers=1, limiter=RateLimiter({}, 60000))
+    create = manager.files.create
+
+    def failing_create(*args, **kwargs):
+        monkeypatch.setattr(manager.files, "create", create)
+        raise OSError("disk full")
+
+    try:
+        first = await manager.create("groq", "key", write_input(manager, ["a"]), "/v1/chat/completions")
+        monkeypatch.setattr(manager.files, "create", failing_create)
+        while first.request_counts["completed"] == 0 or manager.files.create is failing_create:
+            await asyncio.sleep(0.01)
+        assert first.status == "in_progress"
+        second = await manager.create("groq", "key", write_input(manager, ["b"]), "/v1/chat/completions")
+        await wait_done(manager, second)
+    finally:
+        await manager.stop()
+    assert second.status == "completed"
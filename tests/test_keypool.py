@@ -0,0 +1,49 @@
+import time
+import httpx
+import pytest
+from fastapi import HTTPException
+from api.servers.clients import registry
+from api.servers.gemini import send_with_key_pool
+from api.servers.keypool import KeyPool
+
+
+def test_select_spreads_requests_by_headroom():
+    pool = KeyPool(["key-a", "key-b"], rpm=2)
+    picked = [pool.select().key for _ in range(4)]
+    assert sorted(picked) == ["key-a", "key-a", "key-b", "key-b"]
+    assert [state.headroom(time.monotonic()) for state in pool.keys] == [0, 0]
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_key_is_cooled_down_and_request_retried(monkeypatch):
+    used = []
+
+    def handler(request: httpx.Request):
+        key = request.headers["x-goog-api-key"]
+        used.append(key)
+        if key == "hot-key":
+            return httpx.Response(429, json={"error": {"details": [{"retryDelay": "42s"}]}})
+        return httpx.Response(200, json={"candidates": []})
+
+    pool = KeyPool(["hot-key", "idle-key"])
+    pool.keys[1].acquire(0)  # make hot-key the first choice
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        monkeypatch.setitem(registry._clients, "gemini", client)
+        response, state = await send_with_key_pool(pool, "gemini-1.5-flash", {}, stream=False)
+        await response.aclose()
+    assert response.status_code == 200 and state.key == "idle-key"
+    assert used == ["hot-key", "idle-key"]
+    assert 40 < pool.keys[0].cooldown_until - pool.keys[1].cooldown_until
+
+
+@pytest.mark.asyncio
+async def test_all_keys_rate_limited_returns_retry_after(monkeypatch):
+    pool = KeyPool(["k1", "k2"])
+    async with httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(429, headers={"retry-after": "7"}))) as client:
+        monkeypatch.setitem(registry._clients, "gemini", client)
+        with pytest.raises(HTTPException) as e:
+            await send_with_key_pool(pool, "gemini-1.5-flash", {}, stream=False)
+    assert e.value.status_code == 429
+    assert e.value.headers["Retry-After"] in ("6", "7")
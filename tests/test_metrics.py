@@ -0,0 +1,54 @@
+import asyncio
+import pytest
+from api.servers import metrics
+from api.servers.metrics import Counter, Histogram, Registry, RequestTracker
+
+
+def test_registry_renders_the_text_exposition_format():
+    registry = Registry()
+    requests = registry.register(Counter("requests_total", "Requests", ("platform", "model")))
+    duration = registry.register(Histogram("duration_seconds", "Duration", ("platform",), buckets=(0.1, 1)))
+    requests.inc(("groq", 'say "hi"\\\nbye'), 2)
+    for value in (0.05, 0.1, 0.5, 3):
+        duration.observe(("groq",), value)
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{platform="groq",model="say \\"hi\\"\\\\\\nbye"} 2',
+        "# HELP duration_seconds Duration",
+        "# TYPE duration_seconds histogram",
+        # Buckets are cumulative and `le` is inclusive.
+        'duration_seconds_bucket{platform="groq",le="0.1"} 2',
+        'duration_seconds_bucket{platform="groq",le="1"} 3',
+        'duration_seconds_bucket{platform="groq",le="+Inf"} 4',
+        'duration_seconds_sum{platform="groq"} 3.65',
+        'duration_seconds_count{platform="groq"} 4',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_rendered_request_metrics_include_client_disconnects():
+    RequestTracker("metrics-test", "m").finish(200, 10)
+    RequestTracker("metrics-test", "m").finish(502)
+
+    async def chunks():
+        yield b"data: 1\n\n"
+        await asyncio.Event().wait()
+
+    stream = RequestTracker("metrics-test", "m").wrap(chunks())
+    assert await stream.__anext__() == b"data: 1\n\n"
+    reading = asyncio.ensure_future(stream.__anext__())
+    await asyncio.sleep(0)
+    reading.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await reading
+
+    lines = metrics.render().splitlines()
+    for status in ("200", "502", "499"):
+        assert f'llmproxy_requests_total{{platform="metrics-test",model="m",status="{status}"}} 1' in lines
+        assert (f'llmproxy_request_duration_seconds_count{{platform="metrics-test",model="m",status="{status}"}} 1'
+                in lines)
+    assert 'llmproxy_requests_in_flight{platform="metrics-test"} 0' in lines
+    assert 'llmproxy_stream_cancellations_total{platform="metrics-test",model="m"} 1' in lines
+    assert 'llmproxy_response_bytes_total{platform="metrics-test",model="m"} 19' in lines
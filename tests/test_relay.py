@@ -0,0 +1,90 @@
+import asyncio
+import httpx
+import pytest
+from api.servers.base import SSEScanner, relay_stream
+from api.servers.metrics import REQUESTS, STREAM_CANCELLATIONS, RequestTracker
+
+
+def upstream(log, count=1000):
+    async def chunks():
+        try:
+            for i in range(count):
+                log.append(i)
+                yield b"data: %d\n\n" % i
+        finally:
+            log.append("closed")
+    return chunks()
+
+
+@pytest.mark.asyncio
+async def test_relay_reads_ahead_only_up_to_the_buffer():
+    log = []
+    relay = relay_stream(upstream(log), buffer=4)
+    assert await relay.__anext__() == b"data: 0\n\n"
+    await asyncio.sleep(0.01)
+    assert len(log) <= 6
+    assert [chunk async for chunk in relay][-1] == b"data: 999\n\n"
+    assert log[-1] == "closed"
+
+
+@pytest.mark.asyncio
+async def test_relay_propagates_upstream_errors():
+    async def failing():
+        yield b"a"
+        raise ValueError("upstream broke")
+
+    relay = relay_stream(failing())
+    assert await relay.__anext__() == b"a"
+    with pytest.raises(ValueError):
+        await relay.__anext__()
+
+
+@pytest.mark.asyncio
+async def test_closing_a_tracked_stream_closes_the_upstream_and_counts_the_cancellation():
+    log = []
+    tracker = RequestTracker("test", "relay-model", completion_budget=500)
+    stream = tracker.wrap(relay_stream(upstream(log), buffer=2))
+    for _ in range(3):
+        await stream.__anext__()
+    await stream.aclose()
+    await asyncio.sleep(0.01)
+    assert log[-1] == "closed"
+    assert len(log) < 10
+    assert STREAM_CANCELLATIONS.values[("test", "relay-model")] == 1
+
+
+@pytest.mark.asyncio
+async def test_tracked_stream_records_disconnects_as_499_and_upstream_errors_as_5xx():
+    async def broken():
+        yield b"data: 1\n\n"
+        raise httpx.ReadError("connection reset")
+
+    stream = RequestTracker("test", "status-model").wrap(broken())
+    await stream.__anext__()
+    with pytest.raises(httpx.ReadError):
+        await stream.__anext__()
+
+    async def silent():
+        await asyncio.sleep(10)
+        yield b""
+
+    # Client gone before the first chunk.
+    waiting = asyncio.ensure_future(RequestTracker("test", "status-model").wrap(silent()).__anext__())
+    await asyncio.sleep(0.01)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert REQUESTS.values[("test", "status-model", "502")] == 1
+    assert REQUESTS.values[("test", "status-model", "499")] == 1
+
+
+def test_scanner_stops_only_at_a_done_line():
+    scanner = SSEScanner()
+    scanner.feed(b'data: {"choices":[{"delta":{"content":"print(\\"data: [DONE]\\")"}}]}\n\n')
+    assert not scanner.done and scanner.events == 1
+    for chunk in (b"data: [DO", b"NE]\n\n"):
+        scanner.feed(chunk)
+    assert scanner.done and scanner.events == 2
+    first = SSEScanner()
+    first.feed(b"data:[DONE]\n\n")
+    assert first.done
@@ -0,0 +1,68 @@
+import json
+import pytest
+from fastapi import HTTPException
+from api.servers.base import scan_top_level_fields
+from api.servers.generic import parse_request_body
+
+FIELDS = ("model", "stream", "temperature", "max_tokens")
+
+
+def scan(body):
+    return scan_top_level_fields(body if isinstance(body, bytes) else body.encode(), FIELDS)
+
+
+def test_nested_keys_of_the_same_name_are_ignored():
+    body = json.dumps({
+        "messages": [{"role": "user", "content": "hi", "model": "nested", "stream": True}],
+        "metadata": {"model": "meta", "max_tokens": 1, "inner": [{"temperature": 2}]},
+        "model": "top",
+        "tools": [{"function": {"parameters": {"properties": {"stream": {"type": "boolean"}}}}}],
+    })
+    assert scan(body) == {"model": "top"}
+
+
+def test_escaped_quotes_and_trailing_backslashes_in_strings():
+    body = json.dumps({
+        "messages": [{"content": 'say "model": "fake", then \\'}, {"content": "\\\\"}],
+        "stop": ["\\", '"stream": true'],
+        "model": 'm "quoted" \\',
+        "stream": False,
+    })
+    assert scan(body) == {"model": 'm "quoted" \\', "stream": False}
+    # A string value equal to a wanted key is not a key.
+    assert scan('{"stop": "model" , "user": "stream"}') == {}
+
+
+def test_duplicate_keys_take_the_last_value():
+    assert scan('{"model": "a", "stream": true, "temperature": 0, "max_tokens": 1, "model": "b"}') == \
+        {"model": "b", "stream": True, "temperature": 0, "max_tokens": 1}
+    assert scan('{"model": "a", "model": {"name": "b"}}') == {}
+
+
+def test_whitespace_and_unicode_around_keys():
+    body = '\n {\r\n\t"名前" : "値",  "model"\n :\t"模型-ü" ,"temperature":\n0.5, "max_tokens" :12 }\n'
+    assert scan(body) == {"model": "模型-ü", "temperature": 0.5, "max_tokens": 12}
+    assert scan(json.dumps({"emoji": "😀", "model": "m"}, ensure_ascii=True)) == {"model": "m"}
+    # An escaped key means the same key to JSON parsers, and so to the upstream.
+    assert scan('{"mod\\u0065l": "m"}') == {"model": "m"}
+
+
+@pytest.mark.parametrize("body", [
+    b"", b"   ", b"null", b"[]", b'["model"]', b'"model"', b"42",
+    b'{"model": "m"', b'{"model": "m", "messages": [{"content": "x"}', b'{"model": "m}',
+    b'{"model": "m"} {"model": "n"}', b'{"model": "m"}}',
+])
+def test_non_object_and_truncated_bodies_are_rejected(body):
+    with pytest.raises(ValueError):
+        scan(body)
+    with pytest.raises(HTTPException) as e:
+        parse_request_body(body)
+    assert e.value.status_code == 400
+
+
+def test_missing_model_is_still_a_422():
+    with pytest.raises(HTTPException) as e:
+        parse_request_body(b'{"messages": []}')
+    assert e.value.status_code == 422
+    payload, fields = parse_request_body(b' {"model": "m", "stream": true} ')
+    assert payload == b' {"model": "m", "stream": true} ' and fields == {"model": "m", "stream": True}
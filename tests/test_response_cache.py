@@ -0,0 +1,52 @@
+import json
+import pytest
+from api.servers.response_cache import MemoryBackend, ResponseCache, cache_key, replay_as_sse
+
+COMPLETION = {
+    "id": "chatcmpl-1",
+    "object": "chat.completion",
+    "created": 1,
+    "model": "m",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "hello"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}
+
+
+def test_cache_key_ignores_stream_and_key_order_but_not_params():
+    body = {"model": "m", "temperature": 0, "messages": [{"role": "user", "content": "hi"}]}
+    reordered = {"messages": body["messages"], "stream": True, "model": "m", "temperature": 0}
+    assert cache_key("groq", body) == cache_key("groq", reordered)
+    assert cache_key("groq", body) != cache_key("openai", body)
+    assert cache_key("groq", body) != cache_key("groq", dict(body, max_tokens=5))
+
+
+def test_policy_only_caches_deterministic_requests_unless_forced():
+    cache = ResponseCache(MemoryBackend(1024), default_ttl=60)
+    body = {"model": "m", "temperature": 0.7, "messages": []}
+    assert cache.policy("groq", body, {}, "k") is None
+    assert cache.policy("groq", body, {"X-LLMProxy-Cache": "force"}, "k") is not None
+    assert cache.policy("groq", dict(body, temperature=0), {"X-LLMProxy-Cache": "bypass"}, "k") is None
+    assert cache.policy("groq", dict(body, temperature=0), {"X-LLMProxy-Cache": "refresh"}, "k").lookup is False
+    # Entries are per caller.
+    deterministic = dict(body, temperature=0)
+    assert cache.policy("groq", deterministic, {}, "k").key != cache.policy("groq", deterministic, {}, "other").key
+
+
+@pytest.mark.asyncio
+async def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(max_bytes=10)
+    await backend.set("a", b"1234", 60)
+    await backend.set("b", b"1234", 60)
+    assert await backend.get("a") == b"1234"
+    await backend.set("c", b"1234", 60)
+    assert await backend.get("b") is None
+    assert await backend.get("a") == b"1234"
+
+
+def test_replay_as_sse_rebuilds_chunks():
+    events = [e for e in replay_as_sse(COMPLETION)]
+    assert events[-1] == b"data: [DONE]\n\n"
+    chunks = [json.loads(e[6:]) for e in events[:-1]]
+    assert [c["choices"][0]["delta"] for c in chunks[:3]] == [{"role": "assistant"}, {"content": "hello"}, {}]
+    assert chunks[2]["choices"][0]["finish_reason"] == "stop"
+    assert chunks[3]["usage"] == COMPLETION["usage"]
@@ -0,0 +1,77 @@
+import httpx
+import pytest
+from api.servers import generic
+from api.servers.clients import registry
+from api.servers.routing import BACKEND_HEADER, ModelRouter, resolve_keys
+
+ALIASES = {"llama": ["groq/llama-3.3-70b-versatile", "cerebras/llama-3.3-70b", "nvidia/meta/llama-3.3-70b-instruct"]}
+
+
+def test_backends_are_ranked_by_expected_completion_time():
+    router = ModelRouter(ALIASES, explore=0)
+    groq, cerebras, nvidia = router.aliases["llama"]
+    assert nvidia.model == "meta/llama-3.3-70b-instruct"
+    # Unmeasured backends are tried first, in configuration order.
+    assert router.rank("llama", 500, ["groq", "cerebras", "nvidia"]) == [groq, cerebras, nvidia]
+
+    router.record_success(groq, 0.1, 100, 1.0)       # fast start, 100 tokens/s
+    router.record_success(cerebras, 0.5, 1000, 1.0)  # slow start, 1000 tokens/s
+    router.record_success(nvidia, None, 0, 0.3)
+    assert router.rank("llama", 10, ["groq", "cerebras"]) == [groq, cerebras]
+    assert router.rank("llama", 1000, ["groq", "cerebras"]) == [cerebras, groq]
+    assert router.rank("llama", 10, ["groq", "nvidia"]) == [groq, nvidia]
+
+    # A failing backend cools down and goes last.
+    router.record_failure(cerebras)
+    assert router.rank("llama", 1000, ["groq", "cerebras"]) == [groq, cerebras]
+    assert router.stats()["llama"]["cerebras/llama-3.3-70b"]["failed"] == 1
+
+
+def test_keys_come_from_pairs_or_a_configured_token(monkeypatch):
+    assert resolve_keys("groq=gsk_1, cerebras=csk-2") == {"groq": "gsk_1", "cerebras": "csk-2"}
+    monkeypatch.setattr("api.servers.routing.auto_keys", {"proxy-token": {"groq": "gsk_3"}})
+    assert resolve_keys("proxy-token") == {"groq": "gsk_3"}
+    assert resolve_keys("sk-plain") == {}
+
+
+@pytest.mark.asyncio
+async def test_auto_route_fails_over_and_names_the_backend(monkeypatch):
+    from main import app
+    router = ModelRouter(ALIASES, explore=0)
+    monkeypatch.setattr(generic, "model_router", router)
+    seen = []
+    groq_status = [503]
+
+    def handler(request: httpx.Request):
+        body = generic.codec.loads(request.content)
+        seen.append((request.url.host, body["model"], request.headers["authorization"]))
+        if request.url.host == "api.groq.com":
+            return httpx.Response(groq_status[0], text="no")
+        return httpx.Response(200, json={"choices": [], "usage": {"completion_tokens": 7}})
+
+    upstreams = [httpx.AsyncClient(transport=httpx.MockTransport(handler)) for _ in range(2)]
+    for platform, upstream in zip(("groq", "cerebras"), upstreams):
+        monkeypatch.setitem(registry._clients, platform, upstream)
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://proxy") as client:
+            response = await client.post("/auto/chat/completions", json={"model": "llama", "messages": []},
+                                         headers={"Authorization": "Bearer groq=gsk_1,cerebras=csk-2"})
+        assert response.status_code == 200
+        assert response.headers[BACKEND_HEADER] == "cerebras/llama-3.3-70b"
+        assert seen[0] == ("api.groq.com", "llama-3.3-70b-versatile", "Bearer gsk_1")
+        assert seen[-1] == ("api.cerebras.ai", "llama-3.3-70b", "Bearer csk-2")
+        groq, cerebras, _ = router.aliases["llama"]
+        assert groq.failed == 1 and cerebras.served == 1
+
+        # A rejected key fails over too, but is not the backend's fault.
+        groq_status[0] = 401
+        groq.cooldown_until = 0
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://proxy") as client:
+            response = await client.post("/auto/chat/completions", json={"model": "llama", "messages": []},
+                                         headers={"Authorization": "Bearer groq=bad-key,cerebras=csk-2"})
+        assert response.headers[BACKEND_HEADER] == "cerebras/llama-3.3-70b"
+        assert seen[-2][0] == "api.groq.com"
+        assert groq.failed == 1 and groq.cooldown_until == 0
+    finally:
+        for upstream in upstreams:
+            await upstream.aclose()
@@ -0,0 +1,30 @@
+from api.servers.semantic_cache import HashingEmbedder, SemanticCache
+
+
+def body(question, system="Be brief.", model="m"):
+    return {"model": model, "temperature": 0,
+            "messages": [{"role": "system", "content": system}, {"role": "user", "content": question}]}
+
+
+def test_semantic_cache_hits_paraphrase_in_same_context_only():
+    cache = SemanticCache(HashingEmbedder(), threshold=0.9)
+    cache.set(cache.query("groq", body("What is the capital of France?"), {}, "k"), b'{"answer": "Paris"}')
+
+    value, similarity = cache.get(cache.query("groq", body("what's the capital of france"), {}, "k"))
+    assert value == b'{"answer": "Paris"}' and 0.9 <= similarity < 1
+    assert cache.get(cache.query("groq", body("What is the capital of Germany?"), {}, "k")) is None
+    assert cache.get(cache.query("groq", body("What is the capital of France?", system="Be verbose."), {}, "k")) is None
+    assert cache.get(cache.query("groq", body("What is the capital of France?", model="other"), {}, "k")) is None
+    assert cache.get(cache.query("groq", body("What is the capital of France?"), {}, "other-key")) is None
+    assert cache.query("groq", dict(body("What is the capital of France?"), temperature=1), {}, "k") is None
+    assert cache.query("groq", body("What is the capital of France?"), {"X-LLMProxy-Cache": "bypass"}, "k") is None
+
+
+def test_semantic_cache_evicts_least_recently_used():
+    cache = SemanticCache(HashingEmbedder(), max_entries=2)
+    for i, question in enumerate(["How do I reverse a list?", "How do I sort a dict?", "How do I read a file?"]):
+        cache.set(cache.query("groq", body(question), {}, "k"), str(i).encode())
+    assert cache.stats()["entries"] == 2 and cache.stats()["evictions"] == 1
+    assert len(cache.index) == 2
+    assert cache.get(cache.query("groq", body("How do I reverse a list?"), {}, "k")) is None
+    assert cache.get(cache.query("groq", body("How do I read a file?"), {}, "k"))[0] == b"2"
@@ -0,0 +1,58 @@
+import asyncio
+import pytest
+from api.servers import codec
+from api.servers.codec import ChunkTemplate
+from api.servers.shaping import EventShaper, shape_stream
+
+template = ChunkTemplate("chatcmpl-1", "llama", 1)
+ROLE = template.event([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+
+
+def contents(events):
+    texts = []
+    for event in events:
+        chunk = codec.loads(event[6:])
+        texts.append(chunk["choices"][0]["delta"].get("content") if chunk.get("choices") else None)
+    return texts
+
+
+def test_first_token_goes_out_at_once_and_later_ones_merge_up_to_the_size():
+    shaper = EventShaper(max_bytes=8, interval=1)
+    assert shaper.feed(ROLE + template.content("He"), now=0) == [ROLE, template.content("He")]
+    # Split across reads, and merged until 8 bytes of text are held.
+    event = template.content("llo")
+    assert shaper.feed(event[:10], now=0) == []
+    assert shaper.feed(event[10:] + template.content(" wo"), now=0) == []
+    out = shaper.feed(template.content("rld") + template.content("!"), now=0)
+    assert contents(out) == ["llo world"]
+    assert codec.loads(out[0][6:])["id"] == "chatcmpl-1"
+    # Anything else flushes the held text first and is relayed unchanged.
+    finish = template.finish("stop")
+    assert shaper.feed(finish + codec.DONE, now=0) == [template.content("!"), finish, codec.DONE]
+
+
+def test_held_text_is_sent_at_its_deadline():
+    shaper = EventShaper(max_bytes=1000, interval=0.02)
+    shaper.feed(template.content("a"), now=0)
+    assert shaper.feed(template.content("b") + template.content("c"), now=0.01) == []
+    assert contents(shaper.feed(template.content("d"), now=0.03)) == ["bcd"]
+    assert shaper.feed(template.content("e"), now=0.04) == []
+    assert contents(shaper.flush()) == ["e"] and not shaper.pending
+
+
+@pytest.mark.asyncio
+async def test_stream_flushes_while_upstream_is_quiet():
+    async def upstream():
+        for text in ("a", "b", "c"):
+            yield template.content(text)
+        await asyncio.sleep(0.2)
+        yield codec.DONE
+
+    received = []
+    async for event in shape_stream(upstream(), enabled=True):
+        received.append((event, asyncio.get_running_loop().time()))
+    events = [event for event, _ in received]
+    assert events[0] == template.content("a") and events[2] == codec.DONE
+    assert contents(events[1:2]) == ["bc"]
+    # The merged text did not wait for the next upstream event.
+    assert received[2][1] - received[1][1] > 0.1
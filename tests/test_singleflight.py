@@ -0,0 +1,139 @@
+import asyncio
+import pytest
+from api.servers.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_execution():
+    flights = SingleFlight()
+    calls = []
+
+    async def upstream():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return b"result"
+
+    results = await asyncio.gather(*(flights.call("k", upstream) for _ in range(5)))
+    assert results == [b"result"] * 5
+    assert len(calls) == 1
+    assert flights.stats()["joined"] == 4
+    # Once finished, the next call goes upstream again.
+    await flights.call("k", upstream)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_stream_fan_out_with_late_joiner_catch_up():
+    flights = SingleFlight()
+    opened = []
+    release = asyncio.Event()
+
+    async def chunks():
+        yield b"a"
+        yield b"b"
+        await release.wait()
+        yield b"c"
+
+    async def open_stream():
+        opened.append(1)
+        return chunks()
+
+    async def consume(stream):
+        return [chunk async for chunk in stream]
+
+    first = asyncio.ensure_future(consume(await flights.stream("k", open_stream)))
+    await asyncio.sleep(0.01)
+    late = asyncio.ensure_future(consume(await flights.stream("k", open_stream)))
+    await asyncio.sleep(0.01)
+    release.set()
+    assert await first == [b"a", b"b", b"c"]
+    assert await late == [b"a", b"b", b"c"]
+    assert len(opened) == 1
+
+
+@pytest.mark.asyncio
+async def test_stream_open_error_reaches_every_waiter():
+    flights = SingleFlight()
+
+    async def open_stream():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream said no")
+
+    results = await asyncio.gather(*(flights.stream("k", open_stream) for _ in range(3)),
+                                   return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+@pytest.mark.asyncio
+async def test_stream_producer_waits_for_slowest_subscriber_and_stops_when_all_leave():
+    flights = SingleFlight(max_lag=2)
+    produced = []
+    closed = asyncio.Event()
+
+    async def chunks():
+        try:
+            for i in range(100):
+                produced.append(i)
+                yield b"%d" % i
+        finally:
+            closed.set()
+
+    async def open_stream():
+        return chunks()
+
+    stream = await flights.stream("k", open_stream)
+    assert await stream.__anext__() == b"0"
+    await asyncio.sleep(0.01)
+    assert len(produced) <= 4
+    await stream.aclose()
+    await asyncio.wait_for(closed.wait(), 1)
+    assert len(produced) <= 4
+
+
+@pytest.mark.asyncio
+async def test_stream_is_cancelled_when_callers_leave_before_reading():
+    flights = SingleFlight(max_lag=2)
+    closed = asyncio.Event()
+
+    async def chunks():
+        try:
+            for i in range(100):
+                yield b"%d" % i
+        finally:
+            closed.set()
+
+    async def open_stream():
+        await asyncio.sleep(0.01)
+        return chunks()
+
+    # One caller is cancelled while the stream opens, the other never iterates.
+    leader = asyncio.ensure_future(flights.stream("k", open_stream))
+    await asyncio.sleep(0)
+    leader.cancel()
+    follower = await flights.stream("k", open_stream)
+    await follower.aclose()
+    await asyncio.wait_for(closed.wait(), 1)
+    assert flights.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_error_after_open_reaches_every_subscriber():
+    flights = SingleFlight()
+
+    async def chunks():
+        yield b"a"
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream broke")
+
+    async def open_stream():
+        return chunks()
+
+    async def consume(stream):
+        received = []
+        with pytest.raises(RuntimeError):
+            async for chunk in stream:
+                received.append(chunk)
+        return received
+
+    streams = [await flights.stream("k", open_stream) for _ in range(2)]
+    assert await asyncio.gather(*(consume(s) for s in streams)) == [[b"a"], [b"a"]]
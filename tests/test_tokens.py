@@ -0,0 +1,32 @@
+from api.servers.base import ContentPart, ImageUrl, Message
+from api.servers.tokens import TOKENS_PER_IMAGE, estimate_message_tokens, estimate_prompt_tokens, estimate_tokens
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("Hello, world!") == 4
+    # One token per CJK character, punctuation included.
+    assert estimate_tokens("你好，世界") == 5
+    # Long words are split roughly every four characters.
+    assert estimate_tokens("internationalization") == 5
+
+
+def test_estimate_message_tokens_counts_images():
+    text_only = [Message(role="user", content="Describe this")]
+    with_image = [Message(role="user", content=[
+        ContentPart(type="text", text="Describe this"),
+        ContentPart(type="image_url", image_url=ImageUrl(url="https://example.com/a.png")),
+    ])]
+    assert estimate_message_tokens(with_image) == estimate_message_tokens(text_only) + TOKENS_PER_IMAGE
+
+
+def test_estimate_prompt_tokens_matches_models_and_ignores_image_bytes():
+    image = "data:image/png;base64," + "A" * 100000
+    body = {"model": "m", "messages": [
+        {"role": "system", "content": "Be brief."},
+        {"role": "user", "content": [{"type": "text", "text": "Describe this"},
+                                     {"type": "image_url", "image_url": {"url": image}}]},
+    ]}
+    messages = [Message.parse_obj(message) for message in body["messages"]]
+    assert estimate_prompt_tokens(body) == estimate_message_tokens(messages) < 300
+    assert estimate_prompt_tokens({"model": "m"}) == 0
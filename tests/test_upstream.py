@@ -0,0 +1,119 @@
+import asyncio
+import httpx
+import pytest
+from api.servers.upstream import Endpoint, UpstreamPool
+
+
+def make_pool(*urls, **kwargs):
+    kwargs.setdefault("backoff_base", 0.001)
+    return UpstreamPool("test", [Endpoint(url=url) for url in urls], **kwargs)
+
+
+def build(client: httpx.AsyncClient):
+    return lambda url: client.build_request("POST", url, content=b"{}")
+
+
+@pytest.mark.asyncio
+async def test_retries_on_another_endpoint_before_first_byte():
+    calls = []
+
+    def handler(request: httpx.Request):
+        calls.append(request.url.host)
+        if request.url.host == "bad":
+            return httpx.Response(503)
+        return httpx.Response(200, json={"ok": True})
+
+    pool = make_pool("http://bad/v1", "http://good/v1")
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        for _ in range(5):
+            response = await pool.send(client, build(client))
+            await response.aread()
+            assert response.status_code == 200
+    assert calls.count("good") == 5
+    assert pool.stats()["endpoints"][0]["failures"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_connect_errors_are_retried_then_raised():
+    def handler(request: httpx.Request):
+        raise httpx.ConnectError("refused", request=request)
+
+    pool = make_pool("http://down/v1", retries=2)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        with pytest.raises(httpx.ConnectError):
+            await pool.send(client, build(client))
+    assert pool.attempts == 3
+
+
+@pytest.mark.asyncio
+async def test_long_retry_after_is_returned_to_caller():
+    def handler(request: httpx.Request):
+        return httpx.Response(429, headers={"retry-after": "60"})
+
+    pool = make_pool("http://busy/v1")
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        response = await pool.send(client, build(client))
+    assert response.status_code == 429
+    assert pool.attempts == 1
+
+
+@pytest.mark.asyncio
+async def test_hedged_request_wins_over_slow_endpoint():
+    async def handler(request: httpx.Request):
+        if request.url.host == "slow":
+            await asyncio.sleep(1)
+        return httpx.Response(200, json={"host": request.url.host})
+
+    pool = make_pool("http://slow/v1", "http://fast/v1", hedge=True)
+    pool._ttfb.extend([0.01] * 50)
+    pool.choose = lambda exclude=frozenset(): pool.endpoints[1] if exclude else pool.endpoints[0]
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        response = await asyncio.wait_for(pool.send(client, build(client)), 0.5)
+        await response.aread()
+    assert response.json() == {"host": "fast"}
+    assert pool.hedged == 1 and pool.hedge_wins == 1
+
+
+@pytest.mark.asyncio
+async def test_errors_after_the_request_was_sent_are_not_retried():
+    def handler(request: httpx.Request):
+        raise httpx.ReadTimeout("no answer", request=request)
+
+    pool = make_pool("http://a/v1", "http://b/v1", retries=2)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        with pytest.raises(httpx.ReadTimeout):
+            await pool.send(client, build(client))
+    assert pool.attempts == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelling_a_hedged_request_cancels_its_attempts():
+    started, cancelled = [], []
+
+    async def handler(request: httpx.Request):
+        started.append(request.url.host)
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(request.url.host)
+            raise
+        return httpx.Response(200)
+
+    async def cancel_after(hedge_delay):
+        started.clear()
+        cancelled.clear()
+        pool = make_pool("http://a/v1", "http://b/v1", hedge=True)
+        pool._ttfb.extend([hedge_delay] * 50)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            request = asyncio.ensure_future(pool.send(client, build(client)))
+            await asyncio.sleep(0.05)
+            request.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await request
+            await asyncio.sleep(0)
+        assert started and sorted(cancelled) == sorted(started)
+        return len(started)
+
+    # While waiting for the hedge deadline, and after the hedge was sent.
+    assert await cancel_after(5.0) == 1
+    assert await cancel_after(0.01) == 2